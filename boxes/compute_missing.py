@@ -25,6 +25,7 @@ compute missing boxes to get a smoother experience when using the downloaded cha
 there is a compromise between the # of tiles and the layers we can leave empty.
 we start from the highest zoom level and ensure that we hav a box at zoom + MAX_EMPTY that covers the same are
 '''
+import concurrent.futures
 import importlib.util
 import os
 import sys
@@ -54,77 +55,119 @@ class Log(object):
   def error(self, fmt, *args):
     print("E:%s" % (fmt % (args)))
 
-def findCompleteMatch(parsedBoxes,box,maxEmpty):
-  zoomLevels = parsedBoxes.getZoomLevels()
-  zoom=box.zoom-1
-  down=1
-  while zoom >= min(zoomLevels) and down <= (maxEmpty+1):
+def boxToRect(box):
+  return (box.southwest.lat,box.southwest.lng,box.northeast.lat,box.northeast.lng)
+
+class Coverage(object):
+  '''
+  the boxes per zoom level with a spatial index
+  to check if a box is covered by the boxes of lower zoom levels
+  the coverage is computed from tile ranges, not from tile lists
+  '''
+  def __init__(self,minZoom):
+    self.minZoom=minZoom
+    self.indexes={}
+
+  def add(self,zoom,rect):
+    index=self.indexes.get(zoom)
+    if index is None:
+      index=seedCreator.GridIndex(min(90.0,2.0**(13-zoom)))
+      self.indexes[zoom]=index
+    index.add(*rect,rect)
+
+  def isCovered(self,rect,zoom):
+    '''
+    check if all tiles of a box at zoom are covered by the boxes of this zoom level
+    '''
+    index=self.indexes.get(zoom)
+    if index is None:
+      return False
+    (swlat,swlng,nelat,nelng)=rect
     intersecting=[]
-    for compare in parsedBoxes.getZoomBounds(zoom):
-      if compare.contains(box):
-        return True
-      intersection=compare.intersection(box)
-      if intersection is not None:
-        intersecting.append(intersection)
-    if len(intersecting) > 0:
-      tileList=box.getTileList(-down)
-      foundTiles=[]
-      for intersection in intersecting:
-        foundTiles+=intersection.getTileList()
-      allFound=True
-      for tile in tileList:
-        if tile not in foundTiles:
-          allFound=False
-          break
-      if allFound:
+    for (cswlat,cswlng,cnelat,cnelng) in index.query(*rect):
+      if cnelat >= nelat and cnelng >= nelng and cswlat <= swlat and cswlng <= swlng:
         return True
+      inelat=min(nelat,cnelat)
+      inelng=min(nelng,cnelng)
+      iswlat=max(swlat,cswlat)
+      iswlng=max(swlng,cswlng)
+      if inelat > iswlat and inelng > iswlng:
+        intersecting.append((iswlat,iswlng,inelat,inelng))
+    if len(intersecting) < 1:
+      return False
+    #tiles like Box.getTileList would give - without any clipping
+    #the tiles of the intersections are a subset of the tiles of the box
+    ranges=seedCreator.tileRanges(intersecting+[rect],zoom,clip=False)
+    (xmin,ymin,xmax,ymax)=ranges.pop()
+    numTiles=max(0,xmax-xmin+1)*max(0,ymax-ymin+1)
+    return seedCreator.unionArea(ranges) >= numTiles
 
-    down+=1
+  def findCompleteMatch(self,rect,zoom,maxEmpty):
+    '''
+    check if a box at zoom is covered by boxes
+    at one of the maxEmpty+1 zoom levels below
+    '''
+    down=1
     zoom-=1
-  return False
+    while zoom >= self.minZoom and down <= (maxEmpty+1):
+      if self.isCovered(rect,zoom):
+        return True
+      down+=1
+      zoom-=1
+    return False
+
+def findCompleteMatch(coverage,box,maxEmpty):
+  return coverage.findCompleteMatch(boxToRect(box),box.zoom,maxEmpty)
+
+def _checkZoom(args):
+  (zoom,rects,lowerRects,minZoom,maxEmpty)=args
+  coverage=Coverage(minZoom)
+  for (z,rect) in lowerRects:
+    coverage.add(z,rect)
+  return [coverage.findCompleteMatch(rect,zoom,maxEmpty) for rect in rects]
+
+def checkZoomLevels(parsedBoxes,zoomLevels,maxEmpty,processes=None):
+  '''
+  check the boxes of several zoom levels in parallel
+  as adding boxes can only add coverage, a box found here will
+  also be found later on
+  :return: dict zoom -> list of results for the current boxes of this zoom
+  '''
+  minZoom=min(parsedBoxes.getZoomLevels())
+  tasks=[]
+  for zoom in zoomLevels:
+    rects=[boxToRect(b) for b in parsedBoxes.getZoomBounds(zoom)]
+    lowerRects=[]
+    for z in range(max(minZoom,zoom-maxEmpty-1),zoom):
+      lowerRects+=[(z,boxToRect(b)) for b in parsedBoxes.getZoomBounds(z)]
+    tasks.append((zoom,rects,lowerRects,minZoom,maxEmpty))
+  #start with the largest levels
+  tasks.sort(key=lambda t: len(t[1])*len(t[2]),reverse=True)
+  if processes == 1:
+    results=map(_checkZoom,tasks)
+  else:
+    executor=concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    results=executor.map(_checkZoom,tasks)
+  rt={}
+  for task,result in zip(tasks,results):
+    rt[task[0]]=result
+  if processes != 1:
+    executor.shutdown()
+  return rt
 
 class Combine(seedCreator.LogEnabled):
+  MAXDIFF = 0.01
   def __init__(self,logHandler=None):
     super().__init__(logHandler=logHandler)
 
-  def canCombine(self,box, next):
+  def combineBoxes(self,boxList):
     '''
-    we should be able to combine
-    (1)if the ne edge of box is close to the nw edge of combine
-    and the se edge of box is close to sw of combine
-    (2)if the sw edge of box is close to nw of combine and
-    se of box is close to ne of combine
-    :param box:
-    :param next:
-    :return:
+    replace the boxes of each zoom level by a set of non overlapping boxes
+    covering the union of them
+    coordinates closer then MAXDIFF (but at most 1/8 of a tile) are considered to be equal
+    :param boxList:
+    :return: the list of boxes, named COMPnnnnn
     '''
-    MAXDIFF = 0.01
-    nextNw = seedCreator.LatLng(next.northeast.lat, next.southwest.lng)
-    boxSe = seedCreator.LatLng(box.southwest.lat, box.northeast.lng)
-    if box.northeast.closeTo(nextNw, MAXDIFF) and boxSe.closeTo(next.southwest, MAXDIFF):
-      return True
-    if box.southwest.closeTo(nextNw, MAXDIFF) and boxSe.closeTo(next.northeast, MAXDIFF):
-      return True
-    return False
-
-  def combineSorted(self,zoomBoxes):
-    rt=[]
-    combined = None
-    for box in zoomBoxes:
-      if combined is None:
-        combined = box
-        continue
-      if self.canCombine(combined, box):
-        self.logInfo("combine %s and %s",str(combined),str(box))
-        combined.extend(box)
-        continue
-      rt.append(combined)
-      combined = box
-    if combined is not None:
-      rt.append(combined)
-    return rt
-
-  def combineBoxes(self,boxList):
     parsed = seedCreator.Parsed(boxList)
     start=len(boxList)
     rt = []
@@ -132,48 +175,44 @@ class Combine(seedCreator.LogEnabled):
       zoomBoxes = parsed.getZoomBounds(zoom)
       if len(zoomBoxes) < 1:
         continue
-      self.logInfo("%d boxes on zoom %s",len(zoomBoxes),zoom)
-      zoomBoxes = sorted(zoomBoxes, key=lambda x: x.northeast.lat)
-      zoomBoxes = sorted(zoomBoxes, key=lambda x: x.northeast.lng)
-      zoomBoxes=self.combineSorted(zoomBoxes)
-      self.logInfo("%d boxes on zoom %d after pass#1",len(zoomBoxes),zoom)
-      zoomBoxes = sorted(zoomBoxes, key=lambda x: x.northeast.lng)
-      zoomBoxes = sorted(zoomBoxes, key=lambda x: x.northeast.lat)
-      zoomBoxes = self.combineSorted(zoomBoxes)
-      self.logInfo("%d boxes on zoom %d after pass#2", len(zoomBoxes), zoom)
-      zoomBoxes=sorted(zoomBoxes,key=lambda x:x.getSize(),reverse=True)
-      reduced=[]
-      for box in zoomBoxes:
-        contained=False
-        for red in reduced:
-          if red.contains(box):
-            contained=True
-            break
-        if contained:
-          self.logInfo("skipping already contained %s",str(box))
-          continue
-        reduced.append(box)
-      self.logInfo("%d boxes on zoom %d after pass#3", len(reduced), zoom)
-      rt+=reduced
+      tolerance=min(self.MAXDIFF,360.0/2**zoom/8)
+      rects=seedCreator.rectUnion([boxToRect(b) for b in zoomBoxes],tolerance)
+      self.logInfo("%d boxes on zoom %d reduced to %d",len(zoomBoxes),zoom,len(rects))
+      for (swlat,swlng,nelat,nelng) in rects:
+        box=seedCreator.Box(seedCreator.LatLng(nelat,nelng),seedCreator.LatLng(swlat,swlng),
+                            zoom=zoom,name="COMP%05d"%len(rt))
+        box.isComputed=True
+        rt.append(box)
     self.logInfo("reduced from %d to %d boxes",start,len(rt))
     return rt
 
 
 logHandler=Log()
 
-def computeMissing(inFile,outFile,maxEmpty=1):
+def computeMissing(inFile,outFile,maxEmpty=1,processes=None):
   boxReader=seedCreator.Boxes(boxes=inFile,logHandler=logHandler)
   boxReader.mergeBoxes()
   parsedBoxes=boxReader.getParsed()
   zoomLevels=parsedBoxes.getZoomLevels()
   additionalBoxes=[]
+  coverage=Coverage(min(zoomLevels))
+  for zoom in zoomLevels:
+    for box in parsedBoxes.getZoomBounds(zoom):
+      coverage.add(zoom,boxToRect(box))
+  checkLevels=list(range(max(zoomLevels),min(zoomLevels),-1))
+  checked=checkZoomLevels(parsedBoxes,checkLevels,maxEmpty,processes)
   #we go from max to min+1...
-  for zoom in range(max(zoomLevels),min(zoomLevels),-1):
+  for zoom in checkLevels:
     zoomBoxes=parsedBoxes.getZoomBounds(zoom)
-    for box in zoomBoxes:
+    zoomChecked=checked.get(zoom,[])
+    for idx,box in enumerate(zoomBoxes):
       #currently simple approach:
       #check if we find a complete match - otherwise add a box
-      hasUpper=findCompleteMatch(parsedBoxes,box,maxEmpty)
+      #only boxes not found in the parallel check need to be checked
+      #again with the boxes we added
+      hasUpper=idx < len(zoomChecked) and zoomChecked[idx]
+      if not hasUpper:
+        hasUpper=findCompleteMatch(coverage,box,maxEmpty)
       if not hasUpper:
         upperZoom=box.zoom-maxEmpty-1
         while upperZoom < min(zoomLevels):
@@ -189,6 +228,7 @@ def computeMissing(inFile,outFile,maxEmpty=1):
         logHandler.log("creating upperBox %s for %s",str(upperBox),str(box))
         additionalBoxes.append(upperBox)
         parsedBoxes.addBox(upperBox)
+        coverage.add(upperBox.zoom,boxToRect(upperBox))
   logHandler.log("created %d additionalBoxes",len(additionalBoxes))
   combine=Combine(logHandler)
   additionalBoxes=combine.combineBoxes(additionalBoxes)
@@ -208,7 +248,7 @@ def testCombine(boxFile):
 
 
 def usage():
-  print("usage: %s infile outfile [maxEmpty]"%sys.argv[0],file=sys.stderr)
+  print("usage: %s infile outfile [maxEmpty [processes]]"%sys.argv[0],file=sys.stderr)
 
 if __name__ == '__main__':
   if len(sys.argv) < 3:
@@ -222,7 +262,10 @@ if __name__ == '__main__':
   maxEmpty=1
   if len(sys.argv) > 3:
     maxEmpty=int(sys.argv[3])
-  computeMissing(infile,outfile,maxEmpty)
+  processes=None
+  if len(sys.argv) > 4:
+    processes=int(sys.argv[4])
+  computeMissing(infile,outfile,maxEmpty,processes)
 
 
 
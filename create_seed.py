@@ -19,12 +19,37 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
+import bisect
+import importlib.util
+import io
 import math
+import mmap
 import os
 import re
+import sqlite3
+import struct
 import sys
+import threading
+import urllib.request
 
 import yaml
+try:
+  import numpy
+except ImportError:
+  numpy=None
+
+def loadModuleFromFile(fileName):
+  if not os.path.isabs(fileName):
+    fileName=os.path.join(os.path.dirname(__file__),fileName)
+  moduleName=os.path.splitext(os.path.basename(fileName))[0]
+  # see https://docs.python.org/3/library/importlib.html#module-importlib
+  spec = importlib.util.spec_from_file_location(moduleName, fileName)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  sys.modules[moduleName] = module
+  return module
+
+lrucache=loadModuleFromFile('lrucache.py')
 
 def deg2num(lat_deg, lon_deg, zoom):
   lat_rad = math.radians(lat_deg)
@@ -33,6 +58,91 @@ def deg2num(lat_deg, lon_deg, zoom):
   ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
   return (xtile, ytile,zoom)
 
+#below this number of points numpy is slower then the plain loop
+NUMPY_MIN_POINTS=64
+#numpy tan/arcsinh may differ from math by some ulp - values closer
+#then this to a tile border are recomputed with deg2num
+BORDER_EPSILON=1e-6
+def deg2numArray(lats, lngs, zooms):
+  '''
+  batch version of deg2num, vectorized if numpy is available
+  :param lats: sequence of latitudes
+  :param lngs: sequence of longitudes
+  :param zooms: sequence of zoom levels or one zoom level for all
+  :return: (xtiles,ytiles) - numpy int arrays or lists if we have no numpy
+  '''
+  if numpy is None or len(lats) < NUMPY_MIN_POINTS:
+    if not isinstance(zooms,(list,tuple)):
+      zooms=[zooms]*len(lats)
+    xtiles=[]
+    ytiles=[]
+    for (lat,lng,zoom) in zip(lats,lngs,zooms):
+      (x,y,z)=deg2num(lat,lng,zoom)
+      xtiles.append(x)
+      ytiles.append(y)
+    return (xtiles,ytiles)
+  latArray=numpy.asarray(lats,dtype=numpy.float64)
+  lat_rad=numpy.radians(latArray)
+  n=numpy.ldexp(1.0,numpy.asarray(zooms,dtype=numpy.int32))
+  xtiles=numpy.trunc((numpy.asarray(lngs,dtype=numpy.float64) + 180.0) / 360.0 * n)
+  yvalues=(1.0 - numpy.arcsinh(numpy.tan(lat_rad)) / numpy.pi) / 2.0 * n
+  ytiles=numpy.trunc(yvalues).astype(numpy.int64)
+  border=numpy.nonzero(numpy.abs(yvalues-numpy.rint(yvalues)) < BORDER_EPSILON)[0]
+  if len(border) > 0:
+    zoomArray=numpy.broadcast_to(numpy.asarray(zooms),latArray.shape)
+    for i in border.tolist():
+      ytiles[i]=deg2num(float(latArray[i]),0,int(zoomArray[i]))[1]
+  return (xtiles.astype(numpy.int64),ytiles)
+
+def tileRanges(rects, zooms, clip=True):
+  '''
+  get the tile ranges for many boxes at once
+  :param rects: list of (swlat,swlng,nelat,nelng)
+  :param zooms: list of zoom levels (one per rect) or one zoom level for all
+  :param clip: limit the ranges to the valid tiles like Box.getTileRange,
+               otherwise return them like Box.getTileList would iterate them
+  :return: list of (xmin,ymin,xmax,ymax) - inclusive
+  '''
+  num=len(rects)
+  if num < 1:
+    return []
+  single=not isinstance(zooms,(list,tuple))
+  allZooms=zooms if single else list(zooms)+list(zooms)
+  (xtiles,ytiles)=deg2numArray(
+    [r[0] for r in rects]+[r[2] for r in rects],
+    [r[1] for r in rects]+[r[3] for r in rects],
+    allZooms)
+  if not isinstance(xtiles,list):
+    swx,nex=xtiles[:num],xtiles[num:]
+    swy,ney=ytiles[:num],ytiles[num:]
+    if not clip:
+      return list(zip(swx.tolist(),ney.tolist(),nex.tolist(),swy.tolist()))
+    maxTile=numpy.left_shift(1,numpy.asarray(zooms,dtype=numpy.int64))-1
+    return list(zip(
+      numpy.maximum(0,numpy.minimum(swx,nex)).tolist(),
+      numpy.maximum(0,numpy.minimum(swy,ney)).tolist(),
+      numpy.minimum(maxTile,numpy.maximum(swx,nex)).tolist(),
+      numpy.minimum(maxTile,numpy.maximum(swy,ney)).tolist()))
+  rt=[]
+  for i in range(num):
+    (swx,nex,swy,ney)=(xtiles[i],xtiles[num+i],ytiles[i],ytiles[num+i])
+    if not clip:
+      rt.append((swx,ney,nex,swy))
+      continue
+    maxTile=2**int(zooms if single else zooms[i])-1
+    rt.append((max(0,min(swx,nex)),max(0,min(swy,ney)),min(maxTile,max(swx,nex)),min(maxTile,max(swy,ney))))
+  return rt
+
+def num2deg(xtile, ytile, zoom):
+  '''
+  get the north west corner of a tile
+  :return: (lat,lon)
+  '''
+  n = 2.0 ** zoom
+  lon_deg = xtile / n * 360.0 - 180.0
+  lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
+  return (math.degrees(lat_rad), lon_deg)
+
 class LogEnabled(object):
   def __init__(self,logHandler=None):
     self.logHandler=logHandler
@@ -179,25 +289,737 @@ class Box(object):
     if self.zoom is None or self.zoom < 0:
       return 0
     add=1 if roundDown is False else 0
-    netile=deg2num(self.northeast.lat,self.northeast.lng,self.zoom)
-    swtile=deg2num(self.southwest.lat,self.southwest.lng,self.zoom)
-    xdiff=abs(netile[0]-swtile[0])+add
-    ydiff=abs(netile[1]-swtile[1])+add
+    (xtiles,ytiles)=deg2numArray([self.northeast.lat,self.southwest.lat],
+                                 [self.northeast.lng,self.southwest.lng],self.zoom)
+    xdiff=abs(int(xtiles[0])-int(xtiles[1]))+add
+    ydiff=abs(int(ytiles[0])-int(ytiles[1]))+add
     return xdiff*ydiff
 
+  def getTileRange(self,zoomOffset=0):
+    '''
+    get the range of tiles covered by the box
+    :return: (xmin,ymin,xmax,ymax) - inclusive, limited to the valid tiles of the zoom level
+             or None if the box has no zoom
+    '''
+    if self.zoom is None or self.zoom < 0:
+      return None
+    zoom=self.zoom+zoomOffset
+    return tileRanges([(self.southwest.lat,self.southwest.lng,self.northeast.lat,self.northeast.lng)],zoom)[0]
+
   def getTileList(self,zoomOffset=0):
     if self.zoom is None or self.zoom < 0:
       return []
     zoom=self.zoom+zoomOffset
-    netile = deg2num(self.northeast.lat, self.northeast.lng, zoom)
-    swtile = deg2num(self.southwest.lat, self.southwest.lng, zoom)
+    (x0,y0,x1,y1)=tileRanges([(self.southwest.lat,self.southwest.lng,self.northeast.lat,self.northeast.lng)],
+                             zoom,clip=False)[0]
     rt=[]
-    for x in range(swtile[0],netile[0]+1):
-      for y in range(netile[1],swtile[1]+1):
+    for x in range(x0,x1+1):
+      for y in range(y0,y1+1):
         rt.append((x,y,zoom))
     return rt
 
 yaml.add_representer(Box,Box.representYaml,Dumper=yaml.dumper.SafeDumper)
+
+def unionArea(rects):
+  '''
+  get the number of tiles covered by a list of tile ranges
+  we sweep over the columns and keep the covered rows
+  (compressed to the range borders) in a segment tree
+  :param rects: list of (xmin,ymin,xmax,ymax) - inclusive
+  :return: the number of tiles
+  '''
+  if len(rects) < 1:
+    return 0
+  if len(rects) == 1:
+    (x0,y0,x1,y1)=rects[0]
+    return (x1-x0+1)*(y1-y0+1)
+  rows=sorted(set([r[1] for r in rects]+[r[3]+1 for r in rects]))
+  rowIndex={y:i for i,y in enumerate(rows)}
+  events=[]
+  for (x0,y0,x1,y1) in rects:
+    events.append((x0,1,rowIndex[y0],rowIndex[y1+1]))
+    events.append((x1+1,-1,rowIndex[y0],rowIndex[y1+1]))
+  events.sort()
+  numSegments=len(rows)-1
+  counts=[0]*(4*numSegments)
+  covered=[0]*(4*numSegments)
+  def update(node,lower,upper,start,end,value):
+    if end <= lower or upper <= start:
+      return
+    if start <= lower and upper <= end:
+      counts[node]+=value
+    else:
+      middle=(lower+upper)//2
+      update(2*node,lower,middle,start,end,value)
+      update(2*node+1,middle,upper,start,end,value)
+    if counts[node] > 0:
+      covered[node]=rows[upper]-rows[lower]
+    elif upper-lower == 1:
+      covered[node]=0
+    else:
+      covered[node]=covered[2*node]+covered[2*node+1]
+  rt=0
+  lastColumn=events[0][0]
+  for (column,value,start,end) in events:
+    rt+=covered[1]*(column-lastColumn)
+    lastColumn=column
+    update(1,0,numSegments,start,end,value)
+  return rt
+
+def _snapCoordinates(values,tolerance):
+  '''
+  group coordinates that are not more then tolerance away from the first
+  (smallest) value of their group - so a group never spans more then tolerance
+  :return: dict value -> (min of group, max of group)
+  '''
+  rt={}
+  group=[]
+  for v in sorted(set(values)):
+    if len(group) > 0 and v - group[0] > tolerance:
+      for g in group:
+        rt[g]=(group[0],group[-1])
+      group=[]
+    group.append(v)
+  for g in group:
+    rt[g]=(group[0],group[-1])
+  return rt
+
+def _sweepUnion(rects):
+  '''
+  sweep over x, for each strip between two x borders merge the y intervals
+  of the active rectangles, intervals that continue in the next strip
+  extend the rectangle
+  :param rects: list of (x0,y0,x1,y1) with x0 < x1, y0 < y1
+  :return: list of non overlapping (x0,y0,x1,y1)
+  '''
+  events={}
+  for r in rects:
+    if events.get(r[0]) is None:
+      events[r[0]]=[]
+    events[r[0]].append((1,r[1],r[3]))
+    if events.get(r[2]) is None:
+      events[r[2]]=[]
+    events[r[2]].append((-1,r[1],r[3]))
+  active={}
+  #the keys of active, kept sorted
+  activeKeys=[]
+  openRects={}
+  rt=[]
+  for x in sorted(events.keys()):
+    for (change,y0,y1) in events[x]:
+      key=(y0,y1)
+      count=active.get(key,0)+change
+      if count > 0:
+        if key not in active:
+          bisect.insort(activeKeys,key)
+        active[key]=count
+      else:
+        del active[key]
+        del activeKeys[bisect.bisect_left(activeKeys,key)]
+    intervals=[]
+    for (y0,y1) in activeKeys:
+      if len(intervals) > 0 and y0 <= intervals[-1][1]:
+        if y1 > intervals[-1][1]:
+          intervals[-1]=(intervals[-1][0],y1)
+        continue
+      intervals.append((y0,y1))
+    current=set(intervals)
+    for interval in list(openRects.keys()):
+      if interval not in current:
+        rt.append((openRects[interval],interval[0],x,interval[1]))
+        del openRects[interval]
+    for interval in intervals:
+      if interval not in openRects:
+        openRects[interval]=x
+  return rt
+
+def _area(r):
+  return (r[2]-r[0])*(r[3]-r[1])
+
+def _intersect(r,other):
+  rt=(max(r[0],other[0]),max(r[1],other[1]),min(r[2],other[2]),min(r[3],other[3]))
+  if rt[0] < rt[2] and rt[1] < rt[3]:
+    return rt
+
+def _isCovered(r,pieces,disjoint=False):
+  '''
+  check if a rectangle is completely covered by others
+  :param pieces: the rectangles to check, only the ones touching r are needed
+  :param disjoint: if True the pieces do not overlap
+  '''
+  clipped=[]
+  for piece in pieces:
+    i=_intersect(r,piece)
+    if i is not None:
+      clipped.append(i)
+  if len(clipped) < 1:
+    return False
+  if not disjoint:
+    clipped=_sweepUnion(clipped)
+  return sum(_area(c) for c in clipped) >= _area(r)*(1-1e-12)
+
+def _coverRects(rects,union):
+  '''
+  find a set of (overlapping) rectangles covering exactly the union
+  starting with the largest ones, rectangles are either skipped if already covered,
+  or combined with an accepted one if the bounding box is inside the union
+  or added
+  finally we remove rectangles that are covered by the others
+  :param rects: list of (x0,y0,x1,y1)
+  :param union: the union as non overlapping rectangles
+  '''
+  sizes=sorted(max(r[2]-r[0],r[3]-r[1]) for r in rects)
+  cellSize=sizes[len(sizes)//2]
+  unionIndex=GridIndex(cellSize)
+  for piece in union:
+    unionIndex.add(*piece,piece)
+  accepted=[]
+  acceptedIndex=GridIndex(cellSize)
+  def touching(r,grow=0):
+    #the index contains outdated entries for combined rectangles
+    rt=[]
+    dx=(r[2]-r[0])*grow
+    dy=(r[3]-r[1])*grow
+    for idx in sorted(set(acceptedIndex.query(r[0]-dx,r[1]-dy,r[2]+dx,r[3]+dy))):
+      if accepted[idx] is not None:
+        rt.append(idx)
+    return rt
+  for r in sorted(set(rects),key=_area,reverse=True):
+    candidates=touching(r)
+    if _isCovered(r,[accepted[idx] for idx in candidates]):
+      continue
+    combined=False
+    for idx in touching(r,1):
+      a=accepted[idx]
+      box=(min(a[0],r[0]),min(a[1],r[1]),max(a[2],r[2]),max(a[3],r[3]))
+      if _isCovered(box,unionIndex.query(*box),True):
+        accepted[idx]=box
+        acceptedIndex.add(*box,idx)
+        combined=True
+        break
+    if not combined:
+      acceptedIndex.add(*r,len(accepted))
+      accepted.append(r)
+  for idx in sorted(range(len(accepted)),key=lambda i: _area(accepted[i])):
+    r=accepted[idx]
+    others=[accepted[o] for o in touching(r) if o != idx]
+    if _isCovered(r,others):
+      accepted[idx]=None
+  return [r for r in accepted if r is not None]
+
+def _swap(rects):
+  return [(r[1],r[0],r[3],r[2]) for r in rects]
+
+def rectUnion(rects,tolerance=0.0,overlapping=True):
+  '''
+  get the union of rectangles as a small set of rectangles
+  coordinates closer then tolerance are snapped together, always extending
+  the rectangles, so the union covers at least the input
+  we sweep in both directions to get non overlapping rectangles,
+  if overlapping is allowed we also try to cover the union with combined input rectangles
+  and return the result with the least rectangles
+  :param rects: list of (swlat,swlng,nelat,nelng)
+  :param tolerance: max difference (degrees) of coordinates to be considered equal
+  :param overlapping: allow the resulting rectangles to overlap
+  :return: list of (swlat,swlng,nelat,nelng)
+  '''
+  lats=_snapCoordinates([r[0] for r in rects]+[r[2] for r in rects],tolerance)
+  lngs=_snapCoordinates([r[1] for r in rects]+[r[3] for r in rects],tolerance)
+  snapped=[]
+  for (swlat,swlng,nelat,nelng) in rects:
+    r=(lats[swlat][0],lngs[swlng][0],lats[nelat][1],lngs[nelng][1])
+    if r[0] < r[2] and r[1] < r[3]:
+      snapped.append(r)
+  if len(snapped) < 1:
+    return []
+  rt=_sweepUnion(snapped)
+  byLng=_swap(_sweepUnion(_swap(snapped)))
+  if len(byLng) < len(rt):
+    rt=byLng
+  if overlapping:
+    covering=_coverRects(snapped,rt)
+    if len(covering) < len(rt):
+      rt=covering
+  return rt
+
+class TileCounter(object):
+  '''
+  exact count of the tiles covered by a set of boxes
+  overlapping boxes at one zoom level are only counted once
+  '''
+  def __init__(self):
+    self.boxes={}
+
+  def add(self,box):
+    if box.zoom is None or box.zoom < 0:
+      return
+    if self.boxes.get(box.zoom) is None:
+      self.boxes[box.zoom]=[]
+    self.boxes[box.zoom].append((box.southwest.lat,box.southwest.lng,box.northeast.lat,box.northeast.lng))
+
+  def getZoomCount(self,zoom):
+    return unionArea(tileRanges(self.boxes.get(zoom,[]),zoom))
+
+  def getCount(self):
+    rt=0
+    for zoom in self.boxes.keys():
+      rt+=self.getZoomCount(zoom)
+    return rt
+
+class GridIndex(object):
+  '''
+  a simple uniform grid to find rectangles touching an area
+  rectangles that would span too many cells are kept in a separate list
+  that is checked on every query
+  '''
+  MAXCELLS=256
+  def __init__(self,cellSize=1.0):
+    self.cellSize=cellSize
+    self.cells={}
+    self.large=[]
+    self.rects=[]
+
+  def _cellRange(self,swlat,swlng,nelat,nelng):
+    cs=self.cellSize
+    return (math.floor(swlat/cs),math.floor(swlng/cs),math.floor(nelat/cs),math.floor(nelng/cs))
+
+  def add(self,swlat,swlng,nelat,nelng,value=None):
+    '''
+    add a rectangle
+    :param value: the value to be returned by queries, defaults to the insert position
+    :return: the insert position
+    '''
+    idx=len(self.rects)
+    self.rects.append((swlat,swlng,nelat,nelng,idx if value is None else value))
+    (y0,x0,y1,x1)=self._cellRange(swlat,swlng,nelat,nelng)
+    if y1 < y0 or x1 < x0 or (y1-y0+1)*(x1-x0+1) > self.MAXCELLS:
+      self.large.append(idx)
+      return idx
+    for y in range(y0,y1+1):
+      for x in range(x0,x1+1):
+        cell=self.cells.get((y,x))
+        if cell is None:
+          self.cells[(y,x)]=[idx]
+        else:
+          cell.append(idx)
+    return idx
+
+  def _candidates(self,swlat,swlng,nelat,nelng):
+    (y0,x0,y1,x1)=self._cellRange(swlat,swlng,nelat,nelng)
+    numCells=(y1-y0+1)*(x1-x0+1)
+    if numCells > len(self.rects):
+      return range(len(self.rects))
+    rt=set(self.large)
+    if numCells > len(self.cells):
+      for (y,x),cell in self.cells.items():
+        if y0 <= y <= y1 and x0 <= x <= x1:
+          rt.update(cell)
+      return rt
+    for y in range(y0,y1+1):
+      for x in range(x0,x1+1):
+        cell=self.cells.get((y,x))
+        if cell is not None:
+          rt.update(cell)
+    return rt
+
+  def query(self,swlat,swlng,nelat,nelng):
+    '''
+    get the values of all rectangles touching the area
+    (borders included)
+    :return: list of values in insert order
+    '''
+    rt=[]
+    for idx in sorted(self._candidates(swlat,swlng,nelat,nelng)):
+      (bswlat,bswlng,bnelat,bnelng,value)=self.rects[idx]
+      if bnelat < swlat or bnelng < swlng \
+          or bswlat > nelat or bswlng > nelng:
+        continue
+      rt.append(value)
+    return rt
+
+
+class BoxCatalog(LogEnabled):
+  '''
+  the content of a box file, kept in memory
+  the text file is compiled into a binary file with fixed size records
+  (zoom, swlat, swlng, nelat, nelng, line offset, line length)
+  followed by the original lines
+  the compiled file is memory mapped and filtered with numpy if available,
+  otherwise a spatial index per zoom level is built from the records
+  the catalog will be reloaded when the box file changes
+  catalogs are shared between all users of the same file
+  '''
+  _catalogs={}
+  _catalogLock=threading.Lock()
+  #directory to write compiled catalogs to, if None we only
+  #use a compiled file next to the box file or compile in memory
+  compiledDir=None
+  MINCELL=0.001
+  MAGIC=b'AVNBOX01'
+  SUFFIX='.bin'
+  HEADER=struct.Struct('<8sIqq') #magic,count,source size,source mtime_ns
+  RECORD=struct.Struct('<iddddII')
+  DTYPE=numpy.dtype([
+    ('zoom','<i4'),
+    ('swlat','<f8'),('swlng','<f8'),('nelat','<f8'),('nelng','<f8'),
+    ('offset','<u4'),('length','<u4')]) if numpy is not None else None
+
+  def __init__(self,fileName,logHandler=None):
+    super().__init__(logHandler)
+    self.fileName=fileName
+    self.lock=threading.Lock()
+    self.mtime=None
+    self.data=None
+
+  @classmethod
+  def getCatalog(cls,fileName,logHandler=None):
+    with cls._catalogLock:
+      rt=cls._catalogs.get(fileName)
+      if rt is None:
+        rt=BoxCatalog(fileName,logHandler)
+        cls._catalogs[fileName]=rt
+    rt.checkLoaded()
+    return rt
+
+  @classmethod
+  def compile(cls,sourceFile,outFile=None):
+    '''
+    compile a box file into the binary format
+    :param sourceFile: the box file
+    :param outFile: the file to write, if None just return the data
+    :return: the compiled data (bytes)
+    '''
+    st=os.stat(sourceFile)
+    records=[]
+    blob=io.BytesIO()
+    with open(sourceFile,'rb') as fh:
+      for bline in fh:
+        parts = re.split(b'  *', bline.rstrip())
+        if len(parts) != 6:
+          continue
+        try:
+          z=int(parts[1])
+          coords=[float(p) for p in parts[2:]]
+        except ValueError:
+          continue
+        records.append(cls.RECORD.pack(z,*coords,blob.tell(),len(bline)))
+        blob.write(bline)
+    data=cls.HEADER.pack(cls.MAGIC,len(records),st.st_size,st.st_mtime_ns)+\
+      b''.join(records)+blob.getvalue()
+    if outFile is not None:
+      tmpname=outFile+".tmp%d"%os.getpid()
+      try:
+        with open(tmpname,'wb') as oh:
+          oh.write(data)
+        os.replace(tmpname,outFile)
+      finally:
+        try:
+          os.unlink(tmpname)
+        except:
+          pass
+    return data
+
+  def _compiledNames(self):
+    rt=[self.fileName+self.SUFFIX]
+    if self.compiledDir is not None:
+      rt.insert(0,os.path.join(self.compiledDir,os.path.basename(self.fileName)+self.SUFFIX))
+    return rt
+
+  def _openCompiled(self,fileName,st):
+    '''
+    memory map a compiled file if it matches the box file
+    '''
+    try:
+      with open(fileName,'rb') as fh:
+        mm=mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    except (OSError,ValueError):
+      return None
+    if len(mm) < self.HEADER.size:
+      return None
+    (magic,count,size,mtime)=self.HEADER.unpack_from(mm)
+    if magic != self.MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+      return None
+    return mm
+
+  def checkLoaded(self):
+    '''
+    (re)load the file if it has changed
+    :return: True if loaded
+    '''
+    mtime=os.stat(self.fileName).st_mtime_ns
+    if mtime == self.mtime:
+      return False
+    with self.lock:
+      if mtime == self.mtime:
+        return False
+      self.data=self._load()
+      self.mtime=mtime
+    return True
+
+  def _load(self):
+    st=os.stat(self.fileName)
+    buffer=None
+    for name in self._compiledNames():
+      buffer=self._openCompiled(name,st)
+      if buffer is not None:
+        self.logDebug("using compiled boxes %s",name)
+        break
+    if buffer is None:
+      outFile=None
+      if self.compiledDir is not None:
+        outFile=self._compiledNames()[0]
+        self.logInfo("compiling %s to %s",self.fileName,outFile)
+      try:
+        buffer=self.compile(self.fileName,outFile)
+      except OSError as e:
+        self.logError("unable to write compiled boxes %s: %s",outFile,str(e))
+        buffer=self.compile(self.fileName)
+    count=self.HEADER.unpack_from(buffer)[1]
+    if numpy is not None:
+      rt=_NumpyCatalogData(buffer,count)
+    else:
+      rt=_IndexedCatalogData(buffer,count,self.MINCELL)
+    self.logInfo("loaded %d boxes from %s",count,self.fileName)
+    return rt
+
+  def query(self,nelat,nelng,swlat,swlng,minZoom,maxZoom):
+    '''
+    get the lines for all boxes touching the area
+    :return: the lines (bytes) in file order
+    '''
+    data=self.data
+    return data.lines(data.query(nelat,nelng,swlat,swlng,minZoom,maxZoom))
+
+  MAXLEVEL=16
+  def aggregate(self,nelat,nelng,swlat,swlng,minZoom,maxZoom,maxBoxes=None):
+    '''
+    get the lines for all boxes touching the area
+    if these are more then maxBoxes the boxes of each zoom level
+    are aggregated into clusters on a grid that is just coarse enough
+    (the clusters are only computed for the zoom levels and grids we try),
+    if even the coarsest grid gives too many we return one outline per zoom
+    cluster lines have the name CLUSTER_<number of boxes>
+    :return: the lines (bytes)
+    '''
+    data=self.data
+    indices=data.query(nelat,nelng,swlat,swlng,minZoom,maxZoom)
+    if maxBoxes is None or len(indices) <= maxBoxes:
+      return data.lines(indices)
+    zooms=[z for z in data.zooms((swlat,swlng,nelat,nelng)) if minZoom <= z <= maxZoom]
+    span=max(nelat-swlat,nelng-swlng,1e-6)
+    perAxis=max(1.0,math.sqrt(maxBoxes/len(zooms)))
+    level=max(0,min(self.MAXLEVEL,int(math.floor(math.log2(360.0*perAxis/span)))))
+    while True:
+      found=[]
+      for z in zooms:
+        for cluster in data.clusters(z,level).query(swlat,swlng,nelat,nelng):
+          found.append((z,)+cluster)
+      if len(found) <= maxBoxes or level == 0:
+        break
+      level-=1
+    if len(found) > maxBoxes:
+      outlines={}
+      for (z,count,cswlat,cswlng,cnelat,cnelng) in found:
+        outline=outlines.get(z)
+        if outline is None:
+          outlines[z]=(count,cswlat,cswlng,cnelat,cnelng)
+        else:
+          outlines[z]=(outline[0]+count,min(outline[1],cswlat),min(outline[2],cswlng),
+                       max(outline[3],cnelat),max(outline[4],cnelng))
+      found=[(z,)+outline for z,outline in outlines.items()]
+    self.logDebug("aggregated %d boxes into %d clusters, level %d",len(indices),len(found),level)
+    rt=[]
+    for (z,count,cswlat,cswlng,cnelat,cnelng) in found:
+      rt.append(b"CLUSTER_%d %d %f %f %f %f\n"%(count,z,cswlat,cswlng,cnelat,cnelng))
+    return rt
+
+  def records(self,minZoom=None,maxZoom=None,areas=None):
+    '''
+    get the boxes
+    :param areas: if set only return boxes touching one of these areas (swlat,swlng,nelat,nelng)
+    :return: list of tuples (name,zoom,swlat,swlng,nelat,nelng) in file order
+    '''
+    return self.data.records(minZoom,maxZoom,areas)
+
+  def zooms(self,area):
+    '''
+    get the zoom levels that have boxes touching an area
+    :param area: (swlat,swlng,nelat,nelng)
+    :return: list of zoom levels
+    '''
+    return self.data.zooms(area)
+
+
+class _CatalogData(object):
+  def __init__(self,buffer,count):
+    self.buffer=buffer
+    self.count=count
+    self.blobStart=BoxCatalog.HEADER.size+count*BoxCatalog.RECORD.size
+    self.clusterIndex={}
+    self.clusterCount={}
+    self.zoomCoordinates={}
+
+  def _line(self,offset,length):
+    start=self.blobStart+offset
+    return self.buffer[start:start+length]
+
+  def _name(self,offset,length):
+    return self._line(offset,length).split(b' ',1)[0].decode('utf-8',errors='replace')
+
+  def clusters(self,zoom,level):
+    '''
+    get the boxes of one zoom level aggregated into clusters
+    a cluster covers all boxes with their center in one cell of 360/2^level degrees
+    computed on first use and kept as long as the catalog data,
+    if the coarser level is already known and has the same number of clusters we share its index
+    :return: a GridIndex with values (count,swlat,swlng,nelat,nelng)
+    '''
+    key=(zoom,level)
+    rt=self.clusterIndex.get(key)
+    if rt is not None:
+      return rt
+    coordinates=self.zoomCoordinates.get(zoom)
+    if coordinates is None:
+      coordinates=[record[2:] for record in self.records(zoom,zoom)]
+      self.zoomCoordinates[zoom]=coordinates
+    coarser=self.clusterIndex.get((zoom,level-1))
+    cellSize=360.0/2**level
+    cells={}
+    for (swlat,swlng,nelat,nelng) in coordinates:
+      cell=(math.floor((swlat+nelat)/2/cellSize),math.floor((swlng+nelng)/2/cellSize))
+      cluster=cells.get(cell)
+      if cluster is None:
+        cells[cell]=[1,swlat,swlng,nelat,nelng]
+        continue
+      cluster[0]+=1
+      cluster[1]=min(cluster[1],swlat)
+      cluster[2]=min(cluster[2],swlng)
+      cluster[3]=max(cluster[3],nelat)
+      cluster[4]=max(cluster[4],nelng)
+    if coarser is not None and self.clusterCount[(zoom,level-1)] == len(cells):
+      #cells are nested in the cells of the coarser level - same number means same clusters
+      self.clusterCount[key]=len(cells)
+      self.clusterIndex[key]=coarser
+      return coarser
+    #at fine levels the clusters are larger then the grid cells
+    sizes=sorted(max(c[3]-c[1],c[4]-c[2]) for c in cells.values())
+    rt=GridIndex(max(cellSize,sizes[len(sizes)//2] if len(sizes) > 0 else 0))
+    for cluster in cells.values():
+      rt.add(*cluster[1:],tuple(cluster))
+    self.clusterCount[key]=len(cells)
+    self.clusterIndex[key]=rt
+    return rt
+
+
+class _NumpyCatalogData(_CatalogData):
+  def __init__(self,buffer,count):
+    super().__init__(buffer,count)
+    self.boxes=numpy.frombuffer(buffer,dtype=BoxCatalog.DTYPE,count=count,offset=BoxCatalog.HEADER.size)
+
+  def lines(self,indices):
+    selected=self.boxes[indices]
+    return [self._line(o,l) for o,l in zip(selected['offset'].tolist(),selected['length'].tolist())]
+
+  def query(self,nelat,nelng,swlat,swlng,minZoom,maxZoom):
+    b=self.boxes
+    mask=(b['zoom'] >= minZoom) & (b['zoom'] <= maxZoom) & \
+         (b['nelat'] >= swlat) & (b['nelng'] >= swlng) & \
+         (b['swlat'] <= nelat) & (b['swlng'] <= nelng)
+    return numpy.nonzero(mask)[0]
+
+  def zooms(self,area):
+    (swlat,swlng,nelat,nelng)=area
+    b=self.boxes
+    mask=(b['nelat'] >= swlat) & (b['nelng'] >= swlng) & \
+         (b['swlat'] <= nelat) & (b['swlng'] <= nelng)
+    return numpy.unique(b['zoom'][mask]).tolist()
+
+  def records(self,minZoom=None,maxZoom=None,areas=None):
+    b=self.boxes
+    if minZoom is not None or maxZoom is not None or areas is not None:
+      mask=numpy.ones(len(b),dtype=bool)
+      if minZoom is not None:
+        mask&=b['zoom'] >= minZoom
+      if maxZoom is not None:
+        mask&=b['zoom'] <= maxZoom
+      if areas is not None:
+        inArea=numpy.zeros(len(b),dtype=bool)
+        for (swlat,swlng,nelat,nelng) in areas:
+          inArea|=(b['nelat'] >= swlat) & (b['nelng'] >= swlng) & \
+                  (b['swlat'] <= nelat) & (b['swlng'] <= nelng)
+        mask&=inArea
+      b=b[mask]
+    rt=[]
+    for (z,swlat,swlng,nelat,nelng,offset,length) in b.tolist():
+      rt.append((self._name(offset,length),z,swlat,swlng,nelat,nelng))
+    return rt
+
+
+class _IndexedCatalogData(_CatalogData):
+  def __init__(self,buffer,count,minCell):
+    super().__init__(buffer,count)
+    self.boxes=list(BoxCatalog.RECORD.iter_unpack(
+      buffer[BoxCatalog.HEADER.size:self.blobStart]))
+    zoomBoxes={}
+    for idx,box in enumerate(self.boxes):
+      z=box[0]
+      if zoomBoxes.get(z) is None:
+        zoomBoxes[z]=[]
+      zoomBoxes[z].append(idx)
+    self.zoomIndex={}
+    for z,boxes in zoomBoxes.items():
+      #cells at roughly twice the typical box size for this zoom
+      sizes=sorted(max(self.boxes[i][3]-self.boxes[i][1],self.boxes[i][4]-self.boxes[i][2]) for i in boxes)
+      index=GridIndex(max(minCell,2*sizes[len(sizes)//2]))
+      for i in boxes:
+        index.add(*self.boxes[i][1:5],i)
+      self.zoomIndex[z]=index
+
+  def lines(self,indices):
+    rt=[]
+    for idx in indices:
+      box=self.boxes[idx]
+      rt.append(self._line(box[5],box[6]))
+    return rt
+
+  def query(self,nelat,nelng,swlat,swlng,minZoom,maxZoom):
+    found=[]
+    for z,index in self.zoomIndex.items():
+      if z < minZoom or z > maxZoom:
+        continue
+      found+=index.query(swlat,swlng,nelat,nelng)
+    found.sort()
+    return found
+
+  def zooms(self,area):
+    rt=[]
+    for z,index in self.zoomIndex.items():
+      if len(index.query(*area)) > 0:
+        rt.append(z)
+    return rt
+
+  def records(self,minZoom=None,maxZoom=None,areas=None):
+    boxes=self.boxes
+    if areas is not None:
+      found=set()
+      for z,index in self.zoomIndex.items():
+        if minZoom is not None and z < minZoom:
+          continue
+        if maxZoom is not None and z > maxZoom:
+          continue
+        for area in areas:
+          found.update(index.query(*area))
+      boxes=[self.boxes[i] for i in sorted(found)]
+    rt=[]
+    for (z,swlat,swlng,nelat,nelng,offset,length) in boxes:
+      if minZoom is not None and z < minZoom:
+        continue
+      if maxZoom is not None and z > maxZoom:
+        continue
+      rt.append((self._name(offset,length),z,swlat,swlng,nelat,nelng))
+    return rt
+
+
 class Boxes(LogEnabled):
   BOXES=os.path.join(os.path.dirname(__file__),'boxes','allcountries.bbox')
   ADDBOXES=os.path.join(os.path.dirname(__file__),'boxes','computed.bbox')
@@ -212,8 +1034,9 @@ class Boxes(LogEnabled):
     self.logHandler=logHandler
     self.merges=[]
     self.numTiles=0
+    self.counter=None
 
-  def getBoxes(self,nelat,nelng,swlat,swlng,minZoom=None,maxZoom=None):
+  def getBoxes(self,nelat,nelng,swlat,swlng,minZoom=None,maxZoom=None,maxBoxes=None):
     '''
     get boxes from the main file
     :param nelat:
@@ -222,9 +1045,9 @@ class Boxes(LogEnabled):
     :param swlng:
     :param minZoom:
     :param maxZoom:
+    :param maxBoxes: if set, aggregate boxes into clusters if there are more
     :return:
     '''
-    rt=[]
     if minZoom is None:
       minZoom=0
     else:
@@ -233,94 +1056,133 @@ class Boxes(LogEnabled):
       maxZoom=22
     else:
       maxZoom=int(maxZoom)
-    #we duplicate some code here as we want to be fast and do not create
-    #objects
-    #and we directly return the lines as this most probably is much faster
+    #we directly return the lines as this most probably is much faster
     #and we return them as bytes to avoid any encode/decode
-    with open(self.boxesFile,'rb') as fh:
-      for bline in fh:
-        parts = re.split(b'  *', bline.rstrip())
-        if len(parts) != 6:
-          continue
-        z=int(parts[1])
-        if z < minZoom or z > maxZoom:
-          continue
-        bnelat=float(parts[4])
-        bnelng=float(parts[5])
-        bswlat=float(parts[2])
-        bswlng=float(parts[3])
-        if bnelat < swlat or bnelng < swlng \
-            or bswlat > nelat or bswlng > nelng:
-          continue
-        rt.append(bline)
-    return rt
+    catalog=BoxCatalog.getCatalog(self.boxesFile,self.logHandler)
+    return catalog.aggregate(nelat,nelng,swlat,swlng,minZoom,maxZoom,maxBoxes)
+
+  def getVersion(self):
+    '''
+    get a version for the box file used in getBoxes
+    will change whenever the file changes
+    '''
+    return BoxCatalog.getCatalog(self.boxesFile,self.logHandler).mtime
+
+  MAX_QUANTIZE_ZOOM=22
+  @classmethod
+  def quantizeBounds(cls,nelat,nelng,swlat,swlng):
+    '''
+    extend the bounds to tile borders at a zoom level
+    where the area is covered by 2...3 tiles in each direction
+    this way we get the same bounds for slightly different areas
+    :return: (key,(nelat,nelng,swlat,swlng)) - key is a tuple (zoom,xmin,ymin,xmax,ymax)
+    '''
+    span=max(nelng-swlng,nelat-swlat)
+    if span <= 0:
+      zoom=cls.MAX_QUANTIZE_ZOOM
+    else:
+      zoom=max(0,min(cls.MAX_QUANTIZE_ZOOM,int(math.floor(math.log2(360.0/span)))+1))
+    maxTile=2**zoom-1
+    maxLat=85.0511
+    (xmin,ymax,z)=deg2num(max(-maxLat,min(maxLat,swlat)),swlng,zoom)
+    (xmax,ymin,z)=deg2num(max(-maxLat,min(maxLat,nelat)),nelng,zoom)
+    xmin=max(0,min(maxTile,xmin))
+    xmax=max(0,min(maxTile,xmax))
+    ymin=max(0,min(maxTile,ymin))
+    ymax=max(0,min(maxTile,ymax))
+    qnelat=num2deg(xmax+1,ymin,zoom)[0] if ymin > 0 else 90.0
+    qswlat=num2deg(xmin,ymax+1,zoom)[0] if ymax < maxTile else -90.0
+    qswlng=num2deg(xmin,ymax+1,zoom)[1] if xmin > 0 else -180.0
+    qnelng=num2deg(xmax+1,ymin,zoom)[1] if xmax < maxTile else 180.0
+    return ((zoom,xmin,ymin,xmax,ymax),(qnelat,qnelng,qswlat,qswlng))
+
+  def prepare(self):
+    '''
+    load the box catalogs in advance
+    :return:
+    '''
+    for boxesFile in [self.boxesFile,self.addBoxes]:
+      if boxesFile is not None:
+        BoxCatalog.getCatalog(boxesFile,self.logHandler)
   @classmethod
   def boxToLine(cls,box):
     return "%s %d %f %f %f %f"%(box.name,box.zoom,box.southwest.lat,box.southwest.lng,box.northeast.lat,box.northeast.lng)
   #line from boxes:
   #         z   s    w     n    e
   #1U319240 12 24.0 119.0 25.0 120.0
+  @classmethod
+  def _zoomIndex(cls,zoom):
+    #cells at about the typical size of chart boxes for this zoom
+    return GridIndex(min(90.0,2.0**(13-zoom)))
+
+  @classmethod
+  def _selectionIndex(cls,boxesList):
+    sizes=sorted(max(abs(b.northeast.lat-b.southwest.lat),abs(b.northeast.lng-b.southwest.lng))
+                 for b in boxesList)
+    cellSize=1.0
+    if len(sizes) > 0 and sizes[len(sizes)//2] > 0:
+      cellSize=sizes[len(sizes)//2]
+    rt=GridIndex(cellSize)
+    for box in boxesList:
+      rt.add(box.southwest.lat,box.southwest.lng,box.northeast.lat,box.northeast.lng,box)
+    return rt
+
   def mergeBoxes(self,boxesList=None,minZoom=0,maxZoom=20):
     rt=[]
     zoomLevelBoxes={}
-    numTiles=0
+    counter=TileCounter()
+    selectionIndex=None
+    areas=None
+    if boxesList is not None:
+      selectionIndex=self._selectionIndex(boxesList)
+      areas=[(b.southwest.lat,b.southwest.lng,b.northeast.lat,b.northeast.lng) for b in boxesList]
     for boxesFile in [self.boxesFile,self.addBoxes]:
       if boxesFile is None:
         continue
-      with open(boxesFile,"r") as fh:
-        for bline in fh:
-          parts=re.split('  *',bline.rstrip())
-          if len(parts) != 6:
-            self.logDebug("skipping invalid line %s",bline)
-          try:
-            chartBox=Box(LatLng(float(parts[4]),float(parts[5])),LatLng(float(parts[2]),float(parts[3])),int(parts[1]),name=parts[0])
-            if chartBox.zoom < minZoom or chartBox.zoom > maxZoom:
-              continue
-            if boxesList is None:
-              self.logDebug("adding %s", str(chartBox))
-              numTiles += chartBox.getNumTiles()
-              rt.append(chartBox)
+      catalog=BoxCatalog.getCatalog(boxesFile,self.logHandler)
+      for (name,zoom,swlat,swlng,nelat,nelng) in catalog.records(minZoom,maxZoom,areas):
+        chartBox=Box(LatLng(nelat,nelng),LatLng(swlat,swlng),zoom,name=name)
+        if boxesList is None:
+          self.logDebug("adding %s", str(chartBox))
+          counter.add(chartBox)
+          rt.append(chartBox)
+          continue
+        #first we intersect with all boxes we have and
+        #extend this íntersection
+        #at the end we intersect again with the box to ensure at most the complete box
+        #the index gives us all selection boxes touching the chart box (in list order)
+        intersection=None
+        for box in selectionIndex.query(swlat,swlng,nelat,nelng):
+          currentIntersect=chartBox.intersection(box)
+          if intersection is None:
+            intersection=currentIntersect
+          else:
+            intersection.extend(currentIntersect)
+        if intersection is not None:
+          result=chartBox.intersection(intersection)
+          if result is not None:
+            if result.zoom is None:
+              result.zoom=-1
+            if zoomLevelBoxes.get(result.zoom) is None:
+              zoomLevelBoxes[result.zoom]=self._zoomIndex(result.zoom)
+            alreadyContained=False
+            for other in zoomLevelBoxes[result.zoom].query(
+                result.southwest.lat,result.southwest.lng,result.northeast.lat,result.northeast.lng):
+              if other.contains(result):
+                alreadyContained=True
+                break
+            if alreadyContained:
               continue
-            #first we intersect with all boxes we have and
-            #extend this íntersection
-            #at the end we intersect again with the box to ensure at most the complete box
-            intersection=None
-            for box in boxesList:
-              currentIntersect=chartBox.intersection(box)
-              if intersection is None:
-                intersection=currentIntersect
-              else:
-                intersection.extend(currentIntersect)
-            if intersection is not None:
-              result=chartBox.intersection(intersection)
-              if result is not None:
-                if result.zoom is None:
-                  result.zoom=-1
-                if zoomLevelBoxes.get(result.zoom) is None:
-                  zoomLevelBoxes[result.zoom]=[]
-                #we assume that the boxes do not overlap at one level...
-                resultTiles=result.getNumTiles()
-                alreadyContained=False
-                for other in zoomLevelBoxes[result.zoom]:
-                  if other.contains(result):
-                    alreadyContained=True
-                    break
-                  intersect=other.intersection(result)
-                  if intersect is not None:
-                    resultTiles-=intersect.getNumTiles(True)
-                if alreadyContained:
-                  continue
-                if resultTiles < 0:
-                  resultTiles=0
-                self.logDebug("adding from %s: %s", str(chartBox), str(result))
-                zoomLevelBoxes[result.zoom].append(result)
-                rt.append(result)
-                numTiles +=resultTiles
-          except Exception as e:
-            self.logError("unable to parse %s:%s",bline,str(e))
+            self.logDebug("adding from %s: %s", str(chartBox), str(result))
+            zoomLevelBoxes[result.zoom].add(
+              result.southwest.lat,result.southwest.lng,result.northeast.lat,result.northeast.lng,result)
+            rt.append(result)
+            #overlapping boxes are handled by the counter
+            counter.add(result)
     self.merges=rt
-    self.numTiles=numTiles
-    return (rt,numTiles)
+    self.counter=counter
+    self.numTiles=counter.getCount()
+    return (rt,self.numTiles)
 
   def getParsed(self,merged=None):
     if merged is None:
@@ -368,6 +1230,8 @@ class SeedWriter(LogEnabled):
   def buildOutput(self, parsed, name, parameters):
     '''
     create a mobac seed file from parsed boundings
+    the boxes of each zoom level are compacted into a smaller set
+    of rectangles covering the same area
     :param parsed:
     :type parsed: Parser
     :param name: the name prefix for the seeds
@@ -384,11 +1248,13 @@ class SeedWriter(LogEnabled):
       bounds = parsed.getZoomBounds(z)
       entry['levels'] = [z]
       entry_coverages = []
-      for bound in bounds:
-        cvname = "%s_%03d_%s" % (name, z, bound.name)
+      rects = rectUnion([(b.southwest.lat, b.southwest.lng, b.northeast.lat, b.northeast.lng) for b in bounds])
+      self.logDebug("zoom %d: %d boxes compacted to %d coverages", z, len(bounds), len(rects))
+      for idx, (swlat, swlng, nelat, nelng) in enumerate(rects):
+        cvname = "%s_%03d_%05d" % (name, z, idx)
         coverage = {
           'srs': 'EPSG:4326',
-          'bbox': bound.getMpBounds()
+          'bbox': [swlng, swlat, nelng, nelat]
         }
         coverages[cvname] = coverage
         entry_coverages.append(cvname)
@@ -400,34 +1266,243 @@ class SeedWriter(LogEnabled):
     return out
 
 
-def createSeed(boundsFile,name,caches,seedFile=None,logger=None,reloadDays=None):
+class SeedPreflight(LogEnabled):
+  '''
+  check the tiles of a seed against existing mbtiles caches
+  and remove the regions that are already cached in all caches
+  the caches must store tiles with the usual x/y/z numbers (GLOBAL_WEBMERCATOR, origin nw)
+  tile ranges are split until they are completely cached, completely missing
+  or have less then MINTILES tiles
+  '''
+  MINTILES=64
+  COUNT="select count(*) from tiles where zoom_level=? and tile_column between ? and ? and tile_row between ? and ?"
+  TILES="select tile_column,tile_row from tiles where zoom_level=? and tile_column between ? and ? and tile_row between ? and ?"
+  def __init__(self,cacheFiles,logHandler=None):
+    super().__init__(logHandler)
+    self.cacheFiles=cacheFiles
+    #zoom -> (tiles, tiles to fetch)
+    self.zoomStats={}
+
+  def _missing(self,connections,zoom,tileRange,found):
+    '''
+    find the missing parts of a tile range
+    a tile is missing if at least one of the caches does not have it
+    :param found: list to append (tileRange,number of missing tiles) to
+    '''
+    (xmin,ymin,xmax,ymax)=tileRange
+    numTiles=(xmax-xmin+1)*(ymax-ymin+1)
+    counts=[con.execute(self.COUNT,(zoom,xmin,xmax,ymin,ymax)).fetchone()[0] for con in connections]
+    if min(counts) == numTiles:
+      return
+    if min(counts) == 0:
+      found.append((tileRange,numTiles))
+      return
+    if numTiles <= self.MINTILES:
+      if len(connections) == 1:
+        found.append((tileRange,numTiles-counts[0]))
+        return
+      cachedInAll=None
+      for con in connections:
+        tiles=set(con.execute(self.TILES,(zoom,xmin,xmax,ymin,ymax)).fetchall())
+        cachedInAll=tiles if cachedInAll is None else cachedInAll & tiles
+      found.append((tileRange,numTiles-len(cachedInAll)))
+      return
+    if xmax-xmin >= ymax-ymin:
+      middle=(xmin+xmax)//2
+      self._missing(connections,zoom,(xmin,ymin,middle,ymax),found)
+      self._missing(connections,zoom,(middle+1,ymin,xmax,ymax),found)
+    else:
+      middle=(ymin+ymax)//2
+      self._missing(connections,zoom,(xmin,ymin,xmax,middle),found)
+      self._missing(connections,zoom,(xmin,middle+1,xmax,ymax),found)
+
+  @classmethod
+  def _tileBbox(cls,tileRange,zoom):
+    '''
+    get a bbox for the coverage of a tile range
+    slightly shrinked to avoid touching the neighbour tiles
+    :return: [swlng,swlat,nelng,nelat]
+    '''
+    (xmin,ymin,xmax,ymax)=tileRange
+    (nelat,swlng)=num2deg(xmin,ymin,zoom)
+    (swlat,nelng)=num2deg(xmax+1,ymax+1,zoom)
+    dlng=(nelng-swlng)/(xmax-xmin+1)/1000
+    dlat=(nelat-swlat)/(ymax-ymin+1)/1000
+    return [swlng+dlng,swlat+dlat,nelng-dlng,nelat-dlat]
+
+  def run(self,seeds):
+    '''
+    remove the cached regions from a seed
+    :param seeds: the seed definition as created by SeedWriter.buildOutput, will be modified
+    :return: (tiles to fetch, tiles already cached)
+    '''
+    connections=[]
+    try:
+      for cacheFile in self.cacheFiles:
+        connections.append(sqlite3.connect("file:%s?mode=ro"%urllib.request.pathname2url(cacheFile),uri=True))
+      coverages=seeds['coverages']
+      newCoverages={}
+      toFetch=0
+      cached=0
+      for sname in list(seeds['seeds'].keys()):
+        seed=seeds['seeds'][sname]
+        zoom=seed['levels'][0]
+        rects=[]
+        for cvname in seed['coverages']:
+          (swlng,swlat,nelng,nelat)=coverages[cvname]['bbox']
+          rects.append((swlat,swlng,nelat,nelng))
+        #non overlapping tile ranges, upper borders exclusive
+        ranges=_sweepUnion([(r[0],r[1],r[2]+1,r[3]+1) for r in tileRanges(rects,zoom)])
+        missing=[]
+        numTiles=0
+        for r in ranges:
+          numTiles+=(r[2]-r[0])*(r[3]-r[1])
+          self._missing(connections,zoom,(r[0],r[1],r[2]-1,r[3]-1),missing)
+        numMissing=sum(m for (r,m) in missing)
+        toFetch+=numMissing
+        cached+=numTiles-numMissing
+        self.zoomStats[zoom]=(numTiles,numMissing)
+        self.logDebug("seed %s: %d tiles, %d to fetch",sname,numTiles,numMissing)
+        if len(missing) < 1:
+          del seeds['seeds'][sname]
+          continue
+        seed['coverages']=[]
+        compacted=rectUnion([(r[0],r[1],r[2]+1,r[3]+1) for (r,m) in missing])
+        for idx,r in enumerate(compacted):
+          cvname="%s_%05d"%(sname,idx)
+          newCoverages[cvname]={
+            'srs':'EPSG:4326',
+            'bbox':self._tileBbox((r[0],r[1],r[2]-1,r[3]-1),zoom)
+          }
+          seed['coverages'].append(cvname)
+      seeds['coverages']=newCoverages
+      self.logInfo("preflight: %d tiles to fetch, %d already cached",toFetch,cached)
+      return (toFetch,cached)
+    finally:
+      for con in connections:
+        con.close()
+
+
+def averageTileSizes(cacheFile,zooms,sampleSize=1000):
+  '''
+  get the average size of the tiles in a mbtiles file
+  we only look at the first sampleSize tiles of each zoom level
+  :return: dict zoom -> bytes for the zoom levels that have tiles
+  '''
+  rt={}
+  con=sqlite3.connect("file:%s?mode=ro"%urllib.request.pathname2url(cacheFile),uri=True)
+  try:
+    for zoom in zooms:
+      row=con.execute("select avg(l) from (select length(tile_data) as l from tiles where zoom_level=? limit ?)",
+                      (zoom,sampleSize)).fetchone()
+      if row is not None and row[0] is not None:
+        rt[zoom]=row[0]
+  finally:
+    con.close()
+  return rt
+
+def buildSeed(boxesList,name,caches,logger=None,reloadDays=None):
+  '''
+  create the seed definition for a list of boxes
+  :return: (merger,seeds) - the merger (Boxes) has the tile counts
+  '''
   merger = Boxes(logHandler=logger,additionalBoxes=True)
-  with open(boundsFile, 'r') as h:
-    blist = yaml.safe_load(h)
-  boxesList = []
-  for b in blist:
-    boxesList.append(Box.fromDict(b))
-  res = merger.mergeBoxes(boxesList)
+  merger.mergeBoxes(boxesList)
   writer = SeedWriter(logger)
   param={'caches': caches}
   if reloadDays is not None:
     param['refresh_before']={'days':int(reloadDays)}
   seeds = writer.buildOutput(merger.getParsed(), name, param)
+  return (merger,seeds)
+
+def createSeed(boundsFile,name,caches,seedFile=None,logger=None,reloadDays=None):
+  with open(boundsFile, 'r') as h:
+    blist = yaml.safe_load(h)
+  boxesList = []
+  for b in blist:
+    boxesList.append(Box.fromDict(b))
+  (merger,seeds) = buildSeed(boxesList,name,caches,logger=logger,reloadDays=reloadDays)
   if seedFile is not None:
-    writer.write(seedFile, seeds)
+    SeedWriter(logger).write(seedFile, seeds)
   return (merger.numTiles,seeds)
 
+class TileCountCache(LogEnabled):
+  '''
+  memoized tile counts for selections
+  the selection boxes are rounded and sorted to get a canonical key
+  counts are cached for the complete selection and per zoom level,
+  keyed by the selection boxes that touch any chart box at this level
+  so adding or removing one box only recomputes the levels it affects
+  all keys include the versions of the box files
+  '''
+  PRECISION=6
+  def __init__(self,maxEntries=5000,logHandler=None):
+    super().__init__(logHandler)
+    self.cache=lrucache.LRUCache(maxEntries=maxEntries)
+
+  @classmethod
+  def normalize(cls,boxesList):
+    areas=set()
+    for box in boxesList:
+      areas.add((
+        round(box.southwest.lat,cls.PRECISION),
+        round(box.southwest.lng,cls.PRECISION),
+        round(box.northeast.lat,cls.PRECISION),
+        round(box.northeast.lng,cls.PRECISION)))
+    return tuple(sorted(areas))
+
+  def count(self,boxesList,minZoom=0,maxZoom=20,logHandler=None):
+    '''
+    :param logHandler: the logger for this call, defaults to our own one
+    '''
+    if logHandler is None:
+      logHandler=self.logHandler
+    template=Boxes(additionalBoxes=True)
+    catalogs=[]
+    for boxesFile in [template.boxesFile,template.addBoxes]:
+      if boxesFile is not None:
+        catalogs.append(BoxCatalog.getCatalog(boxesFile,logHandler))
+    version=tuple((c.fileName,c.mtime) for c in catalogs)
+    areas=self.normalize(boxesList)
+    rt=self.cache.get((version,minZoom,maxZoom,areas))
+    if rt is not None:
+      return rt
+    zoomAreas={}
+    for area in areas:
+      zooms=set()
+      for catalog in catalogs:
+        zooms.update(catalog.zooms(area))
+      for z in zooms:
+        if z < minZoom or z > maxZoom:
+          continue
+        if zoomAreas.get(z) is None:
+          zoomAreas[z]=[]
+        zoomAreas[z].append(area)
+    rt=0
+    for z,zareas in zoomAreas.items():
+      key=(version,z,tuple(zareas))
+      count=self.cache.get(key)
+      if count is None:
+        merger=Boxes(template.boxesFile,template.addBoxes,logHandler=logHandler)
+        merger.mergeBoxes([Box(LatLng(a[2],a[3]),LatLng(a[0],a[1])) for a in zareas],minZoom=z,maxZoom=z)
+        count=merger.numTiles
+        self.cache.put(key,count)
+      rt+=count
+    self.cache.put((version,minZoom,maxZoom,areas),rt)
+    return rt
+
+tileCountCache=TileCountCache()
+
 def countTiles(bounds,logger=None):
-  merger = Boxes(logHandler=logger,additionalBoxes=True)
   boxesList = []
   for b in bounds:
     boxesList.append(Box.fromDict(b))
-  merger.mergeBoxes(boxesList)
-  return merger.numTiles
+  return tileCountCache.count(boxesList,logHandler=logger)
 
 if __name__ == '__main__':
   def usage():
     print("usage: %s infile outfile name caches"%sys.argv[0],file=sys.stderr)
+    print("       %s -c boxfile compiledfile"%sys.argv[0],file=sys.stderr)
   class Log(object):
     def log(self,fmt,*args):
       print("I:%s"%(fmt%(args)))
@@ -436,6 +1511,9 @@ if __name__ == '__main__':
     def error(self,fmt,*args):
       print("E:%s"%(fmt%(args)))
 
+  if len(sys.argv) == 4 and sys.argv[1] == '-c':
+    BoxCatalog.compile(sys.argv[2],sys.argv[3])
+    sys.exit(0)
   if len(sys.argv) != 5:
     usage()
     sys.exit(1)
@@ -124,8 +124,17 @@ import {
         )
         .then((res)=>{
             showHideOverlay('spinnerOverlay',false);
-            if (res.numTiles !== undefined){
-                showToast("seed started with "+res.numTiles+" tiles");
+            let action=res.queued?"seed queued":"seed started";
+            if (res.fetchTiles !== undefined){
+                if (res.fetchTiles > 0) {
+                    showToast(action+" with " + res.fetchTiles + " tiles, " + res.cachedTiles + " already cached");
+                }
+                else{
+                    showToast("all "+res.numTiles+" tiles already cached");
+                }
+            }
+            else if (res.numTiles !== undefined){
+                showToast(action+" with "+res.numTiles+" tiles");
             }
         })
         .catch((e)=>{
@@ -207,22 +216,58 @@ import {
             })
             .catch((e)=>showError(e));
     }
+    let formatProgress=(progress)=>{
+        if (! progress) return "";
+        let rt="z"+progress.zoom+" "+progress.tiles;
+        if (progress.total) rt+="/"+progress.total;
+        rt+=" tiles";
+        if (progress.tilesPerSecond) rt+=", "+progress.tilesPerSecond.toFixed(1)+" tiles/s";
+        if (progress.bytes) rt+=", "+(progress.bytes/1024/1024).toFixed(1)+" MB";
+        if (progress.eta !== null && progress.eta !== undefined){
+            let eta=progress.eta;
+            rt+=", ETA "+Math.floor(eta/3600)+"h"+String(Math.floor((eta%3600)/60)).padStart(2,'0')+"m";
+        }
+        return rt;
+    }
     let stopSeed=()=>{
         apiRequest(base,'killSeed')
             .then(()=>{})
             .catch((e)=>showError(e));
     }
-    let showLog=()=>{
-        fetch(base+"/api/getLog").then((resp)=>resp.text())
-            .then((txt)=>{
+    let logState={name:undefined,offset:undefined,generation:0};
+    let logVisible=()=>{
+        let ovl=document.getElementById('logOverlay');
+        return ovl && ovl.style.visibility === 'unset';
+    }
+    let pollLog=(generation)=>{
+        let url='readLog';
+        if (logState.offset !== undefined){
+            url+="?offset="+encodeURIComponent(logState.offset)+"&wait=10"+
+                "&name="+encodeURIComponent(logState.name);
+        }
+        apiRequest(base,url)
+            .then((res)=>{
+                if (generation !== logState.generation) return;
                 let logel=document.querySelector('#logOverlay .overlayContent');
                 if (! logel) return;
-                logel.textContent=txt;
-                logel.scrollTop=logel.scrollHeight;
-                showHideOverlay('logOverlay',true)
+                let first=logState.offset === undefined;
+                if (first) logel.textContent='';
+                logState.name=res.name;
+                logState.offset=res.next;
+                if (res.data){
+                    logel.textContent+=res.data;
+                    logel.scrollTop=logel.scrollHeight;
+                }
+                if (first) showHideOverlay('logOverlay',true);
+                if (res.running && logVisible()) pollLog(generation);
             })
             .catch((e)=>showError(e))
     }
+    let showLog=()=>{
+        logState.generation++;
+        logState.offset=undefined;
+        pollLog(logState.generation);
+    }
     let editConfig=(name)=>{
         editedConfig=name;
         apiRequest(base,'editLayer?name='+encodeURIComponent(name))
@@ -523,8 +568,7 @@ import {
                         "sequence "+parseInt(data.sequence):'');
                     setTextContent('.proxyError',mapproxy.lastError);
 
-                    buttonEnable('startSeed',seedStatus !== 'running' && canSave
-                        && ! seed.paused && data.networkAvailable);
+                    buttonEnable('startSeed',canSave && data.networkAvailable);
                     buttonEnable('killSeed',seedStatus === 'running' || seed.paused);
                     buttonEnable('showLog',seed.logFile);
                     buttonEnable('downloadSelection',canSave);
@@ -539,7 +583,9 @@ import {
                     let name=seed.name||'';
                     if (name instanceof Array) name=name.join(',');
                     name=(seed.selection||'')+' '+name;
-                    setTextContent('.seedInfo',name+" "+(data.seed || {}).info)
+                    let queued=(seed.queue||[]).length;
+                    setTextContent('.seedInfo',name+" "+(data.seed || {}).info+
+                        (queued?" ("+queued+" queued)":"")+" "+formatProgress(seed.progress))
                     forEachEl('#stopSeed',(el)=>{
                         el.style.display=(seedStatus === 'running')?'inline-block':'none'
                     })
@@ -368,6 +368,26 @@ export default class SeedMap{
             .catch((e)=>showError(e));
     }
 
+    /**
+     * extend the bounds to tile borders at a zoom level where they are covered by
+     * 2...3 tiles in each direction - so we request the same url
+     * for slightly different views and the browser can use its cache
+     * @param bounds
+     * @returns {L.LatLngBounds}
+     */
+    quantizeBounds(bounds){
+        let ne=bounds.getNorthEast();
+        let sw=bounds.getSouthWest();
+        let span=Math.max(ne.lng-sw.lng,ne.lat-sw.lat);
+        let qz=22;
+        if (span > 0) qz=Math.max(0,Math.min(22,Math.floor(Math.log2(360/span))+1));
+        let nw=this.map.project(L.latLng(ne.lat,sw.lng),qz).divideBy(256).floor();
+        let se=this.map.project(L.latLng(sw.lat,ne.lng),qz).divideBy(256).floor().add([1,1]);
+        return L.latLngBounds(
+            this.map.unproject(se.multiplyBy(256),qz),
+            this.map.unproject(nw.multiplyBy(256),qz));
+    }
+
     getBoxes(){
         if (! this.showBoxes){
             this.boxesLayer.clearLayers();
@@ -382,7 +402,7 @@ export default class SeedMap{
                 this.getBoxes();
                 return;
             }
-            let bound = this.map.getBounds();
+            let bound = this.quantizeBounds(this.map.getBounds());
             let url = this.apiBase + "/api/getBoxes?nelat=" + encodeURIComponent(bound.getNorthEast().lat) +
                 "&nelng=" + encodeURIComponent(bound.getNorthEast().lng) +
                 "&swlat=" + encodeURIComponent(bound.getSouthWest().lat) +
@@ -22,9 +22,18 @@
 
 import importlib.util
 import os
+import struct
 import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
 
 import yaml
+try:
+  import fcntl
+except ImportError:
+  fcntl=None
 
 
 def loadModuleFromFile(fileName,namePrefix=None):
@@ -43,9 +52,84 @@ def loadModuleFromFile(fileName,namePrefix=None):
 class InjectorException(Exception):
   pass
 
+class RateLimiter(object):
+  '''
+  token bucket per upstream host
+  the bucket state is kept in a small file per host that is locked
+  while updating it - so all processes (the proxy and the seed workers)
+  share the same bucket
+  '''
+  STATE=struct.Struct('<dd') #tokens, timestamp
+  DEFAULT_DIR='avnav-mapproxy-ratelimit'
+  def __init__(self,stateDir=None):
+    '''
+    :param stateDir: the directory for the bucket files, all processes
+                     that share a limit must use the same one,
+                     defaults to a directory of the user in the temp dir
+    '''
+    if stateDir is None:
+      stateDir=os.path.join(tempfile.gettempdir(),"%s-%s"%(self.DEFAULT_DIR,getattr(os,'getuid',lambda: 'user')()))
+    self.stateDir=stateDir
+    self.lock=threading.Lock()
+
+  def _stateFile(self,host):
+    safeHost="".join(c if c.isalnum() or c in '.-' else '_' for c in host)
+    return os.path.join(self.stateDir,safeHost+".bucket")
+
+  def _reserve(self,host,rate,burst):
+    '''
+    take one token from the bucket of host
+    :return: the time (s) to wait before the request may be sent
+    '''
+    os.makedirs(self.stateDir,mode=0o700,exist_ok=True)
+    with self.lock:
+      fd=os.open(self._stateFile(host),os.O_RDWR|os.O_CREAT,0o600)
+      try:
+        if fcntl is not None:
+          fcntl.lockf(fd,fcntl.LOCK_EX)
+        now=time.time()
+        data=os.pread(fd,self.STATE.size,0)
+        if len(data) == self.STATE.size:
+          (tokens,last)=self.STATE.unpack(data)
+          tokens=min(burst,tokens+max(0,now-last)*rate)
+        else:
+          tokens=burst
+        #a negative value reserves tokens for requests that are already waiting
+        tokens-=1
+        os.pwrite(fd,self.STATE.pack(tokens,now),0)
+      finally:
+        os.close(fd)
+    if tokens >= 0:
+      return 0
+    return -tokens/rate
+
+  def acquire(self,url,rate,burst=None):
+    '''
+    wait until a request to the host of url is allowed
+    :param url: the request url
+    :param rate: allowed requests per second for the host
+    :param burst: max number of requests that can be sent without waiting
+    '''
+    host=urlparse(url).hostname
+    if host is None or rate is None or rate <= 0:
+      return
+    if burst is None or burst < 1:
+      burst=max(1,rate)
+    waitTime=self._reserve(host,rate,burst)
+    if waitTime > 0:
+      time.sleep(waitTime)
+
 class Injector(object):
-  def __init__(self,configDirs):
+  def __init__(self,configDirs,rateLimiter=None,byteCounter=None,logger=None):
+    '''
+    :param byteCounter: a multiprocessing.Value that will be incremented
+                        by the size of each response (if known)
+    :param logger: used for config warnings, without one they are printed
+    '''
     self.configDirs=configDirs
+    self.logger=logger
+    self.rateLimiter=rateLimiter if rateLimiter is not None else RateLimiter()
+    self.byteCounter=byteCounter
     self.originalHttpClient=None
     self.creationException=None
     try:
@@ -79,19 +163,42 @@ class Injector(object):
     if not 'sources' in config:
       return
     for name,src in config['sources'].items():
-      if src.get('plugin') is not None:
+      if src.get('plugin') is not None or src.get('rate_limit') is not None:
         if self.originalHttpClient is None:
           if self.creationException:
             raise InjectorException("unable to inject plugin for %s, not initialized: %s"%
                                     (name,str(self.creationException)))
           raise InjectorException("unable to inject plugin for %s ,injector not initialized"%name)
 
-  def _createOpenWarpper(self,source,httpClient):
-    originalOpen = httpClient.open
-    client=httpClient
-    plugin=source.conf.get('plugin')
-    if plugin is None:
+  def _logWarning(self,fmt,*args):
+    if self.logger is not None:
+      self.logger.log(fmt,*args)
+    else:
+      print(fmt%args)
+
+  def _getFloat(self,source,name):
+    '''
+    get a numeric value from the source config
+    :return: the value or None if not set or invalid
+    '''
+    value=source.conf.get(name)
+    if value is None:
+      return None
+    try:
+      return float(value)
+    except (ValueError,TypeError):
+      self._logWarning("ignoring invalid %s %s for source %s",name,str(value),source.conf.get('name'))
+      return None
+
+  def _countBytes(self,response):
+    try:
+      length=int(response.headers.get('Content-Length'))
+    except Exception:
       return
+    with self.byteCounter.get_lock():
+      self.byteCounter.value+=length
+
+  def _loadPlugin(self,plugin):
     found=None
     if not os.path.isabs(plugin):
       for dir in self.configDirs:
@@ -111,6 +218,20 @@ class Injector(object):
       checkResponse=pluginModule.checkResponse
     if checkResponse is None and prepareMethod is None:
       raise InjectorException("either prepareRequest or checkResponse must be defined in %s"%plugin)
+    return (prepareMethod,checkResponse)
+
+  def _createOpenWarpper(self,source,httpClient):
+    originalOpen = httpClient.open
+    client=httpClient
+    plugin=source.conf.get('plugin')
+    rateLimit=self._getFloat(source,'rate_limit')
+    if plugin is None and rateLimit is None and self.byteCounter is None:
+      return
+    prepareMethod=None
+    checkResponse=None
+    if plugin is not None:
+      (prepareMethod,checkResponse)=self._loadPlugin(plugin)
+    rateBurst=self._getFloat(source,'rate_burst')
     #convert header_list to dict to make it modifyable
     headers={}
     if type(client.header_list) is list:
@@ -127,7 +248,11 @@ class Injector(object):
         else:
           url=args[0]
         client.header_list = headers.items()
+        if rateLimit is not None:
+          self.rateLimiter.acquire(url,rateLimit,rateBurst)
         rt = originalOpen(url, **kwargs)
+        if self.byteCounter is not None:
+          self._countBytes(rt)
         if checkResponse is not None:
           rs=checkResponse(rt,url)
           if rs is None:
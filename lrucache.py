@@ -0,0 +1,104 @@
+###############################################################################
+# Copyright (c) 2021, Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+  '''
+  a thread safe LRU cache
+  the size can be limited by the number of entries and/or by the
+  sum of the entry sizes (computed by sizeFunction)
+  '''
+  def __init__(self,maxEntries=None,maxSize=None,sizeFunction=None):
+    self.maxEntries=maxEntries
+    self.maxSize=maxSize
+    self.sizeFunction=sizeFunction if sizeFunction is not None else len
+    self.entries=OrderedDict()
+    self.size=0
+    self.hits=0
+    self.misses=0
+    self.lock=threading.Lock()
+
+  def _entrySize(self,value):
+    if self.maxSize is None:
+      return 0
+    return self.sizeFunction(value)
+
+  def get(self,key,default=None):
+    with self.lock:
+      entry=self.entries.get(key)
+      if entry is None:
+        self.misses+=1
+        return default
+      self.entries.move_to_end(key)
+      self.hits+=1
+      return entry[0]
+
+  def put(self,key,value):
+    '''
+    add an entry
+    :return: False if the entry is too large to be cached
+    '''
+    size=self._entrySize(value)
+    if self.maxSize is not None and size > self.maxSize:
+      return False
+    with self.lock:
+      old=self.entries.pop(key,None)
+      if old is not None:
+        self.size-=old[1]
+      self.entries[key]=(value,size)
+      self.size+=size
+      while len(self.entries) > 0:
+        if self.maxEntries is not None and len(self.entries) > self.maxEntries:
+          pass
+        elif self.maxSize is not None and self.size > self.maxSize:
+          pass
+        else:
+          break
+        (k,removed)=self.entries.popitem(last=False)
+        self.size-=removed[1]
+    return True
+
+  def remove(self,key):
+    with self.lock:
+      old=self.entries.pop(key,None)
+      if old is not None:
+        self.size-=old[1]
+        return True
+    return False
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size=0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def getStatus(self):
+    return {
+      'entries':len(self.entries),
+      'size':self.size,
+      'hits':self.hits,
+      'misses':self.misses
+    }
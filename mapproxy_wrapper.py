@@ -23,7 +23,9 @@ import importlib.util
 import io
 import logging
 import os
+import re
 import sys
+import threading
 import traceback
 import urllib.parse
 from wsgiref.headers import Headers
@@ -43,6 +45,8 @@ def loadModuleFromFile(fileName):
   return module
 
 injector=loadModuleFromFile('injector.py')
+lrucache=loadModuleFromFile('lrucache.py')
+tilereader=loadModuleFromFile('tilereader.py')
 
 class OwnWsgiHeaders(Headers):
 
@@ -120,7 +124,17 @@ def layerDictToList(d):
   return rt
 class MapProxyWrapper(object):
   LOGGERS=['mapproxy']
-  def __init__(self,prefix,configFile,configDirs,logger,loglevel=logging.NOTSET):
+  XYZ_SRS=['EPSG:3857','EPSG:900913','EPSG:102100','EPSG:102113']
+  TILE_PATH=re.compile(r'^/tiles/1\.0\.0/([^/]+)/([^/]+)/([0-9]+)/([0-9]+)/([0-9]+)\.([a-zA-Z]+)$')
+  TILE_CACHE_SIZE=16*1024*1024
+  TILE_ENTRY_OVERHEAD=200
+  TILE_INFO_ENTRIES=20000
+  CONDITIONAL_HEADERS=['HTTP_IF_NONE_MATCH','HTTP_IF_MODIFIED_SINCE']
+  def __init__(self,prefix,configFile,configDirs,logger,loglevel=logging.NOTSET,tileCacheSize=TILE_CACHE_SIZE,
+               rateLimitDir=None):
+    '''
+    :param rateLimitDir: the directory for the rate limit state shared with the seeds
+    '''
     self.prefix=prefix
     self.configFile=configFile
     self.normalConfig=configFile+".normal"
@@ -131,12 +145,121 @@ class MapProxyWrapper(object):
       mplogger.setLevel(logging.INFO) #TODO: debug
       mplogger.addHandler(self.handler)
     self.mapproxy = None
+    #(app,tileLayers,generation) - replaced as a whole when a new app is created
+    #or the tile caches are cleared, requests read it once at their start
+    #tileLayers: (layer,grid) -> cache and mbtiles file info of the tile layers
+    #generation: counts the clears, tiles are only put into the caches
+    #if the generation did not change while they were fetched
+    self.proxy=(None,{},0)
+    self.proxyLock=threading.Lock()
+    self.createLock=threading.Lock()
     self.logger=logger
     self.fatalError=None
     self.configTimeStamp = None
     self.layerMappings={}
-    self.injector=injector.Injector(configDirs)
+    self.injector=injector.Injector(configDirs,rateLimiter=injector.RateLimiter(rateLimitDir),logger=logger)
     self.configDirs=configDirs
+    #encoded tile responses: (layer,grid,z,x,y,ext) -> (status,headers,body)
+    self.tileCache=lrucache.LRUCache(maxSize=tileCacheSize,
+                                     sizeFunction=lambda e: len(e[2])+self.TILE_ENTRY_OVERHEAD)
+    #headers of tiles sent with 200 (incl. ETag) to answer conditional requests
+    #without reading the tile: (layer,grid,z,x,y,ext) -> headers
+    self.tileInfoCache=lrucache.LRUCache(maxEntries=self.TILE_INFO_ENTRIES)
+    self.mbtilesReader=tilereader.MbtilesReader()
+
+  @classmethod
+  def _isXyzGrid(cls,cfg,grids):
+    '''
+    check if a cache has exactly one grid that is the GLOBAL_WEBMERCATOR grid
+    with origin nw - i.e. the tiles are stored with the usual x/y/z numbers
+    '''
+    if not isinstance(grids,list) or len(grids) != 1:
+      return False
+    name=grids[0]
+    gridDefs=cfg.get('grids') or {}
+    seen=set()
+    while name != 'GLOBAL_WEBMERCATOR':
+      if name in seen:
+        return False
+      seen.add(name)
+      grid=gridDefs.get(name)
+      if not isinstance(grid,dict):
+        return False
+      for k,v in grid.items():
+        if k == 'base':
+          continue
+        if k == 'srs' and v in cls.XYZ_SRS:
+          continue
+        if k == 'origin' and v in ['nw','ul']:
+          continue
+        return False
+      name=grid.get('base')
+      if name is None:
+        return False
+    return True
+
+  def _getSeedConcurrency(self,cfg,cacheName,seen=None):
+    '''
+    get the seed_concurrency configured at the sources of a cache
+    (following caches that use other caches as source)
+    :return: the smallest value found or None if no source has one
+    '''
+    if seen is None:
+      seen=set()
+    if cacheName in seen:
+      return None
+    seen.add(cacheName)
+    caches=cfg.get('caches') or {}
+    sources=cfg.get('sources') or {}
+    cache=caches.get(cacheName)
+    if not isinstance(cache,dict) or not isinstance(cache.get('sources'),list):
+      return None
+    rt=None
+    for name in cache.get('sources'):
+      name=str(name).split(':')[0]
+      if name in caches:
+        concurrency=self._getSeedConcurrency(cfg,name,seen)
+      else:
+        source=sources.get(name)
+        concurrency=source.get('seed_concurrency') if isinstance(source,dict) else None
+        if concurrency is not None:
+          try:
+            concurrency=int(concurrency)
+          except (ValueError,TypeError):
+            self.logger.log("ignoring invalid seed_concurrency %s for source %s",str(concurrency),name)
+            concurrency=None
+      if concurrency is None:
+        continue
+      if rt is None or concurrency < rt:
+        rt=concurrency
+    return rt
+
+  @classmethod
+  def _hasErrorHandler(cls,cfg,cacheName,seen=None):
+    '''
+    check if a source of a cache (following caches that use other caches as source)
+    has an on_error handler - i.e. the cache can get tiles that are no real tiles
+    '''
+    if seen is None:
+      seen=set()
+    if cacheName in seen:
+      return False
+    seen.add(cacheName)
+    caches=cfg.get('caches') or {}
+    sources=cfg.get('sources') or {}
+    cache=caches.get(cacheName)
+    if not isinstance(cache,dict) or not isinstance(cache.get('sources'),list):
+      return False
+    for name in cache.get('sources'):
+      name=str(name).split(':')[0]
+      if name in caches:
+        if cls._hasErrorHandler(cfg,name,seen):
+          return True
+        continue
+      source=sources.get(name)
+      if isinstance(source,dict) and source.get('on_error'):
+        return True
+    return False
 
   def _mergeCfg(self,current,base,isFirstLevel=False):
     if not isinstance(base,dict):
@@ -246,6 +369,10 @@ class MapProxyWrapper(object):
             centry['name']=s
             cachecfg=centry.get('cache',{})
             centry['hasBefore']=cachecfg.get('type') in ['sqlite','files']
+            centry['xyzGrid']=self._isXyzGrid(cfg,centry.get('grids'))
+            centry['seedConcurrency']=self._getSeedConcurrency(cfg,s)
+            centry['cacheControl']=layer.get('cache_control')
+            centry['errorTiles']=self._hasErrorHandler(cfg,s)
             if layer2caches.get(name) is None:
               layer2caches[name] = []
             layer2caches[name].append(centry)
@@ -273,34 +400,43 @@ class MapProxyWrapper(object):
       os.unlink(other)
     except:
       pass
-    self.layerMappings=mappings
-
+    return mappings
 
   def createProxy(self,changedOnly=False,isOffline=False):
-    if self.mapproxy is None or self.configTimeStamp is None:
-      changedOnly=False
-    if not os.path.exists(self.configFile):
-      self.mapproxy = None
-      raise Exception("config file %s not found",self.configFile)
-    st = os.stat(self.configFile)
-    if changedOnly:
-      if st.st_mtime == self.configTimeStamp:
-        self.logger.debug("config file %s not changed",self.configFile)
-        return False
-    self.fatalError = None
-    self.mapproxy = None
-    self.configTimeStamp=st.st_mtime
-    self.logger.log("creating mapproxy wsgi app with config %s", self.getConfigName(isOffline))
-    try:
-      self.createConfigAndMappings(isOffline)
-      self.injector.checkCreatedIfNeeded(self.getConfigName(isOffline))
-      self.mapproxy = make_wsgi_app(self.getConfigName(isOffline), ignore_config_warnings=True, reloader=False)
+    '''
+    (re)create the mapproxy app
+    the current app continues to serve requests until the new one is ready,
+    if the new app cannot be created the current one stays active
+    :return: True if a new app has been created
+    '''
+    with self.createLock:
+      if self.mapproxy is None or self.configTimeStamp is None:
+        changedOnly=False
+      if not os.path.exists(self.configFile):
+        raise Exception("config file %s not found",self.configFile)
+      st = os.stat(self.configFile)
+      if changedOnly:
+        if st.st_mtime == self.configTimeStamp:
+          self.logger.debug("config file %s not changed",self.configFile)
+          return False
+      self.fatalError = None
+      self.configTimeStamp=st.st_mtime
+      self.logger.log("creating mapproxy wsgi app with config %s", self.getConfigName(isOffline))
+      try:
+        mappings=self.createConfigAndMappings(isOffline)
+        self.injector.checkCreatedIfNeeded(self.getConfigName(isOffline))
+        app = make_wsgi_app(self.getConfigName(isOffline), ignore_config_warnings=True, reloader=False)
+        tileLayers=self._getTileLayers(app,mappings)
+      except Exception as e:
+        self.logger.error("unable to create mapProxy: %s",traceback.format_exc())
+        self.fatalError=str(e)
+        raise
+      #requests that already run keep their app until they are finished,
+      #but they do not put their tiles into the cleared caches
+      self.clearTileCache(app,tileLayers)
+      self.mapproxy=app
+      self.layerMappings=mappings
       self.getFatalError(True)
-    except Exception as e:
-      self.layerMappings={}
-      self.logger.error("unable to create mapProxy: %s",traceback.format_exc())
-      self.fatalError=str(e)
-      raise
 
     self.logger.log("created mapproxy wsgi app")
     return True
@@ -318,13 +454,18 @@ class MapProxyWrapper(object):
     error=self.getFatalError(False)
     if self.mapproxy is not None:
       status='ok'
-      error=None
+      #the last rebuild failed, the previous app is still running
+      error=self.fatalError
     elif error is not None:
       status='error'
     return {
       'running': self.mapproxy is not None,
       'status': status,
-      'lastError': error
+      'lastError': error,
+      'tileCache': self.tileCache.getStatus(),
+      'tileInfoCache': self.tileInfoCache.getStatus(),
+      'mbtilesLayers': len([l for l in self.proxy[1].values() if l['file'] is not None]),
+      'mbtilesReader': self.mbtilesReader.getStatus()
     }
   def getMaps(self):
     rt=[]
@@ -417,19 +558,242 @@ class MapProxyWrapper(object):
           env['HTTP_' + k] = v
       return env
 
+  def clearTileCache(self,app=None,tileLayers=None):
+    '''
+    drop all tiles from the in memory cache
+    must be called whenever tiles in the mapproxy caches could have changed
+    :param app: a new app to be used from now on (with its tileLayers)
+    '''
+    with self.proxyLock:
+      (currentApp,currentLayers,generation)=self.proxy
+      if app is None:
+        (app,tileLayers)=(currentApp,currentLayers)
+      self.proxy=(app,tileLayers,generation+1)
+      self.tileCache.clear()
+      self.tileInfoCache.clear()
+    self.mbtilesReader.clear()
+
+  def _putTile(self,generation,key,entry):
+    '''
+    keep a tile response (status,headers,body) in the memory caches
+    if they have not been cleared since the request started
+    '''
+    with self.proxyLock:
+      if generation != self.proxy[2]:
+        return
+      self.tileCache.put(key,entry)
+      self.tileInfoCache.put(key,entry[1])
+
+  def _getTileLayers(self,app,layerMappings):
+    '''
+    collect the tile layers of the app with the settings of their cache
+    a layer can be served directly from its mbtiles file (file is set) if it has
+    exactly one cache of type mbtiles (from the layer mappings), a single file
+    and nothing that mapproxy must do on a cache hit
+    :return: a dict (layer,grid) -> {grid,flip,cacheControl,errorTiles,file,format,timestamps}
+    '''
+    rt={}
+    handlers=app.handlers or {}
+    tiles=handlers.get('tiles')
+    if tiles is None:
+      return rt
+    defaultCacheControl=None
+    if tiles.max_tile_age is not None:
+      defaultCacheControl='public, max-age=%d, s-maxage=%d'%(tiles.max_tile_age,tiles.max_tile_age)
+    for key,layer in tiles.layers.items():
+      if not isinstance(key,tuple) or len(key) != 2:
+        continue
+      caches=layerMappings.get(key[0])
+      if caches is None or len(caches) != 1:
+        continue
+      try:
+        manager=layer.tile_manager
+        cache=manager.cache
+        grid=layer.grid
+        #same logic as TileLayer._internal_tile_coord
+        flip=((tiles.origin == 'nw' and grid.origin not in ('ul','nw')) or
+              (tiles.origin == 'sw' and grid.origin not in ('ll','sw',None)))
+        info={
+          'grid':grid,
+          'flip':flip,
+          'cacheControl':caches[0].get('cacheControl'),
+          'errorTiles':caches[0].get('errorTiles',True),
+          'file':None
+        }
+        rt[key]=info
+        if (caches[0].get('cache') or {}).get('type') != 'mbtiles':
+          continue
+        if type(cache).__name__ != 'MBTilesCache' or layer.dimensions or layer._mixed_format:
+          continue
+        if getattr(manager,'_refresh_before',None):
+          continue
+        info.update({
+          'file':cache.mbtile_file,
+          'format':layer.format,
+          'timestamps':cache.supports_timestamp,
+          'cacheControl':caches[0].get('cacheControl') or defaultCacheControl
+        })
+      except Exception as e:
+        self.logger.debug("unable to get tile layer details for %s: %s",str(key),str(e))
+    return rt
+
+  @classmethod
+  def _internalCoord(cls,info,key):
+    '''
+    the tile coordinate in the cache for a tile key, None if outside of the grid
+    '''
+    (layer,grid,z,x,y,ext)=key
+    coord=info['grid'].internal_tile_coord((x,y,z),False)
+    if coord is None:
+      return None
+    if info['flip']:
+      coord=info['grid'].flip_tile_coord(coord)
+    return coord
+
+  def _readMbtilesTile(self,layers,key):
+    '''
+    try to read a tile directly from the mbtiles file of the layer
+    :return: (status,headers,body) or None if mapproxy must handle the request
+    '''
+    (layer,grid,z,x,y,ext)=key
+    info=layers.get((layer,grid))
+    if info is None or info['file'] is None or info['format'] != ext:
+      return None
+    coord=self._internalCoord(info,key)
+    if coord is None:
+      return None
+    try:
+      (data,timestamp)=self.mbtilesReader.getTile(info['file'],coord[2],coord[0],coord[1],
+                                                  withTimestamp=info['timestamps'])
+      if data is not None and timestamp is None:
+        #no timestamp per tile - the tile is at least not newer than the file
+        timestamp=os.path.getmtime(info['file'])
+    except Exception as e:
+      self.logger.debug("unable to read tile %s from %s: %s",str(key),info['file'],str(e))
+      return None
+    if data is None:
+      return None
+    headers=tilereader.tileHeaders([('Content-Type','image/'+ext)],data,timestamp,info['cacheControl'])
+    return ('200 OK',headers,data)
+
+  def _sendNotModified(self,handler,headers):
+    handler.send_response(304,'Not Modified')
+    for k,v in headers:
+      if k.lower() in ['etag','last-modified','cache-control','expires']:
+        handler.send_header(k,v)
+    handler.end_headers()
+
+  def _sendTile(self,handler,conditions,status,headers,body):
+    if status.startswith('200') and tilereader.isNotModified(headers,*conditions):
+      self._sendNotModified(handler,headers)
+      return
+    self._sendResponse(handler,status,headers,body)
+
+  def _tileKey(self,env):
+    '''
+    the key for the tile cache, None if the request is not a plain tile request
+    '''
+    if env.get('REQUEST_METHOD') not in ['GET','HEAD'] or env.get('QUERY_STRING'):
+      return None
+    match=self.TILE_PATH.match(env.get('PATH_INFO',''))
+    if match is None:
+      return None
+    (layer,grid,z,x,y,ext)=match.groups()
+    return (layer,grid,int(z),int(x),int(y),ext)
+
+  def _runApp(self,app,env,stderr,handler):
+    '''
+    run the wsgi app and collect the response
+    :return: (status,headers,body)
+    '''
+    env.update({
+      'wsgi.input':handler.rfile,
+      'wsgi.errors':stderr,
+      'wsgi.version':(1,0),
+      'wsgi.url_scheme':'http',
+      'wsgi.multithread':True,
+      'wsgi.multiprocess':False,
+      'wsgi.run_once':False
+    })
+    response={}
+    chunks=[]
+    def startResponse(status,headers,exc_info=None):
+      response['status']=status
+      response['headers']=headers
+      return chunks.append
+    result=app(env,startResponse)
+    try:
+      for data in result:
+        chunks.append(data)
+    finally:
+      if hasattr(result,'close'):
+        result.close()
+    return (response.get('status','500 Internal Server Error'),response.get('headers',[]),b''.join(chunks))
+
+  def _sendResponse(self,handler,status,headers,body):
+    (code,reason)=(status.split(' ',1)+[''])[0:2]
+    handler.send_response(int(code),reason)
+    for k,v in headers:
+      if k.lower() in ['content-length','date','server','connection']:
+        continue
+      handler.send_header(k,v)
+    handler.send_header('Content-Length',str(len(body)))
+    handler.end_headers()
+    if handler.command != 'HEAD':
+      handler.wfile.write(body)
+
+  def _sendCachedTile(self,handler,conditions,tileLayers,generation,key):
+    '''
+    send a tile from the memory caches or directly from the mbtiles file
+    :return: True if the tile has been sent
+    '''
+    cached=self.tileCache.get(key)
+    if cached is not None:
+      self._sendTile(handler,conditions,*cached)
+      return True
+    info=self.tileInfoCache.get(key)
+    if info is not None and tilereader.isNotModified(info,*conditions):
+      self._sendNotModified(handler,info)
+      return True
+    direct=self._readMbtilesTile(tileLayers,key)
+    if direct is None:
+      return False
+    self._putTile(generation,key,direct)
+    self._sendTile(handler,conditions,*direct)
+    return True
+
   def handleRequest(self,url,handler,args):
-    if self.mapproxy is None:
+    (app,tileLayers,generation)=self.proxy
+    if app is None:
       self.logger.error("request %s, mapproxy not created",url)
       raise Exception("mapproxy not created")
+    env=self._getWsgiEnv(handler)
+    key=self._tileKey(env)
+    if key is not None:
+      #conditional requests are handled here with our own ETags
+      conditions=[env.pop(h,None) for h in self.CONDITIONAL_HEADERS]
+      if self._sendCachedTile(handler,conditions,tileLayers,generation,key):
+        return
     stderr = io.StringIO()
     try:
+      if key is not None:
+        #concurrent requests for the tiles of one meta tile are serialized by the
+        #meta tile lock of mapproxy, the ones that waited read the tile from its cache
+        (status,headers,body)=self._runApp(app,env,stderr,handler)
+        layer=tileLayers.get(key[0:2])
+        if tilereader.isCacheable(layer,status,headers):
+          headers=tilereader.tileHeaders(headers,body,cacheControl=layer['cacheControl'])
+          if env['REQUEST_METHOD'] == 'GET':
+            self._putTile(generation,key,(status,headers,body))
+        self._sendTile(handler,conditions,status,headers,body)
+        return
       shandler = OwnWsgiHandler(
-        handler.rfile, handler.wfile, stderr, self._getWsgiEnv(handler)
+        handler.rfile, handler.wfile, stderr, env
       )
       shandler.request_handler = handler  # backpointer for logging
       shandler.log_request = handler.log_request
-      shandler.run(self.mapproxy)
+      shandler.run(app)
     finally:
       errors = stderr.getvalue()
       if len(errors) > 0:
-        self.logger.error("request %s : %s", url, errors)
\ No newline at end of file
+        self.logger.error("request %s : %s", url, errors)
@@ -23,6 +23,7 @@ import importlib.util
 import io
 import json
 import os
+import hashlib
 import re
 import shutil
 import sys
@@ -54,6 +55,7 @@ seedCreator=loadModuleFromFile('create_seed.py')
 seedRunner=loadModuleFromFile('seed_runner.py')
 mapproxyWrapper=loadModuleFromFile('mapproxy_wrapper.py')
 networkChecker=loadModuleFromFile('network.py')
+lrucache=loadModuleFromFile('lrucache.py')
 
 NAME="mapproxy"
 
@@ -86,11 +88,17 @@ class Plugin:
   WD_SELECTIONS='selections'
   WD_SEED='seed'
   WD_LAYERS="layers"
-  WD_ALL=[WD_LAYERS,WD_SEED,WD_SELECTIONS]
+  WD_BOXES="boxes"
+  WD_RATELIMIT="ratelimit"
+  WD_ALL=[WD_LAYERS,WD_SEED,WD_SELECTIONS,WD_BOXES,WD_RATELIMIT]
   NW_AUTO='auto'
   NW_ON='on'
   NW_OFF='off'
   RT_OK={'status':'OK'}
+  BOXES_CACHE_SIZE=8*1024*1024
+  LOG_CHUNK=100000
+  MAX_LOG_WAIT=30
+  DEFAULT_TILE_SIZE=20000
   NETWORK_MODES=[NW_AUTO,NW_OFF,NW_ON]
   CONFIG_TEMPLATE="avnav_template.yaml"
   AVNAV_XML = """<?xml version="1.0" encoding="UTF-8" ?>
@@ -130,6 +138,18 @@ class Plugin:
       'type': 'NUMBER',
       'default': 200000
     },
+    {
+      'name': 'maxBoxes',
+      'description': 'max number of boxes to show on the map, aggregate them above (0: no limit)',
+      'type': 'NUMBER',
+      'default': 1000
+    },
+    {
+      'name': 'seedConcurrency',
+      'description': 'number of parallel workers for a seed if the sources do not set seed_concurrency',
+      'type': 'NUMBER',
+      'default': 1
+    },
     {
       'name': 'networkMode',
       'description': 'the initial state of the internet connection when AvNav is starting',
@@ -178,7 +198,10 @@ class Plugin:
     self.queryPeriod=5
     self.seedRunner=None
     self.maxTiles=100000
+    self.maxBoxes=None
+    self.seedConcurrency=1
     self.boxes=None
+    self.boxesCache=lrucache.LRUCache(maxSize=self.BOXES_CACHE_SIZE)
     self.networkMode=self.NW_AUTO
     self.networkAvailable=None
     self.networkHost=None
@@ -208,8 +231,18 @@ class Plugin:
     maxTiles=newValues.get('maxTiles')
     if maxTiles is not None:
       self.maxTiles=int(maxTiles)
+    maxBoxes=newValues.get('maxBoxes')
+    if maxBoxes is not None:
+      self.maxBoxes=self._toMaxBoxes(maxBoxes)
+    seedConcurrency=newValues.get('seedConcurrency')
+    if seedConcurrency is not None:
+      self.seedConcurrency=max(1,int(seedConcurrency))
     self.api.saveConfigValues(newValues)
     self.changeSequence+=1
+  def _toMaxBoxes(self,value):
+    value=int(value)
+    return value if value > 0 else None
+
   def _getConfigValue(self, name):
     defaults=self.pluginInfo()['config']
     for cf in defaults:
@@ -318,6 +351,122 @@ class Plugin:
                 except Exception as e:
                   self.api.debug("error setting mbtiles metadata: %s",str(e))
               return name
+  def _getSeedCaches(self,layerName,baseLayer=None):
+    '''
+    get the caches to seed for a layer
+    :return: the list of cache entries or None if the layer has no caches
+    '''
+    caches=self.layer2caches.get(layerName)
+    if caches is None:
+      return None
+    baseCaches=self.layer2caches.get(baseLayer)
+    if type(baseCaches) is list:
+      caches=caches + baseCaches
+    return caches
+
+  def _getSeedConcurrency(self,caches):
+    '''
+    the number of seed workers - the smallest seed_concurrency
+    set at the sources of the caches, the plugin config otherwise
+    '''
+    rt=None
+    for cache in caches:
+      concurrency=cache.get('seedConcurrency')
+      if concurrency is not None and (rt is None or concurrency < rt):
+        rt=concurrency
+    if rt is None:
+      return self.seedConcurrency
+    return max(1,rt)
+
+  def _planSeed(self,bounds,caches,reloadDays=None):
+    '''
+    compute the tiles per zoom level for a seed and estimate
+    the download size (from the tiles in the caches) and the duration
+    (from the previous seeds for the caches)
+    :return: dict with the plan
+    '''
+    boxesList=[seedCreator.Box.fromDict(b) for b in bounds]
+    cacheNames=[c['name'] for c in caches]
+    (merger,seeds)=seedCreator.buildSeed(boxesList,'plan',cacheNames,logger=self.api,reloadDays=reloadDays)
+    zoomStats={}
+    for zoom in merger.getParsed().getZoomLevels():
+      numTiles=merger.counter.getZoomCount(zoom)
+      zoomStats[zoom]=(numTiles,numTiles)
+    if reloadDays is None:
+      cacheFiles=self._getPreflightFiles(caches)
+      if cacheFiles is not None:
+        preflight=seedCreator.SeedPreflight(cacheFiles,self.api)
+        preflight.run(seeds)
+        zoomStats.update(preflight.zoomStats)
+    zooms=sorted(zoomStats.keys())
+    tileSizes=[]
+    for c in caches:
+      cacheFile=self._getCacheFile(c['name'],checkExistance=True)
+      sizes={}
+      if cacheFile is not None:
+        try:
+          sizes=seedCreator.averageTileSizes(cacheFile,range(0,max(zooms+[0])+1))
+        except Exception as e:
+          self.api.debug("unable to get tile sizes from %s: %s",cacheFile,str(e))
+      tileSizes.append(sizes)
+    sizeKnown=True
+    levels=[]
+    totalTiles=0
+    fetchTiles=0
+    totalBytes=0
+    for zoom in zooms:
+      (numTiles,numFetch)=zoomStats[zoom]
+      numBytes=0
+      for sizes in tileSizes:
+        if len(sizes) > 0:
+          #use the nearest zoom level that has tiles
+          size=sizes[min(sizes.keys(),key=lambda z: abs(z-zoom))]
+        else:
+          size=self.DEFAULT_TILE_SIZE
+          sizeKnown=False
+        numBytes+=int(numFetch*size)
+      levels.append({'zoom':zoom,'tiles':numTiles,'fetchTiles':numFetch,'bytes':numBytes})
+      totalTiles+=numTiles
+      fetchTiles+=numFetch
+      totalBytes+=numBytes
+    rt={
+      'numTiles':totalTiles,
+      'fetchTiles':fetchTiles,
+      'bytes':totalBytes,
+      'sizeKnown':sizeKnown,
+      'allowed':self.maxTiles,
+      'zoomLevels':levels,
+      'concurrency':self._getSeedConcurrency(caches),
+      'seconds':None
+    }
+    throughput=self.seedRunner.getThroughput(cacheNames) if self.seedRunner is not None else None
+    if throughput is not None:
+      rt['seconds']=int(fetchTiles/throughput)
+    cacheDir=os.path.join(self.dataDir,'cache_data')
+    if not os.path.isdir(cacheDir):
+      cacheDir=self.dataDir
+    rt['freeBytes']=shutil.disk_usage(cacheDir).free
+    if totalBytes > rt['freeBytes']:
+      rt['warning']='estimated size %d MB exceeds the free space of %d MB in %s'%(
+        totalBytes//(1024*1024),rt['freeBytes']//(1024*1024),cacheDir)
+    return rt
+
+  def _getPreflightFiles(self,caches):
+    '''
+    get the mbtiles files to check before seeding
+    :param caches: the cache entries for the seed
+    :return: the list of files or None if not all caches can be checked
+    '''
+    rt=[]
+    for c in caches:
+      if not c.get('xyzGrid'):
+        return None
+      cacheFile=self._getCacheFile(c.get('name'),checkExistance=True)
+      if cacheFile is None:
+        return None
+      rt.append(cacheFile)
+    return rt
+
   def _emptyCache(self,cacheName):
     cacheFile=self._getCacheFile(cacheName,checkExistance=True)
     self.api.debug("deleting data for %s",cacheName)
@@ -327,6 +476,7 @@ class Plugin:
       con.commit()
     finally:
       con.close()
+      self.mapproxy.clearTileCache()
     
 
   def _wakeupLoop(self):
@@ -438,19 +588,26 @@ class Plugin:
           if hasChanged:
             self._safeWriteFile(mainCfg,yaml.dump(mainData))
       self.maxTiles=int(self._getConfigValue('maxTiles'))
+      self.maxBoxes=self._toMaxBoxes(self._getConfigValue('maxBoxes'))
+      self.seedConcurrency=max(1,int(self._getConfigValue('seedConcurrency')))
       configDirs=[self._getDataDir(),self._getDataDir(self.WD_LAYERS),self._getSystemConfigDir()]
       self.mapproxy=mapproxyWrapper.MapProxyWrapper(self.api.getBaseUrl()+"/api/"+self.MPREFIX,
                                                 os.path.join(self.dataDir,self.INCLUDE_CONFIG),
                                                 configDirs,
-                                                self.api)
+                                                self.api,
+                                                rateLimitDir=self._getDataDir(self.WD_RATELIMIT))
       self.seedRunner=seedRunner.SeedRunner(self._getDataDir(self.WD_SEED),
                                             self.mapproxy.getConfigName(False), #only if online...
                                             configDirs,
-                                            self.api)
+                                            self.api,
+                                            finishedCallback=self.mapproxy.clearTileCache,
+                                            rateLimitDir=self._getDataDir(self.WD_RATELIMIT))
       self.seedRunner.checkRestart()
       # we register an handler for API requestscreateSeed(boundsFile,seedFile,name,cache,logger=None):
       self.api.registerRequestHandler(self.handleApiRequest)
+      seedCreator.BoxCatalog.compiledDir=self._getDataDir(self.WD_BOXES)
       self.boxes=seedCreator.Boxes(logHandler=self.api,additionalBoxes=True)
+      self.boxes.prepare()
       guiPath="gui/index.html"
       testPath=self._getConfigValue('guiPath')
       if testPath is not None:
@@ -608,6 +765,21 @@ class Plugin:
       except:
         pass
 
+  def _matchesEtag(self,handler,etag):
+    '''
+    check if the If-None-Match header of a request contains our etag
+    '''
+    header=handler.headers.get('If-None-Match')
+    if header is None:
+      return False
+    for tag in header.split(','):
+      tag=tag.strip()
+      if tag.startswith('W/'):
+        tag=tag[2:]
+      if tag == etag or tag == '*':
+        return True
+    return False
+
   def handleApiRequest(self,url,handler,args):
     """
     handler for API requests send from the JS
@@ -653,13 +825,9 @@ class Plugin:
           yaml.dump(decoded,oh)
         if startSeed is not None:
           baseLayer=self._getRequestParam(args,'baseLayer',raiseMissing=False)
-          layerName=startSeed
-          caches=self.layer2caches.get(layerName)
+          caches=self._getSeedCaches(startSeed,baseLayer)
           if caches is None:
-            return {'status':'no caches found for layer %s'%layerName}
-          baseCaches=self.layer2caches.get(baseLayer)
-          if type(baseCaches) is list:
-            caches=caches + baseCaches
+            return {'status':'no caches found for layer %s'%startSeed}
           seedName = "seed-" + datetime.now().strftime('%Y%m%d-%H%M%s')
           cacheNames=list(map(lambda x:x['name'],caches))
           reloadDays=self._getRequestParam(args,'reloadDays',raiseMissing=False)
@@ -667,20 +835,62 @@ class Plugin:
                                                      cacheNames,
                                                      logger=self.api,
                                                      reloadDays=reloadDays)
+          rt={'status':'OK','numTiles':numTiles}
+          if reloadDays is None:
+            #without a refresh we only need to seed the tiles that are not cached yet
+            cacheFiles=self._getPreflightFiles(caches)
+            if cacheFiles is not None:
+              (fetchTiles,cachedTiles)=seedCreator.SeedPreflight(cacheFiles,self.api).run(seeds)
+              rt['fetchTiles']=fetchTiles
+              rt['cachedTiles']=cachedTiles
+              numTiles=fetchTiles
           if numTiles > self.maxTiles:
             return {'status':'number of tiles %d larger then allowed %s'%(numTiles,self.maxTiles)}
-          self.seedRunner.runSeed(seeds, cacheNames,selectionName=self._safeName(name))
-          return {'status':'OK','numTiles':numTiles}
+          if len(seeds['seeds']) < 1:
+            return rt
+          priority=self._getRequestParam(args,'priority',raiseMissing=False)
+          (jobId,started)=self.seedRunner.queueSeed(seeds, cacheNames,
+                                                    selectionName=self._safeName(name),
+                                                    numTiles=numTiles,
+                                                    concurrency=self._getSeedConcurrency(caches),
+                                                    priority=int(priority) if priority else 0)
+          rt['jobId']=jobId
+          rt['queued']=not started
+          return rt
         return self.RT_OK
 
       if url == 'killSeed':
         self.seedRunner.killRun()
         return self.RT_OK
 
+      if url == 'removeSeedJob':
+        jobId=int(self._getRequestParam(args,'id'))
+        if not self.seedRunner.removeJob(jobId):
+          return {'status':'seed job %d not found'%jobId}
+        return self.RT_OK
+
+      if url == 'setSeedJobPriority':
+        jobId=int(self._getRequestParam(args,'id'))
+        priority=int(self._getRequestParam(args,'priority'))
+        if not self.seedRunner.setJobPriority(jobId,priority):
+          return {'status':'seed job %d not found'%jobId}
+        return self.RT_OK
+
       if url == 'countTiles':
         data=self._getRequestParam(args,'data')
         rt=seedCreator.countTiles(json.loads(data),self.api)
         return {'status':'OK','numTiles':rt,'allowed':self._getConfigValue('maxTiles')}
+      if url == 'planSeed':
+        data=self._getRequestParam(args,'data')
+        layerName=self._getRequestParam(args,'layer')
+        baseLayer=self._getRequestParam(args,'baseLayer',raiseMissing=False)
+        reloadDays=self._getRequestParam(args,'reloadDays',raiseMissing=False)
+        caches=self._getSeedCaches(layerName,baseLayer)
+        if caches is None:
+          return {'status':'no caches found for layer %s'%layerName}
+        rt=self._planSeed(json.loads(data),caches,reloadDays)
+        rt['status']='OK'
+        return rt
       if url == 'listSelections':
         return {'status':'OK','data':self._listSelections()}
 
@@ -800,23 +1010,55 @@ class Plugin:
     if url == 'getLog':
       asAttach=self._getRequestParam(args,'attach',raiseMissing=False)
       status=self.seedRunner.getStatus()
-      seekBytes=100000
+      seekBytes=self.LOG_CHUNK
       if asAttach is not None:
         seekBytes=None
-      fh=self.seedRunner.getLogFile(status.get('logFile'),seekBytes)
+      compressed=None
+      if asAttach is not None and 'gzip' in (handler.headers.get('Accept-Encoding') or ''):
+        #send compressed logs as they are
+        compressed=self.seedRunner.getCompressedLog(status.get('logFile'))
+      if compressed is not None:
+        fh=compressed
+      else:
+        fh=self.seedRunner.getLogFile(status.get('logFile'),seekBytes)
       if fh is None:
         raise Exception("no log file")
-      handler.send_response(200, "OK")
-      handler.send_header('Content-Type', 'text/plain')
-      handler.send_header("Last-Modified", handler.date_time_string())
-      if asAttach is not None:
-        handler.send_header('Content-Disposition',
-                            'attachment;filename="%s"' %os.path.basename(status.get('logFile')) )
-      handler.end_headers()
-      handler.close_connection=True
-      shutil.copyfileobj(fh,handler.wfile)
+      with fh:
+        handler.send_response(200, "OK")
+        handler.send_header('Content-Type', 'text/plain')
+        handler.send_header("Last-Modified", handler.date_time_string())
+        if compressed is not None:
+          handler.send_header('Content-Encoding','gzip')
+          handler.send_header('Content-Length',str(os.fstat(fh.fileno()).st_size))
+        if asAttach is not None:
+          handler.send_header('Content-Disposition',
+                              'attachment;filename="%s"' %os.path.basename(status.get('logFile')) )
+        handler.end_headers()
+        handler.close_connection=True
+        shutil.copyfileobj(fh,handler.wfile)
       return True
 
+    if url == 'readLog':
+      name=self._getRequestParam(args,'name',raiseMissing=False)
+      if name is None:
+        name=self.seedRunner.getStatus().get('logFile')
+      offset=self._getRequestParam(args,'offset',raiseMissing=False)
+      wait=self._getRequestParam(args,'wait',raiseMissing=False)
+      wait=min(float(wait),self.MAX_LOG_WAIT) if wait else 0
+      res=self.seedRunner.readLog(name,int(offset) if offset is not None else None,
+                                  maxBytes=self.LOG_CHUNK,wait=wait)
+      if res is None:
+        return {'status':'no log file'}
+      (data,start,nextOffset)=res
+      return {
+        'status':'OK',
+        'name':name,
+        'offset':start,
+        'next':nextOffset,
+        'data':data.decode('utf-8',errors='replace'),
+        'running':self.seedRunner.isLogActive(name)
+      }
+
     if url == 'getCacheFile':
       name=self._getRequestParam(args,'name')
       fileName=self._getCacheFile(name,checkExistance=True,insertMeta=True)
@@ -842,14 +1084,29 @@ class Plugin:
         swlng = float(self._getRequestParam(args, 'swlng'))
         minZoom = self._getRequestParam(args, 'minZoom',False)
         maxZoom = self._getRequestParam(args, 'maxZoom',False)
-        boxlines = self.boxes.getBoxes(nelat, nelng, swlat, swlng, minZoom, maxZoom)
+        (qkey,bounds)=self.boxes.quantizeBounds(nelat, nelng, swlat, swlng)
+        maxBoxes=self.maxBoxes
+        key=(self.boxes.getVersion(),qkey,minZoom,maxZoom,maxBoxes)
+        etag='"%s"'%hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        if self._matchesEtag(handler,etag):
+          handler.send_response(304, "Not Modified")
+          handler.send_header("ETag", etag)
+          handler.send_header("Cache-Control", "no-cache")
+          handler.end_headers()
+          handler.close_connection = True
+          return True
+        data=self.boxesCache.get(key)
+        if data is None:
+          data=b''.join(self.boxes.getBoxes(*bounds, minZoom, maxZoom, maxBoxes))
+          self.boxesCache.put(key,data)
         handler.send_response(200, "OK")
         handler.send_header('Content-Type', 'text/plain')
-        handler.send_header("Last-Modified", handler.date_time_string())
+        handler.send_header('Content-Length', str(len(data)))
+        handler.send_header("ETag", etag)
+        handler.send_header("Cache-Control", "no-cache")
         handler.end_headers()
         handler.close_connection = True
-        for l in boxlines:
-          handler.wfile.write(l)
+        handler.wfile.write(data)
         return True
       except Exception as e:
         handler.send_response(400, str(e))
@@ -881,10 +1138,21 @@ class Plugin:
           param.update(chart['internal'])
         response=self.AVNAV_XML%param
         response=response.encode('utf-8')
+        etag='"%s"'%hashlib.md5(response).hexdigest()
+        lastModified=self.mapproxy.configTimeStamp if self.mapproxy is not None else None
+        if self._matchesEtag(handler,etag):
+          handler.send_response(304, "Not Modified")
+          handler.send_header("ETag", etag)
+          handler.send_header("Cache-Control", "no-cache")
+          handler.end_headers()
+          return True
         handler.send_response(200,"OK")
         handler.send_header('Content-Type','text/xml')
         handler.send_header('Content-Length',str(len(response)))
-        handler.send_header("Last-Modified", handler.date_time_string())
+        handler.send_header("ETag", etag)
+        handler.send_header("Cache-Control", "no-cache")
+        if lastModified is not None:
+          handler.send_header("Last-Modified", handler.date_time_string(lastModified))
         handler.end_headers()
         handler.wfile.write(response)
         return True
@@ -20,13 +20,21 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 import datetime
+import gzip
 import importlib.util
+import json
+import multiprocessing
 import os
+import select
+import shutil
 import signal
+import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import traceback
 
 import yaml
 
@@ -50,7 +58,82 @@ class PausedException(Exception):
 
 injector=loadModuleFromFile('injector.py')
 
-ENV_PID='AVNAV_PARENT_PID'
+ENV_PIPE='AVNAV_PARENT_PIPE'
+ENV_STATUS='AVNAV_SEED_STATUS'
+ENV_RATELIMIT='AVNAV_RATELIMIT_DIR'
+
+def exitCode(status):
+  '''
+  convert a status from os.waitpid into a return code like subprocess.Popen
+  '''
+  if os.WIFEXITED(status):
+    return os.WEXITSTATUS(status)
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return -1
+
+def installStatusLog(statusFile,byteCounter=None,interval=1):
+  '''
+  replace the progress logger of mapproxy-seed by one that additionally
+  writes the progress as json to statusFile (at most every interval seconds)
+  must be called before the seed is started
+  '''
+  import mapproxy.seed.script
+  baseClass=mapproxy.seed.script.ProgressLog
+
+  class StatusProgressLog(baseClass):
+    def __init__(self,*args,**kwargs):
+      super().__init__(*args,**kwargs)
+      self.statusStart=time.time()
+      self.statusLast=0
+      self.statusTask=None
+      self.tilesBefore=0
+      self.taskTiles=0
+      self.level=None
+      self.progress=0
+
+    def _writeStatus(self,force=False):
+      now=time.time()
+      if not force and now < (self.statusLast+interval):
+        return
+      self.statusLast=now
+      task=self.current_task_id or (None,None)
+      tiles=self.tilesBefore+self.taskTiles
+      status={
+        'seed':task[0],
+        'cache':task[1],
+        'zoom':self.level,
+        'taskProgress':self.progress,
+        'tiles':tiles,
+        'bytes':byteCounter.value if byteCounter is not None else None,
+        'elapsed':now-self.statusStart,
+        'updated':now
+      }
+      try:
+        tmp=statusFile+".tmp"
+        with open(tmp,"w") as fh:
+          json.dump(status,fh)
+        os.replace(tmp,statusFile)
+      except Exception:
+        pass
+
+    def log_step(self,progress):
+      super().log_step(progress)
+      self.progress=progress.progress
+      self._writeStatus()
+
+    def log_progress(self,progress,level,bbox,tiles):
+      super().log_progress(progress,level,bbox,tiles)
+      if self.current_task_id != self.statusTask:
+        self.statusTask=self.current_task_id
+        self.tilesBefore+=self.taskTiles
+        self.taskTiles=0
+      self.taskTiles=tiles
+      self.level=level
+      self.progress=progress.progress
+      self._writeStatus(progress.progress >= 1.0)
+
+  mapproxy.seed.script.ProgressLog=StatusProgressLog
 class SeedRunner(object):
   STATE_RUNNING="running"
   STATE_OK="ok"
@@ -59,17 +142,42 @@ class SeedRunner(object):
   CURRENT_CONFIG="seed.yaml"
   LAST_CONFIG="last_seed.yaml"
   PROGRESS_FILE="progress"
+  STATUS_FILE="status.json"
   LOGFILE="seed.log"
+  GZSUFFIX=".gz"
   INFOFILE="info.yaml"
-  def __init__(self,workdir,configFile,configDirs,logHandler=None,keepLogs=20):
+  HISTORYFILE="history.yaml"
+  QUEUEFILE="queue.yaml"
+  KEEP_HISTORY=50
+  DEFAULT_CONCURRENCY=1
+  MAX_LOG_WAIT=30
+  def __init__(self,workdir,configFile,configDirs,logHandler=None,keepLogs=20,keepLogBytes=20*1024*1024,
+               useServer=True,finishedCallback=None,rateLimitDir=None):
+    '''
+    :param finishedCallback: called (without parameters) whenever a seed process has ended
+    :param rateLimitDir: the directory for the rate limit state shared with the proxy
+    '''
     self.workdir=workdir
     if not os.path.isdir(workdir):
       raise Exception("workdir %s does not exist"%workdir)
     self.keepLogs=keepLogs
+    self.keepLogBytes=keepLogBytes
+    self.cleanupLock=threading.Lock()
+    self.cleanupThread=None
+    self.finishedCallback=finishedCallback
+    self.server=None
+    self.logCondition=threading.Condition()
+    if useServer:
+      self.server=SeedServerClient(workdir,configFile,configDirs,self._statusFile(),logHandler,
+                                   outputCallback=self._notifyLogReaders,
+                                   rateLimitDir=rateLimitDir)
     self.child=None
     self.configFile=configFile
     self.currentlyStarting=False
     self.lock=threading.Lock()
+    self.checkLock=threading.RLock()
+    self.parentPipe=None
+    self.queueLock=threading.Lock()
     self.seedStatus=self.STATE_INACTIVE
     self.info=""
     self.logHandler=logHandler
@@ -78,6 +186,14 @@ class SeedRunner(object):
     self.selectionName=None
     self.pause=False
     self.configDirs=configDirs
+    self.rateLimitDir=rateLimitDir
+    self.numTiles=None
+    self.runtime=0
+    self.startTime=None
+    self.concurrency=self.DEFAULT_CONCURRENCY
+    self.tilesDone=0
+    self.bytesDone=0
+    self.queue=self._readQueue()
 
   def logDebug(self,fmt,*args):
     if (self.logHandler):
@@ -98,15 +214,35 @@ class SeedRunner(object):
     return os.path.join(self.workdir,self.CURRENT_CONFIG)
   def _progressFile(self):
     return os.path.join(self.workdir,self.PROGRESS_FILE)
+  def _statusFile(self):
+    return os.path.join(self.workdir,self.STATUS_FILE)
   def _infoFile(self):
     return os.path.join(self.workdir,self.INFOFILE)
+  def _historyFile(self):
+    return os.path.join(self.workdir,self.HISTORYFILE)
+  def _queueFile(self):
+    return os.path.join(self.workdir,self.QUEUEFILE)
   def _logFile(self):
-    suffix=self._nowTs(True)
-    return os.path.join(self.workdir,self.LOGFILE+"."+suffix)
+    '''
+    a new log file name, seeds started within the same second get a counter
+    so that we never reuse (and truncate) the log of a previous seed
+    '''
+    base=os.path.join(self.workdir,self.LOGFILE+"."+self._nowTs(True))
+    rt=base
+    count=0
+    while os.path.exists(rt) or os.path.exists(rt+self.GZSUFFIX):
+      count+=1
+      rt="%s-%02d"%(base,count)
+    return rt
   def _writeInfoFile(self):
     info={
       'selection':self.selectionName,
-      'caches': self.cacheNames or []
+      'caches': self.cacheNames or [],
+      'tiles': self.numTiles,
+      'runtime': self.runtime,
+      'concurrency': self.concurrency,
+      'tilesDone': self.tilesDone,
+      'bytesDone': self.bytesDone
     }
     try:
       with open(self._infoFile(),"w") as fh:
@@ -120,6 +256,11 @@ class SeedRunner(object):
         info=yaml.safe_load(fh)
         self.cacheNames=info.get('caches',[])
         self.selectionName=info.get('selection','')
+        self.numTiles=info.get('tiles')
+        self.runtime=info.get('runtime',0)
+        self.concurrency=info.get('concurrency',self.DEFAULT_CONCURRENCY)
+        self.tilesDone=info.get('tilesDone',0)
+        self.bytesDone=info.get('bytesDone',0)
     except Exception as e:
       pass
 
@@ -142,41 +283,169 @@ class SeedRunner(object):
         with open(self._currentConfig(),"w") as fh:
           yaml.safe_dump(newConfig,fh)
       self.currentLog=self._logFile()
-      loghandle=open(self.currentLog,"w")
       self.logInfo("starting new seed")
-      env=os.environ.copy()
-      env[ENV_PID]=str(os.getpid())
-      self.child=subprocess.Popen([sys.executable,
-                                 __file__,
-                                 '-s', self._currentConfig(),
-                                 '-f',self.configFile,
-                                 '-p',",".join(self.configDirs),
-                                 '-c','1',
-                                 '--progress-file', self._progressFile(),
-                                   '--continue'],
-                                  env=env,
-                                  stdout=loghandle,
-                                  stderr=subprocess.STDOUT,
-                                  stdin=subprocess.DEVNULL,
-                                  preexec_fn=os.setsid)
+      try:
+        os.unlink(self._statusFile())
+      except:
+        pass
+      args=['-s', self._currentConfig(),
+            '-f',self.configFile,
+            '-c',str(self.concurrency),
+            '--progress-file', self._progressFile(),
+            '--continue']
+      self.child=None
+      if self.server is not None:
+        open(self.currentLog,"w").close()
+        try:
+          self.child=self.server.startSeed(args,self.currentLog)
+        except Exception as e:
+          self.logError("unable to start seed in seed server, starting a new process: %s",str(e))
+      if self.child is None:
+        self._startProcess(args)
+      self.startTime=time.monotonic()
       self._writeInfoFile()
       self.seedStatus=self.STATE_RUNNING
       self.info="started at %s"%self._nowTs()
+      waiter=threading.Thread(target=self._waitForChild,args=(self.child,self.currentLog),name="seed-waiter")
+      waiter.daemon=True
+      waiter.start()
       return True
     finally:
       self.currentlyStarting=False
 
+  def _logSize(self,fh):
+    '''
+    the (uncompressed) size of an open log file (see _openLog)
+    '''
+    fileSize=os.fstat(fh.fileno()).st_size
+    if not isinstance(fh,gzip.GzipFile):
+      return fileSize
+    #gzip stores the size (mod 2^32) in the last 4 bytes
+    return struct.unpack('<I',os.pread(fh.fileno(),4,fileSize-4))[0]
+
+  def _compressLog(self,fname):
+    tmp=fname+self.GZSUFFIX+".tmp"
+    with open(fname,'rb') as ih, gzip.open(tmp,'wb') as oh:
+      shutil.copyfileobj(ih,oh)
+    os.replace(tmp,fname+self.GZSUFFIX)
+    os.unlink(fname)
+    return fname+self.GZSUFFIX
+
+  def _startProcess(self,args):
+    '''
+    run the seed in a new process
+    '''
+    env=os.environ.copy()
+    #the child will get EOF on this pipe when we are gone
+    (readFd,writeFd)=os.pipe()
+    env[ENV_PIPE]=str(readFd)
+    env[ENV_STATUS]=self._statusFile()
+    if self.rateLimitDir is not None:
+      env[ENV_RATELIMIT]=self.rateLimitDir
+    try:
+      open(self.currentLog,"w").close()
+      self.child=subprocess.Popen([sys.executable,
+                                   __file__,
+                                   '-p',",".join(self.configDirs)]+args,
+                                  env=env,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  stdin=subprocess.DEVNULL,
+                                  pass_fds=(readFd,),
+                                  preexec_fn=os.setsid)
+    except Exception:
+      os.close(writeFd)
+      raise
+    finally:
+      os.close(readFd)
+    self.parentPipe=writeFd
+
+  def _notifyLogReaders(self):
+    with self.logCondition:
+      self.logCondition.notify_all()
+
+  def _copyOutput(self,pipe,logFile):
+    '''
+    write the output of a seed process to its log
+    and wake up the readers waiting for new data
+    returns at EOF (i.e. when the seed and its workers are gone)
+    '''
+    try:
+      with open(logFile,"ab") as fh:
+        while True:
+          data=os.read(pipe.fileno(),65536)
+          if not data:
+            break
+          fh.write(data)
+          fh.flush()
+          self._notifyLogReaders()
+    except Exception as e:
+      self.logError("unable to write seed log %s: %s",logFile,str(e))
+      #do not block the seed
+      while os.read(pipe.fileno(),65536):
+        pass
+    finally:
+      pipe.close()
+
+  def _waitForChild(self,child,logFile):
+    if child.stdout is not None:
+      self._copyOutput(child.stdout,logFile)
+    child.wait()
+    try:
+      self.checkRunning()
+    except Exception as e:
+      self.logError("error when handling end of seed: %s",str(e))
+
   def cleanupLogs(self):
-    logs=list(filter(lambda e: e.startswith(self.LOGFILE),os.listdir(self.workdir)))
-    logs.sort()
-    logs=logs[0:-self.keepLogs]
+    '''
+    compress finished logs and remove old ones
+    we keep at most keepLogs logs with at most keepLogBytes (on disk),
+    the newest log is always kept
+    '''
+    logs=[f for f in os.listdir(self.workdir) if f.startswith(self.LOGFILE) and not f.endswith('.tmp')]
+    logs.sort(reverse=True)
+    numLogs=0
+    totalSize=0
     for l in logs:
       fn=os.path.join(self.workdir,l)
       try:
-        self.logInfo("removing seed log %s",fn)
-        os.unlink(fn)
-      except:
-        pass
+        #a new seed could have been started meanwhile
+        if not l.endswith(self.GZSUFFIX) and not self._isActiveLog(l):
+          if l+self.GZSUFFIX in logs:
+            #leftover from an interrupted compression
+            os.unlink(fn)
+            continue
+          fn=self._compressLog(fn)
+        size=os.path.getsize(fn)
+        numLogs+=1
+        totalSize+=size
+        if numLogs > 1 and (numLogs > self.keepLogs or totalSize > self.keepLogBytes):
+          self.logInfo("removing seed log %s",fn)
+          os.unlink(fn)
+      except Exception as e:
+        self.logError("unable to clean up seed log %s: %s",fn,str(e))
+
+  def _isActiveLog(self,name):
+    '''
+    check if name is the log of a seed that is running or currently starting
+    '''
+    with self.lock:
+      if self.currentLog is None:
+        return False
+      if self.child is None and not self.currentlyStarting:
+        return False
+      return os.path.basename(self.currentLog) == name
+
+  def startCleanupLogs(self):
+    '''
+    run cleanupLogs in a background thread
+    '''
+    with self.cleanupLock:
+      if self.cleanupThread is not None and self.cleanupThread.is_alive():
+        return
+      self.cleanupThread=threading.Thread(target=self.cleanupLogs,name="seed-log-cleanup")
+      self.cleanupThread.daemon=True
+      self.cleanupThread.start()
 
   def checkRestart(self):
     '''
@@ -191,14 +460,168 @@ class SeedRunner(object):
         os.unlink(self._progressFile())
       except:
         pass
-      return False
+      return self._startNext()
     self._readFromInfo()
     return self._startSeed()
-  def runSeed(self,seedConfig,cacheNames=None,selectionName=None):
+
+  def _readQueue(self):
+    '''
+    read the queue file - only called once at startup
+    an unreadable file is renamed so that it will not be overwritten
+    '''
+    fname=self._queueFile()
+    if not os.path.exists(fname):
+      return []
+    try:
+      with open(fname,"r") as fh:
+        rt=yaml.safe_load(fh)
+      if rt is None:
+        return []
+      if not isinstance(rt,list):
+        raise Exception("invalid queue format")
+      return rt
+    except Exception as e:
+      badName=fname+"."+self._nowTs()+".bad"
+      self.logError("unable to read queue %s: %s, renaming to %s",fname,str(e),badName)
+      try:
+        os.replace(fname,badName)
+      except Exception as e:
+        self.logError("unable to rename %s: %s",fname,str(e))
+    return []
+
+  def _writeQueue(self,queue):
+    tmp=self._queueFile()+".tmp"
+    with open(tmp,"w") as fh:
+      yaml.safe_dump(queue,fh)
+    os.replace(tmp,self._queueFile())
+
+  def _insertJob(self,queue,job):
+    '''
+    insert a job behind all jobs with the same or a higher priority
+    '''
+    pos=len(queue)
+    for idx in range(0,len(queue)):
+      if queue[idx].get('priority',0) < job.get('priority',0):
+        pos=idx
+        break
+    queue.insert(pos,job)
+
+  def queueSeed(self,seedConfig,cacheNames=None,selectionName=None,numTiles=None,concurrency=None,priority=0):
+    '''
+    add a seed to the job queue
+    it will be started when the seeds queued before
+    (with the same or a higher priority) are finished
+    :param priority: higher priorities are started first
+    :return: (jobId,started)
+    '''
+    with self.queueLock:
+      queue=list(self.queue)
+      jobId=max([int(time.time()*1000)]+[j.get('id',0)+1 for j in queue])
+      self._insertJob(queue,{
+        'id':jobId,
+        'priority':int(priority or 0),
+        'seeds':seedConfig,
+        'caches':cacheNames or [],
+        'selection':selectionName,
+        'tiles':numTiles,
+        'concurrency':concurrency,
+        'queued':self._nowTs()
+      })
+      self._writeQueue(queue)
+      self.queue=queue
+    self.logInfo("queued seed %d for %s",jobId,selectionName)
+    self.checkRunning()
+    self._startNext()
+    started=not any(j.get('id') == jobId for j in self.getQueue())
+    return (jobId,started)
+
+  def _startNext(self):
+    '''
+    start the first job from the queue if no seed is running or paused
+    :return: True if a job has been started
+    '''
+    with self.queueLock:
+      if self.child is not None or self.pause or os.path.exists(self._currentConfig()):
+        return False
+      if len(self.queue) < 1:
+        return False
+      queue=list(self.queue)
+      job=queue.pop(0)
+      self._writeQueue(queue)
+      self.queue=queue
+    self.logInfo("starting queued seed %d for %s",job.get('id'),job.get('selection'))
+    try:
+      self.runSeed(job.get('seeds'),job.get('caches'),
+                   selectionName=job.get('selection'),
+                   numTiles=job.get('tiles'),
+                   concurrency=job.get('concurrency'))
+    except (OtherRunningException,PausedException):
+      with self.queueLock:
+        queue=[job]+self.queue
+        self._writeQueue(queue)
+        self.queue=queue
+      return False
+    except Exception as e:
+      self.logError("unable to start queued seed %d: %s",job.get('id'),str(e))
+      return False
+    return True
+
+  def removeJob(self,jobId):
+    '''
+    remove a job from the queue
+    :return: True if found
+    '''
+    with self.queueLock:
+      rest=[j for j in self.queue if j.get('id') != jobId]
+      if len(rest) == len(self.queue):
+        return False
+      self._writeQueue(rest)
+      self.queue=rest
+    return True
+
+  def setJobPriority(self,jobId,priority):
+    '''
+    change the priority of a queued job
+    :return: True if found
+    '''
+    with self.queueLock:
+      queue=list(self.queue)
+      for idx in range(0,len(queue)):
+        if queue[idx].get('id') == jobId:
+          job=queue.pop(idx).copy()
+          job['priority']=int(priority)
+          self._insertJob(queue,job)
+          self._writeQueue(queue)
+          self.queue=queue
+          return True
+    return False
+
+  def getQueue(self):
+    '''
+    the queued jobs (without the seed configs)
+    '''
+    with self.queueLock:
+      queue=self.queue
+    rt=[]
+    for job in queue:
+      entry=job.copy()
+      entry.pop('seeds',None)
+      rt.append(entry)
+    return rt
+  def runSeed(self,seedConfig,cacheNames=None,selectionName=None,numTiles=None,concurrency=None):
+    '''
+    start a new seed
+    :param concurrency: the number of parallel seed workers
+    '''
     if self.checkRunning():
       raise OtherRunningException()
+    self.concurrency=max(1,int(concurrency)) if concurrency else self.DEFAULT_CONCURRENCY
     self.cacheNames=cacheNames
     self.selectionName=selectionName
+    self.numTiles=numTiles
+    self.runtime=0
+    self.tilesDone=0
+    self.bytesDone=0
     self._startSeed(seedConfig)
 
   def killRun(self,setPaused=False):
@@ -210,8 +633,8 @@ class SeedRunner(object):
         self.info="seed stopped while paused"
       return False
     self.pause=setPaused
-    pgrp = os.getpgid(self.child.pid)
-    os.killpg(pgrp, signal.SIGINT)
+    #seeds run in an own process group with their pid as id
+    os.killpg(child.pid, signal.SIGINT)
     wt=10
     while wt > 0:
       if not self.checkRunning():
@@ -237,15 +660,23 @@ class SeedRunner(object):
       os.unlink(self._infoFile())
     except:
       pass
+    try:
+      os.unlink(self._statusFile())
+    except:
+      pass
 
 
   def checkRunning(self):
     '''
-    must be called regularly to check if
-    a seed is finished
-    will reset
+    check if a seed is finished
+    will be called by the waiter thread when the child exits,
+    can be called at any time
     :return:
     '''
+    with self.checkLock:
+      return self._checkRunning()
+
+  def _checkRunning(self):
     if self.child is None:
       return False
     rt=self.child.poll()
@@ -255,11 +686,25 @@ class SeedRunner(object):
       self.logInfo("seed paused")
     else:
       self.logInfo("seed finished with status %d",rt)
+    if self.startTime is not None:
+      self.runtime+=time.monotonic()-self.startTime
+      self.startTime=None
+    status=self._readStatus()
+    if status is not None:
+      self.tilesDone+=status.get('tiles') or 0
+      self.bytesDone+=status.get('bytes') or 0
     self.lock.acquire()
     try:
       if not self.pause:
         self._cleanupFiles()
+        if rt == 0:
+          self._addHistory()
+      else:
+        self._writeInfoFile()
       self.child=None
+      if self.parentPipe is not None:
+        os.close(self.parentPipe)
+        self.parentPipe=None
       if self.pause:
         self.seedStatus=self.STATE_INACTIVE
         self.info="seed paused"
@@ -272,9 +717,99 @@ class SeedRunner(object):
           self.info="seed returned with state %d at %s"%(rt,self._nowTs())
     finally:
       self.lock.release()
-    self.cleanupLogs()
+    self._notifyLogReaders()
+    self.startCleanupLogs()
+    if self.finishedCallback is not None:
+      try:
+        self.finishedCallback()
+      except Exception as e:
+        self.logError("error in seed finished callback: %s",str(e))
+    if not self.pause:
+      self._startNext()
     return False
 
+  def _readStatus(self):
+    try:
+      with open(self._statusFile(),"r") as fh:
+        return json.load(fh)
+    except Exception:
+      return None
+
+  def getProgress(self):
+    '''
+    the progress of the running seed as written by the seed process
+    tiles and bytes include the runs before a pause
+    :return: dict or None if no seed is running
+    '''
+    if self.child is None:
+      return None
+    status=self._readStatus()
+    if status is None:
+      return None
+    tiles=status.get('tiles') or 0
+    elapsed=status.get('elapsed') or 0
+    rt={
+      'seed':status.get('seed'),
+      'cache':status.get('cache'),
+      'zoom':status.get('zoom'),
+      'taskProgress':status.get('taskProgress'),
+      'tiles':self.tilesDone+tiles,
+      'total':self.numTiles,
+      'bytes':self.bytesDone+(status.get('bytes') or 0),
+      'tilesPerSecond':tiles/elapsed if elapsed > 0 else None,
+      'eta':None
+    }
+    if self.numTiles and rt['tilesPerSecond']:
+      rt['eta']=int(max(0,self.numTiles-rt['tiles'])/rt['tilesPerSecond'])
+    return rt
+
+  def _readHistory(self):
+    try:
+      with open(self._historyFile(),"r") as fh:
+        rt=yaml.safe_load(fh)
+        if isinstance(rt,list):
+          return rt
+    except Exception:
+      pass
+    return []
+
+  def _addHistory(self):
+    '''
+    remember the number of tiles and the runtime of a finished seed
+    '''
+    if not self.numTiles or self.runtime <= 0:
+      return
+    history=self._readHistory()
+    history.append({
+      'caches':self.cacheNames or [],
+      'tiles':self.numTiles,
+      'runtime':self.runtime,
+      'finished':self._nowTs()
+    })
+    history=history[-self.KEEP_HISTORY:]
+    try:
+      with open(self._historyFile(),"w") as fh:
+        yaml.safe_dump(history,fh)
+    except Exception as e:
+      self.logError("unable to write seed history: %s",str(e))
+
+  def getThroughput(self,cacheNames):
+    '''
+    get the seed speed from previous seeds that used one of the caches
+    :param cacheNames:
+    :return: tiles/s or None if unknown
+    '''
+    tiles=0
+    runtime=0
+    for entry in self._readHistory():
+      if not set(entry.get('caches',[])) & set(cacheNames):
+        continue
+      tiles+=entry.get('tiles',0)
+      runtime+=entry.get('runtime',0)
+    if tiles <= 0 or runtime <= 0:
+      return None
+    return tiles/runtime
+
   def getStatus(self):
     return {
       'status':self.seedStatus,
@@ -282,60 +817,517 @@ class SeedRunner(object):
       'name':self.cacheNames,
       'selection': self.selectionName,
       'paused':self.pause,
+      'concurrency':self.concurrency,
+      'queue':self.getQueue(),
+      'progress':self.getProgress(),
       'logFile':os.path.basename(self.currentLog) if self.currentLog is not None else None
     }
 
+  def _logPath(self,name):
+    '''
+    the path of a log file, None if the name is invalid or the file does not exist
+    for compressed logs the path of the compressed file
+    '''
+    if name is None or os.path.basename(name) != name or not name.startswith(self.LOGFILE):
+      return None
+    if name.endswith(self.GZSUFFIX):
+      name=name[0:-len(self.GZSUFFIX)]
+    fname=os.path.join(self.workdir,name)
+    for candidate in [fname,fname+self.GZSUFFIX]:
+      if os.path.isfile(candidate):
+        return candidate
+    return None
+
+  def _openLog(self,name,raw=False):
+    '''
+    open a log file (binary mode), compressed logs are uncompressed while reading
+    the handle stays valid if cleanupLogs compresses or removes the log meanwhile
+    :param raw: do not uncompress
+    :return: the handle or None if the log does not exist
+    '''
+    for retry in range(0,2):
+      fname=self._logPath(name)
+      if fname is None:
+        return None
+      try:
+        if fname.endswith(self.GZSUFFIX) and not raw:
+          return gzip.open(fname,'rb')
+        return open(fname,'rb')
+      except FileNotFoundError:
+        #compressed just now - try again with the new name
+        pass
+    return None
+
+  def getCompressedLog(self,name):
+    '''
+    an open handle for the compressed log file (the raw gzip data),
+    None if the log is not compressed
+    '''
+    fh=self._openLog(name,raw=True)
+    if fh is not None and not fh.name.endswith(self.GZSUFFIX):
+      fh.close()
+      return None
+    return fh
+
   def getLogFile(self,name,bytesFromEnd=None):
     '''
     get an open handle for the logfile (binary mode)
+    compressed logs are uncompressed while reading
     :param name:
     :return:
     '''
-    if name is None:
+    fh=self._openLog(name)
+    if fh is None:
       return
-    for f in os.listdir(self.workdir):
-      if not f.startswith(self.LOGFILE):
+    size=self._logSize(fh)
+    if bytesFromEnd is not None:
+      if bytesFromEnd> size:
+        bytesFromEnd=size
+      fh.seek(size-bytesFromEnd)
+    return fh
+
+  def isLogActive(self,name):
+    '''
+    check if a log file is still written by a running seed
+    '''
+    return (self.child is not None and self.currentLog is not None
+            and os.path.basename(self.currentLog) == name)
+
+  @classmethod
+  def _utf8Boundary(cls,data):
+    '''
+    the length of data without an incomplete utf-8 sequence at the end
+    '''
+    for back in range(1,min(4,len(data))+1):
+      c=data[-back]
+      if c & 0xc0 == 0x80:
+        #continuation byte
         continue
-      if f == name:
-        fname=os.path.join(self.workdir,f)
-        st=os.stat(fname)
-        size=st.st_size
-        fh=open(fname,'rb')
-        if bytesFromEnd is not None:
-          if bytesFromEnd> size:
-            bytesFromEnd=size
-          spos=size-bytesFromEnd
-          fh.seek(spos)
-        return fh
+      if c & 0x80 == 0:
+        return len(data)
+      needed=2 if c & 0xe0 == 0xc0 else 3 if c & 0xf0 == 0xe0 else 4
+      return len(data) if back >= needed else len(data)-back
+    return len(data)
+
+  def readLog(self,name,offset=None,maxBytes=100000,wait=0):
+    '''
+    read the next part of a log file
+    :param offset: the position to start at, None to get the last maxBytes
+    :param maxBytes: the max number of bytes to return
+    :param wait: max time (s) to wait for new data if the log is still written,
+                 limited to MAX_LOG_WAIT
+    :return: (data,start,next) or None if the log does not exist
+    '''
+    fh=self._openLog(name)
+    if fh is None:
+      return None
+    with fh:
+      size=self._logSize(fh)
+      if offset is None:
+        offset=max(0,size-maxBytes)
+      offset=max(0,min(offset,size))
+      end=time.monotonic()+min(wait,self.MAX_LOG_WAIT)
+      with self.logCondition:
+        while size <= offset and self.isLogActive(name):
+          remaining=end-time.monotonic()
+          if remaining <= 0:
+            break
+          self.logCondition.wait(remaining)
+          size=self._logSize(fh)
+      if size <= offset:
+        return (b'',offset,offset)
+      fh.seek(offset)
+      data=fh.read(min(maxBytes,size-offset))
+    data=data[0:self._utf8Boundary(data)]
+    return (data,offset,offset+len(data))
+
+
+
+class SeedChild(object):
+  '''
+  a seed started by the seed server
+  provides the parts of subprocess.Popen the runner uses
+  '''
+  def __init__(self,pid):
+    self.pid=pid
+    self.returncode=None
+    #the output is written to the log by the server
+    self.stdout=None
+    self.condition=threading.Condition()
+
+  def setExit(self,returncode):
+    with self.condition:
+      self.returncode=returncode
+      self.condition.notify_all()
+
+  def poll(self):
+    return self.returncode
 
+  def wait(self):
+    with self.condition:
+      while self.returncode is None:
+        self.condition.wait()
+      return self.returncode
+
+
+class SeedServerClient(object):
+  '''
+  starts and talks to the seed server (see SeedServer)
+  the server is started on the first seed and kept running
+  '''
+  START_TIMEOUT=60
+  LOGFILE="seed-server.log"
+  def __init__(self,workdir,configFile,configDirs,statusFile,logHandler=None,outputCallback=None,
+               rateLimitDir=None):
+    '''
+    :param outputCallback: called (without parameters) when the server has written seed output to the log
+    '''
+    self.workdir=workdir
+    self.configFile=configFile
+    self.configDirs=configDirs
+    self.statusFile=statusFile
+    self.rateLimitDir=rateLimitDir
+    self.logHandler=logHandler
+    self.outputCallback=outputCallback
+    self.lock=threading.Lock()
+    self.condition=threading.Condition()
+    self.process=None
+    self.sock=None
+    self.requestId=0
+    self.started={}
+    self.children={}
+
+  def logInfo(self,fmt,*args):
+    if (self.logHandler):
+      self.logHandler.log(fmt,*args)
+
+  def _ensureServer(self):
+    if self.process is not None and self.process.poll() is None and self.sock is not None:
+      return
+    (mine,theirs)=socket.socketpair()
+    env=os.environ.copy()
+    env[ENV_PIPE]=str(theirs.fileno())
+    env[ENV_STATUS]=self.statusFile
+    if self.rateLimitDir is not None:
+      env[ENV_RATELIMIT]=self.rateLimitDir
+    self.logInfo("starting seed server")
+    with open(os.path.join(self.workdir,self.LOGFILE),"w") as loghandle:
+      try:
+        self.process=subprocess.Popen([sys.executable,
+                                       __file__,
+                                       '--server',
+                                       '-f',self.configFile,
+                                       '-p',",".join(self.configDirs)],
+                                      env=env,
+                                      stdout=loghandle,
+                                      stderr=subprocess.STDOUT,
+                                      stdin=subprocess.DEVNULL,
+                                      pass_fds=(theirs.fileno(),),
+                                      preexec_fn=os.setsid)
+      except Exception:
+        mine.close()
+        raise
+      finally:
+        theirs.close()
+    self.sock=mine
+    reader=threading.Thread(target=self._reader,args=(mine,),name="seed-server-reader")
+    reader.daemon=True
+    reader.start()
+
+  def _reader(self,sock):
+    try:
+      for line in sock.makefile('r'):
+        message=json.loads(line)
+        with self.condition:
+          if 'started' in message:
+            child=SeedChild(message['started'])
+            self.children[child.pid]=child
+            self.started[message.get('id')]=child
+            self.condition.notify_all()
+          elif 'failed' in message:
+            self.started[message['failed']]=Exception(message.get('error'))
+            self.condition.notify_all()
+          elif 'exit' in message:
+            child=self.children.pop(message['exit'],None)
+            if child is not None:
+              child.setExit(message.get('status'))
+        if 'output' in message and self.outputCallback is not None:
+          self.outputCallback()
+    except Exception:
+      pass
+    #server is gone
+    with self.condition:
+      if self.sock is sock:
+        self.sock=None
+      for child in self.children.values():
+        child.setExit(-1)
+      self.children={}
+      self.condition.notify_all()
+    sock.close()
+
+  def startSeed(self,args,logFile):
+    '''
+    start a seed in the server
+    :param args: the parameters for mapproxy-seed
+    :param logFile: the file for the output of the seed
+    :return: a SeedChild
+    '''
+    with self.lock:
+      self._ensureServer()
+      self.requestId+=1
+      requestId=self.requestId
+      request={'cmd':'seed','id':requestId,'args':args,'log':logFile}
+      self.sock.sendall((json.dumps(request)+"\n").encode('utf-8'))
+      end=time.monotonic()+self.START_TIMEOUT
+      with self.condition:
+        while requestId not in self.started:
+          wait=end-time.monotonic()
+          if wait <= 0 or self.sock is None:
+            raise Exception("seed server did not start the seed")
+          self.condition.wait(wait)
+        rt=self.started.pop(requestId)
+        if isinstance(rt,Exception):
+          raise rt
+        return rt
+
+  def stop(self):
+    with self.lock:
+      sock=self.sock
+      self.sock=None
+      if sock is not None:
+        #the reader still holds the socket, shutdown makes the server see EOF
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+        sock.close()
+
+
+class SeedServer(object):
+  '''
+  a long running process that keeps mapproxy imported
+  this only saves the interpreter start and the imports for each seed,
+  the forked seeds still load the mapproxy configuration themselves
+  seeds are run in forked children (each in an own process group),
+  requests and answers are json lines on the socket from the runner
+  the server does not start any threads so that it is safe to fork,
+  ended children are reaped in the main loop (woken up by SIGCHLD)
+  and the output of the children is copied to their logs there
+  when the socket is closed (runner gone) the running seeds are stopped
+  '''
+  STOP_TIMEOUT=10
+  def __init__(self,cfgFile,cfgDirs,sock,statusFile=None,rateLimitDir=None):
+    self.cfgFile=cfgFile
+    self.sock=sock
+    self.children=set()
+    #read end of the output pipe -> (pid,log fd)
+    self.outputs={}
+    self.byteCounter=None
+    if statusFile is not None:
+      #shared with the forked seeds and their workers
+      self.byteCounter=multiprocessing.Value('q',0)
+    self.injector=injector.Injector(cfgDirs,rateLimiter=injector.RateLimiter(rateLimitDir),
+                                    byteCounter=self.byteCounter)
+    from pkg_resources import load_entry_point
+    self.seedMain=load_entry_point('MapProxy', 'console_scripts', 'mapproxy-seed')
+    if statusFile is not None:
+      installStatusLog(statusFile,self.byteCounter)
+    (self.wakeupRead,self.wakeupWrite)=os.pipe()
+    os.set_blocking(self.wakeupRead,False)
+    os.set_blocking(self.wakeupWrite,False)
+
+  def _send(self,message):
+    try:
+      self.sock.sendall((json.dumps(message)+"\n").encode('utf-8'))
+    except OSError:
+      #runner gone, we will get EOF
+      pass
+
+  def _runChild(self,request,outFd):
+    status=1
+    try:
+      os.setpgid(0,0)
+      signal.set_wakeup_fd(-1)
+      signal.signal(signal.SIGCHLD,signal.SIG_DFL)
+      os.close(self.wakeupRead)
+      os.close(self.wakeupWrite)
+      for fd,(pid,logFd) in self.outputs.items():
+        os.close(fd)
+        os.close(logFd)
+      self.sock.close()
+      os.dup2(outFd,1)
+      os.dup2(outFd,2)
+      os.close(outFd)
+      if self.byteCounter is not None:
+        self.byteCounter.value=0
+      self.injector.checkCreatedIfNeeded(self.cfgFile)
+      sys.argv=['mapproxy-seed']+request['args']
+      status=self.seedMain()
+    except SystemExit as e:
+      status=e.code
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      if status is None:
+        status=0
+      elif not isinstance(status,int):
+        print(status)
+        status=1
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+
+  def _startChild(self,request):
+    logFd=os.open(request['log'],os.O_WRONLY|os.O_CREAT|os.O_APPEND,0o644)
+    (outRead,outWrite)=os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid=os.fork()
+    if pid == 0:
+      os.close(outRead)
+      os.close(logFd)
+      self._runChild(request,outWrite)
+    os.close(outWrite)
+    os.set_blocking(outRead,False)
+    self.outputs[outRead]=(pid,logFd)
+    #set the group here as well, so it is set before the runner gets the pid
+    try:
+      os.setpgid(pid,pid)
+    except OSError:
+      #child has already done this or is gone
+      pass
+    self.children.add(pid)
+    self._send({'started':pid,'id':request.get('id')})
+
+  def _readOutput(self,fd):
+    '''
+    copy the available output of a child to its log
+    '''
+    (pid,logFd)=self.outputs[fd]
+    written=False
+    while True:
+      try:
+        data=os.read(fd,65536)
+      except BlockingIOError:
+        break
+      if not data:
+        os.close(fd)
+        os.close(logFd)
+        del self.outputs[fd]
+        break
+      try:
+        os.write(logFd,data)
+        written=True
+      except OSError as e:
+        print("unable to write log for %d: %s"%(pid,str(e)))
+    if written:
+      self._send({'output':pid})
+
+  def _reapChildren(self):
+    while len(self.children) > 0:
+      try:
+        (pid,status)=os.waitpid(-1,os.WNOHANG)
+      except ChildProcessError:
+        return
+      if pid == 0:
+        return
+      self.children.discard(pid)
+      #the log is complete before the runner gets the exit
+      for fd in [fd for fd,(outPid,_) in self.outputs.items() if outPid == pid]:
+        self._readOutput(fd)
+      self._send({'exit':pid,'status':exitCode(status)})
+
+  def _handleReadable(self,readable):
+    for fd in readable:
+      if fd in self.outputs:
+        self._readOutput(fd)
+    if self.wakeupRead in readable:
+      try:
+        while os.read(self.wakeupRead,1024):
+          pass
+      except BlockingIOError:
+        pass
+    self._reapChildren()
+
+  def run(self):
+    signal.set_wakeup_fd(self.wakeupWrite)
+    #the handler is only needed to get the wakeup
+    signal.signal(signal.SIGCHLD,lambda signum,frame: None)
+    buffer=b''
+    while True:
+      (readable,_,_)=select.select([self.sock,self.wakeupRead]+list(self.outputs),[],[])
+      self._handleReadable(readable)
+      if self.sock not in readable:
+        continue
+      data=self.sock.recv(65536)
+      if not data:
+        break
+      buffer+=data
+      while b'\n' in buffer:
+        (line,buffer)=buffer.split(b'\n',1)
+        request=json.loads(line)
+        if request.get('cmd') == 'seed':
+          try:
+            self._startChild(request)
+          except Exception as e:
+            print("unable to start seed: %s"%str(e))
+            sys.stdout.flush()
+            self._send({'failed':request.get('id'),'error':str(e)})
+    print("runner not available any more, stopping")
+    sys.stdout.flush()
+    for pid in list(self.children):
+      try:
+        os.killpg(pid,signal.SIGINT)
+      except Exception:
+        pass
+    end=time.monotonic()+self.STOP_TIMEOUT
+    while len(self.children) > 0 and time.monotonic() < end:
+      (readable,_,_)=select.select([self.wakeupRead]+list(self.outputs),[],[],0.1)
+      self._handleReadable(readable)
+    for fd in list(self.outputs):
+      self._readOutput(fd)
 
 
 class SeedMain(object):
+  STOP_TIMEOUT=10
   def __init__(self):
     self.status=-1
-    self.runner=None
   def start(self):
     from pkg_resources import load_entry_point
     self.status = load_entry_point('MapProxy', 'console_scripts', 'mapproxy-seed')()
     return self.status
-  def startThread(self):
-    self.runner = threading.Thread(target=self.start)
-    self.runner.setDaemon(True)
-    self.runner.start()
-  def isAlive(self):
-    if self.runner is None:
-      return False
-    return self.runner.is_alive()
+  def watchParent(self,fd):
+    '''
+    stop the seed when the parent is gone
+    fd is the read end of a pipe whose write end is only held by the parent,
+    so the read returns EOF as soon as the parent exits
+    '''
+    def watch():
+      try:
+        while os.read(fd,1024):
+          pass
+      except OSError:
+        pass
+      print("parent not available any more, stopping")
+      sys.stdout.flush()
+      os.killpg(os.getpgid(os.getpid()),signal.SIGINT)
+      time.sleep(self.STOP_TIMEOUT)
+      os._exit(1)
+    watcher=threading.Thread(target=watch,name="parent-watcher")
+    watcher.daemon=True
+    watcher.start()
 
 
 if __name__ == '__main__':
   #we run mapproxy seed
-  #if we have an ENV_PID in the environment we exit if this pid is not available
+  #if we have an ENV_PIPE in the environment we exit when the parent closes this pipe
+  #with --server we run the seed server, ENV_PIPE is the socket to the runner then
   cfgFile=None
   seedFile=None
   lastFlag=None
   cfgDirs=''
   hasP=False
+  serverMode='--server' in sys.argv
   for arg in sys.argv[1:]:
     if arg == '-f' or arg == '-s' or arg == '-p':
       lastFlag=arg
@@ -352,7 +1344,7 @@ if __name__ == '__main__':
   if not cfgFile:
     print("no parameter -f found",file=sys.stderr)
     sys.exit(1)
-  if not seedFile:
+  if not seedFile and not serverMode:
     print("no parameter -s found",file=sys.stderr)
     sys.exit(1)
   if hasP:
@@ -360,29 +1352,25 @@ if __name__ == '__main__':
     sys.argv.remove(cfgDirs)
   cfgDirs=cfgDirs.split(',')
   cfgDirs.append(os.path.dirname(cfgFile))  
-  injector=injector.Injector(cfgDirs)
+  if serverMode:
+    sock=socket.socket(fileno=int(os.environ[ENV_PIPE]))
+    SeedServer(cfgFile,cfgDirs,sock,os.environ.get(ENV_STATUS),os.environ.get(ENV_RATELIMIT)).run()
+    sys.exit(0)
+  statusFile=os.environ.get(ENV_STATUS)
+  byteCounter=None
+  if statusFile is not None:
+    #shared with the forked seed workers
+    byteCounter=multiprocessing.Value('q',0)
+  injector=injector.Injector(cfgDirs,rateLimiter=injector.RateLimiter(os.environ.get(ENV_RATELIMIT)),
+                             byteCounter=byteCounter)
   injector.checkCreatedIfNeeded(cfgFile)
+  if statusFile is not None:
+    try:
+      installStatusLog(statusFile,byteCounter)
+    except Exception as e:
+      print("unable to install status log: %s"%str(e))
   seedMain=SeedMain()
-  parentPid=os.environ.get(ENV_PID)
-  if parentPid is not None:
-    parentPid=int(parentPid)
-    print("start checking parent pid %d"%parentPid)
-    seedMain.startThread()
-    while True:
-      try:
-        rs = os.kill(parentPid, 0)
-      except:
-        # pid not there any more
-        print("parent pid %d not available any more, stopping" % parentPid)
-        pgrp = os.getpgid(os.getpid())
-        os.killpg(pgrp, signal.SIGINT)
-        sys.exit(1)
-      if not seedMain.isAlive():
-        print("main thread stopped, exiting")
-        sys.exit(seedMain.status)
-      time.sleep(0.5)
-  else:
-    sys.exit(seedMain.start())
-
-
-
+  parentPipe=os.environ.get(ENV_PIPE)
+  if parentPipe is not None:
+    seedMain.watchParent(int(parentPipe))
+  sys.exit(seedMain.start())
@@ -0,0 +1,2 @@
+# the other files in this directory are manual scripts that expect command line arguments
+collect_ignore=['test_seed_runner.py','pyssltest.py']
@@ -0,0 +1,418 @@
+#! /usr/bin/env python3
+import math
+import mmap
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+import create_seed
+
+
+def cells(rects):
+  '''
+  the unit cells covered by integer rectangles (x0,y0,x1,y1) - x1,y1 exclusive
+  '''
+  rt=set()
+  for (x0,y0,x1,y1) in rects:
+    for x in range(int(x0),int(x1)):
+      for y in range(int(y0),int(y1)):
+        rt.add((x,y))
+  return rt
+
+def randomRects(rnd,num,size=20,maxExtent=8):
+  rt=[]
+  for i in range(num):
+    x0=rnd.randint(0,size-1)
+    y0=rnd.randint(0,size-1)
+    rt.append((x0,y0,x0+rnd.randint(1,maxExtent),y0+rnd.randint(1,maxExtent)))
+  return rt
+
+
+class TestDeg2Num(unittest.TestCase):
+  def borderPoints(self):
+    lats=[]
+    lngs=[]
+    zooms=[]
+    for zoom in range(0,21):
+      n=2**zoom
+      for t in list(range(0,n,max(1,n//200)))+[n-1]:
+        (lat,lng)=create_seed.num2deg(t,t,zoom)
+        for (dlat,dlng) in [(lat,lng),
+                            (math.nextafter(lat,90),math.nextafter(lng,180)),
+                            (math.nextafter(lat,-90),math.nextafter(lng,-180))]:
+          lats.append(dlat)
+          lngs.append(dlng)
+          zooms.append(zoom)
+    return (lats,lngs,zooms)
+
+  def testArrayMatchesScalarAtTileBorders(self):
+    (lats,lngs,zooms)=self.borderPoints()
+    self.assertGreater(len(lats),create_seed.NUMPY_MIN_POINTS)
+    (xtiles,ytiles)=create_seed.deg2numArray(lats,lngs,zooms)
+    for i in range(len(lats)):
+      expected=create_seed.deg2num(lats[i],lngs[i],zooms[i])
+      self.assertEqual((int(xtiles[i]),int(ytiles[i])),expected[0:2],
+                       "lat=%r lng=%r zoom=%d"%(lats[i],lngs[i],zooms[i]))
+
+  def testSingleZoom(self):
+    (lats,lngs,zooms)=self.borderPoints()
+    lats=[l for l,z in zip(lats,zooms) if z == 20]
+    lngs=[l for l,z in zip(lngs,zooms) if z == 20]
+    (xtiles,ytiles)=create_seed.deg2numArray(lats,lngs,20)
+    for i in range(len(lats)):
+      self.assertEqual((int(xtiles[i]),int(ytiles[i])),create_seed.deg2num(lats[i],lngs[i],20)[0:2])
+
+  def testBoxTiles(self):
+    box=create_seed.Box(create_seed.LatLng(54.3,10.6),create_seed.LatLng(54.0,10.0),14)
+    ne=create_seed.deg2num(54.3,10.6,14)
+    sw=create_seed.deg2num(54.0,10.0,14)
+    expected=[(x,y,14) for x in range(sw[0],ne[0]+1) for y in range(ne[1],sw[1]+1)]
+    self.assertEqual(box.getTileList(),expected)
+    self.assertEqual(box.getNumTiles(),len(expected))
+    self.assertEqual(box.getNumTiles(roundDown=True),(ne[0]-sw[0])*(sw[1]-ne[1]))
+    self.assertEqual(box.getTileRange(),(sw[0],ne[1],ne[0],sw[1]))
+    self.assertEqual(create_seed.Box(box.northeast,box.southwest).getTileList(),[])
+
+
+class TestGridIndex(unittest.TestCase):
+  def testQueryMatchesBruteForce(self):
+    rnd=random.Random(99)
+    for cellSize in [0.5,2,50]:
+      index=create_seed.GridIndex(cellSize)
+      rects=[]
+      for i in range(300):
+        swlat=rnd.uniform(-80,80)
+        swlng=rnd.uniform(-180,180)
+        #some large ones that are kept outside of the cells
+        extent=rnd.choice([0.1,1,5,60])
+        r=(swlat,swlng,swlat+rnd.uniform(0,extent),swlng+rnd.uniform(0,extent))
+        rects.append(r)
+        self.assertEqual(index.add(*r),i)
+      for i in range(100):
+        swlat=rnd.uniform(-90,90)
+        swlng=rnd.uniform(-180,180)
+        q=(swlat,swlng,swlat+rnd.uniform(0,20),swlng+rnd.uniform(0,20))
+        expected=[idx for idx,r in enumerate(rects)
+                  if not (r[2] < q[0] or r[3] < q[1] or r[0] > q[2] or r[1] > q[3])]
+        self.assertEqual(index.query(*q),expected)
+
+  def testValues(self):
+    index=create_seed.GridIndex()
+    index.add(0,0,1,1,'a')
+    index.add(1,1,2,2,'b')
+    self.assertEqual(index.query(1,1,1,1),['a','b'])
+    self.assertEqual(index.query(1.5,1.5,3,3),['b'])
+    self.assertEqual(index.query(3,3,4,4),[])
+
+
+class TestRectUnion(unittest.TestCase):
+  def testSnapGroupsLimitedByTolerance(self):
+    snapped=create_seed._snapCoordinates([0,0.0009,0.0018,0.0027],0.001)
+    self.assertEqual(snapped[0],(0,0.0009))
+    self.assertEqual(snapped[0.0009],(0,0.0009))
+    self.assertEqual(snapped[0.0018],(0.0018,0.0027))
+    self.assertEqual(snapped[0.0027],(0.0018,0.0027))
+
+  def testSnapChainDoesNotGrowBoxes(self):
+    #ne borders 10,11,12,13 would form one chain with a tolerance of 1
+    rects=[(0,2*i,10+i,2*i+1) for i in range(4)]
+    rt=create_seed.rectUnion(rects,tolerance=1)
+    covered=cells(rt)
+    self.assertTrue(covered >= cells(rects))
+    self.assertTrue(covered <= cells([(r[0],r[1],r[2]+1,r[3]+1) for r in rects]))
+
+  def testUnionMatchesCells(self):
+    rnd=random.Random(4711)
+    for run in range(200):
+      rects=randomRects(rnd,rnd.randint(1,30))
+      expected=cells(rects)
+      for overlapping in [False,True]:
+        rt=create_seed.rectUnion(rects,overlapping=overlapping)
+        self.assertEqual(cells(rt),expected,"run %d overlapping=%s"%(run,overlapping))
+        self.assertLessEqual(len(rt),len(rects)*4)
+        if not overlapping:
+          self.assertEqual(sum((r[2]-r[0])*(r[3]-r[1]) for r in rt),len(expected))
+
+  def testToleranceOnlyExtends(self):
+    rnd=random.Random(815)
+    tolerance=1
+    for run in range(200):
+      rects=randomRects(rnd,rnd.randint(1,20))
+      input=cells(rects)
+      grown=cells([(r[0]-tolerance,r[1]-tolerance,r[2]+tolerance,r[3]+tolerance) for r in rects])
+      rt=create_seed.rectUnion(rects,tolerance=tolerance)
+      covered=cells(rt)
+      self.assertTrue(covered >= input,"run %d"%run)
+      self.assertTrue(covered <= grown,"run %d"%run)
+
+
+class TestUnionArea(unittest.TestCase):
+  def testUnionAreaMatchesCells(self):
+    rnd=random.Random(1234)
+    for run in range(300):
+      ranges=[(r[0],r[1],r[2]-1,r[3]-1) for r in randomRects(rnd,rnd.randint(0,30))]
+      expected=cells([(r[0],r[1],r[2]+1,r[3]+1) for r in ranges])
+      self.assertEqual(create_seed.unionArea(ranges),len(expected),"run %d"%run)
+
+  def testSingleTiles(self):
+    self.assertEqual(create_seed.unionArea([(3,4,3,4)]),1)
+    self.assertEqual(create_seed.unionArea([(3,4,3,4),(3,4,3,4),(4,4,4,4)]),2)
+
+  def testTileCounterOverlappingBoxes(self):
+    counter=create_seed.TileCounter()
+    zoom=12
+    boxes=[
+      create_seed.Box(create_seed.LatLng(54.2,10.4),create_seed.LatLng(54.0,10.0),zoom),
+      create_seed.Box(create_seed.LatLng(54.3,10.6),create_seed.LatLng(54.1,10.2),zoom),
+      create_seed.Box(create_seed.LatLng(54.2,10.4),create_seed.LatLng(54.0,10.0),zoom)
+    ]
+    expected=set()
+    for box in boxes:
+      counter.add(box)
+      expected.update(box.getTileList())
+    self.assertEqual(counter.getZoomCount(zoom),len(expected))
+    self.assertEqual(counter.getCount(),len(expected))
+
+
+class TestSeedWriter(unittest.TestCase):
+  def testBuildOutputCompactsCoverages(self):
+    rnd=random.Random(42)
+    rects={10:randomRects(rnd,40),11:randomRects(rnd,5)}
+    boxes=[]
+    for zoom,zrects in rects.items():
+      for (swlat,swlng,nelat,nelng) in zrects:
+        boxes.append(create_seed.Box(create_seed.LatLng(nelat,nelng),create_seed.LatLng(swlat,swlng),zoom))
+    out=create_seed.SeedWriter().buildOutput(create_seed.Parsed(boxes),'test',{'caches':['c']})
+    self.assertEqual(sorted(out['seeds'].keys()),['test_010','test_011'])
+    for zoom,zrects in rects.items():
+      seed=out['seeds']['test_%03d'%zoom]
+      self.assertEqual(seed['levels'],[zoom])
+      self.assertEqual(seed['caches'],['c'])
+      coverages=[]
+      for name in seed['coverages']:
+        (swlng,swlat,nelng,nelat)=out['coverages'][name]['bbox']
+        coverages.append((swlat,swlng,nelat,nelng))
+      self.assertEqual(cells(coverages),cells(zrects))
+      self.assertLessEqual(len(coverages),len(zrects))
+
+
+class TestSeedPreflight(unittest.TestCase):
+  ZOOM=14
+  def setUp(self):
+    self.dir=tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def createCache(self,name,tiles):
+    '''
+    create a mbtiles file, tile_row is the y of the xyz scheme (origin nw)
+    '''
+    fileName=os.path.join(self.dir.name,name)
+    con=sqlite3.connect(fileName)
+    con.execute("create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    con.execute("create unique index idx on tiles (zoom_level, tile_column, tile_row)")
+    con.executemany("insert into tiles values (?,?,?,?)",[(z,x,y,b'x') for (x,y,z) in tiles])
+    con.commit()
+    con.close()
+    return fileName
+
+  def coveredTiles(self,seeds):
+    '''
+    the tiles mapproxy-seed would fetch for the coverages
+    '''
+    rt=set()
+    for seed in seeds['seeds'].values():
+      zoom=seed['levels'][0]
+      for cvname in seed['coverages']:
+        (swlng,swlat,nelng,nelat)=seeds['coverages'][cvname]['bbox']
+        (x0,y0,x1,y1)=create_seed.tileRanges([(swlat,swlng,nelat,nelng)],zoom)[0]
+        rt.update((x,y,zoom) for x in range(x0,x1+1) for y in range(y0,y1+1))
+    return rt
+
+  def testMissingTiles(self):
+    box=create_seed.Box(create_seed.LatLng(54.6,11.0),create_seed.LatLng(54.0,10.0),self.ZOOM)
+    allTiles=box.getTileList()
+    (x0,y0,x1,y1)=box.getTileRange()
+    #a fully cached block, a partly cached row and tiles of other zooms/outside
+    cachedTiles=set(t for t in allTiles if t[0] < x0+(x1-x0)//2)
+    cachedTiles.update(t for t in allTiles if t[1] == y1 and t[0] % 3 == 0)
+    extra=[(x0,y0,self.ZOOM+1),(x1+1,y0,self.ZOOM),(x0,y1+1,self.ZOOM)]
+    #the second cache misses some tiles of the first one
+    otherTiles=set(t for t in cachedTiles if t[1] != y0)
+    caches=[self.createCache('a.mbtiles',list(cachedTiles)+extra),
+            self.createCache('b.mbtiles',list(otherTiles)+extra)]
+    seeds=create_seed.SeedWriter().buildOutput(create_seed.Parsed([box]),'test',{'caches':['a','b']})
+    preflight=create_seed.SeedPreflight(caches)
+    (toFetch,cached)=preflight.run(seeds)
+    expectedMissing=set(allTiles)-(cachedTiles & otherTiles)
+    self.assertEqual(toFetch,len(expectedMissing))
+    self.assertEqual(cached,len(allTiles)-len(expectedMissing))
+    self.assertEqual(preflight.zoomStats[self.ZOOM],(len(allTiles),len(expectedMissing)))
+    covered=self.coveredTiles(seeds)
+    self.assertTrue(covered >= expectedMissing)
+    self.assertTrue(covered <= set(allTiles))
+    #whole blocks are removed
+    self.assertLess(len(covered),len(allTiles))
+
+  def testMissingInDifferentCaches(self):
+    box=create_seed.Box(create_seed.LatLng(54.05,10.05),create_seed.LatLng(54.0,10.0),self.ZOOM)
+    allTiles=box.getTileList()
+    self.assertLessEqual(len(allTiles),create_seed.SeedPreflight.MINTILES)
+    self.assertGreater(len(allTiles),2)
+    #each cache misses another tile
+    caches=[self.createCache('a.mbtiles',allTiles[1:]),
+            self.createCache('b.mbtiles',allTiles[:-1])]
+    seeds=create_seed.SeedWriter().buildOutput(create_seed.Parsed([box]),'test',{'caches':['a','b']})
+    (toFetch,cached)=create_seed.SeedPreflight(caches).run(seeds)
+    self.assertEqual((toFetch,cached),(2,len(allTiles)-2))
+
+  def testAllCached(self):
+    box=create_seed.Box(create_seed.LatLng(54.2,10.3),create_seed.LatLng(54.0,10.0),self.ZOOM)
+    cache=self.createCache('a.mbtiles',box.getTileList())
+    seeds=create_seed.SeedWriter().buildOutput(create_seed.Parsed([box]),'test',{'caches':['a']})
+    (toFetch,cached)=create_seed.SeedPreflight([cache]).run(seeds)
+    self.assertEqual((toFetch,cached),(0,len(box.getTileList())))
+    self.assertEqual(seeds['seeds'],{})
+    self.assertEqual(seeds['coverages'],{})
+
+  def testNothingCached(self):
+    box=create_seed.Box(create_seed.LatLng(54.2,10.3),create_seed.LatLng(54.0,10.0),self.ZOOM)
+    cache=self.createCache('a.mbtiles',[])
+    seeds=create_seed.SeedWriter().buildOutput(create_seed.Parsed([box]),'test',{'caches':['a']})
+    (toFetch,cached)=create_seed.SeedPreflight([cache]).run(seeds)
+    self.assertEqual((toFetch,cached),(len(box.getTileList()),0))
+    self.assertEqual(self.coveredTiles(seeds),set(box.getTileList()))
+
+
+class TestBoxCatalog(unittest.TestCase):
+  def setUp(self):
+    self.dir=tempfile.mkdtemp()
+    self.compiledDir=os.path.join(self.dir,'compiled')
+    os.mkdir(self.compiledDir)
+    self.originalCompiledDir=create_seed.BoxCatalog.compiledDir
+    create_seed.BoxCatalog.compiledDir=self.compiledDir
+    self.boxesFile=os.path.join(self.dir,'test.bbox')
+    rnd=random.Random(7)
+    self.lines=[]
+    for i in range(500):
+      zoom=rnd.randint(6,12)
+      swlat=rnd.uniform(-80,79)
+      swlng=rnd.uniform(-180,179)
+      size=rnd.uniform(0.01,1)
+      self.lines.append(b"B%d %d %f %f %f %f\n"%(i,zoom,swlat,swlng,swlat+size,swlng+size))
+    with open(self.boxesFile,"wb") as fh:
+      fh.write(b"".join(self.lines[0:250])+b"invalid line\n"+b"".join(self.lines[250:]))
+    rnd=random.Random(8)
+    self.areas=[(-90,-180,90,180)]
+    for i in range(20):
+      swlat=rnd.uniform(-80,70)
+      swlng=rnd.uniform(-180,150)
+      self.areas.append((swlat,swlng,swlat+rnd.uniform(0.1,20),swlng+rnd.uniform(0.1,30)))
+
+  def tearDown(self):
+    create_seed.BoxCatalog.compiledDir=self.originalCompiledDir
+    create_seed.BoxCatalog._catalogs.pop(self.boxesFile,None)
+    shutil.rmtree(self.dir,ignore_errors=True)
+
+  def parsed(self,area,minZoom,maxZoom):
+    '''
+    the lines touching area, straight from the text
+    '''
+    (swlat,swlng,nelat,nelng)=area
+    rt=[]
+    for line in self.lines:
+      parts=line.split()
+      (z,bswlat,bswlng,bnelat,bnelng)=[int(parts[1])]+[float(p) for p in parts[2:]]
+      if minZoom <= z <= maxZoom and bnelat >= swlat and bnelng >= swlng and bswlat <= nelat and bswlng <= nelng:
+        rt.append(line)
+    return rt
+
+  def checkCatalog(self,catalog):
+    for (swlat,swlng,nelat,nelng) in self.areas:
+      for (minZoom,maxZoom) in [(0,22),(8,9)]:
+        self.assertEqual(catalog.query(nelat,nelng,swlat,swlng,minZoom,maxZoom),
+                         self.parsed((swlat,swlng,nelat,nelng),minZoom,maxZoom))
+
+  def testCompiledMatchesParsed(self):
+    catalog=create_seed.BoxCatalog(self.boxesFile)
+    catalog.checkLoaded()
+    self.assertNotIsInstance(catalog.data.buffer,mmap.mmap)
+    self.checkCatalog(catalog)
+    compiled=os.path.join(self.compiledDir,'test.bbox'+create_seed.BoxCatalog.SUFFIX)
+    self.assertTrue(os.path.exists(compiled))
+    #a second catalog maps the compiled file
+    mapped=create_seed.BoxCatalog(self.boxesFile)
+    mapped.checkLoaded()
+    self.assertIsInstance(mapped.data.buffer,mmap.mmap)
+    self.checkCatalog(mapped)
+
+  def testDataClassesAgree(self):
+    if create_seed.numpy is None:
+      self.skipTest("numpy not available")
+    buffer=create_seed.BoxCatalog.compile(self.boxesFile)
+    count=create_seed.BoxCatalog.HEADER.unpack_from(buffer)[1]
+    self.assertEqual(count,len(self.lines))
+    withNumpy=create_seed._NumpyCatalogData(buffer,count)
+    indexed=create_seed._IndexedCatalogData(buffer,count,create_seed.BoxCatalog.MINCELL)
+    for area in self.areas:
+      (swlat,swlng,nelat,nelng)=area
+      for data in [withNumpy,indexed]:
+        self.assertEqual(data.lines(data.query(nelat,nelng,swlat,swlng,7,10)),self.parsed(area,7,10))
+      self.assertEqual(sorted(indexed.zooms(area)),sorted(withNumpy.zooms(area)))
+      self.assertEqual(indexed.records(8,11,[area]),withNumpy.records(8,11,[area]))
+    self.assertEqual(indexed.records(),withNumpy.records())
+    for level in [0,3,8]:
+      self.assertEqual(sorted(indexed.clusters(9,level).query(-90,-180,90,180)),
+                       sorted(withNumpy.clusters(9,level).query(-90,-180,90,180)))
+
+  def testRecompileAfterChange(self):
+    catalog=create_seed.BoxCatalog.getCatalog(self.boxesFile)
+    self.assertEqual(catalog.query(1.5,1.5,1,1,0,22),[])
+    line=b"NEW 10 1.0 1.0 2.0 2.0\n"
+    with open(self.boxesFile,"ab") as fh:
+      fh.write(line)
+    st=os.stat(self.boxesFile)
+    os.utime(self.boxesFile,ns=(st.st_atime_ns,catalog.mtime+10**9))
+    self.assertIs(create_seed.BoxCatalog.getCatalog(self.boxesFile),catalog)
+    self.assertEqual(catalog.query(1.5,1.5,1,1,0,22),[line])
+    self.assertFalse(catalog.checkLoaded())
+    #the compiled file has been replaced as well
+    mapped=create_seed.BoxCatalog(self.boxesFile)
+    mapped.checkLoaded()
+    self.assertIsInstance(mapped.data.buffer,mmap.mmap)
+    self.assertEqual(mapped.query(1.5,1.5,1,1,0,22),[line])
+
+
+class TestQuantizeBounds(unittest.TestCase):
+  def testSameKeyForSimilarAreas(self):
+    (key,bounds)=create_seed.Boxes.quantizeBounds(54.3,10.4,54.0,10.0)
+    (otherKey,otherBounds)=create_seed.Boxes.quantizeBounds(54.31,10.41,54.01,10.01)
+    self.assertEqual(key,otherKey)
+    self.assertEqual(bounds,otherBounds)
+    (nelat,nelng,swlat,swlng)=bounds
+    self.assertTrue(nelat >= 54.3 and nelng >= 10.4 and swlat <= 54.0 and swlng <= 10.0)
+    (zoom,xmin,ymin,xmax,ymax)=key
+    self.assertLessEqual(xmax-xmin+1,3)
+    self.assertLessEqual(ymax-ymin+1,3)
+
+  def testBeyond180(self):
+    (key,bounds)=create_seed.Boxes.quantizeBounds(60,200,-60,-200)
+    self.assertEqual(key[0],0)
+    self.assertEqual(bounds,(90.0,180.0,-90.0,-180.0))
+    #an area crossing the antimeridian is extended to the border of the world
+    (key,bounds)=create_seed.Boxes.quantizeBounds(10,185,0,175)
+    (zoom,xmin,ymin,xmax,ymax)=key
+    self.assertEqual(xmax,2**zoom-1)
+    self.assertEqual(bounds[1],180.0)
+    self.assertLessEqual(bounds[3],175)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+import injector
+
+
+class Source(object):
+  def __init__(self,**conf):
+    self.conf=dict(conf,name='test')
+
+
+class Log(object):
+  def __init__(self):
+    self.messages=[]
+  def log(self,fmt,*args):
+    self.messages.append(fmt%args)
+
+
+class Clock(object):
+  '''
+  replaces the time module of the injector
+  '''
+  def __init__(self):
+    self.now=1000.0
+  def time(self):
+    return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+    self.stateDir=os.path.join(self.workdir,'ratelimit')
+    self.clock=Clock()
+    self.originalTime=injector.time
+    injector.time=self.clock
+
+  def tearDown(self):
+    injector.time=self.originalTime
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def testBurstThenRate(self):
+    limiter=injector.RateLimiter(self.stateDir)
+    for i in range(0,3):
+      self.assertEqual(limiter._reserve('host',2,3),0)
+    #each further request reserves the next free slot
+    self.assertAlmostEqual(limiter._reserve('host',2,3),0.5)
+    self.assertAlmostEqual(limiter._reserve('host',2,3),1.0)
+    #after 2 s 4 tokens are added, 2 of them pay back the reserved ones
+    self.clock.now+=2
+    for i in range(0,2):
+      self.assertEqual(limiter._reserve('host',2,3),0)
+    self.assertAlmostEqual(limiter._reserve('host',2,3),0.5)
+    #the bucket never holds more than burst tokens
+    self.clock.now+=100
+    for i in range(0,3):
+      self.assertEqual(limiter._reserve('host',2,3),0)
+    self.assertGreater(limiter._reserve('host',2,3),0)
+
+  def testSharedByHostAndProcess(self):
+    first=injector.RateLimiter(self.stateDir)
+    second=injector.RateLimiter(self.stateDir)
+    self.assertEqual(first._reserve('host',1,1),0)
+    self.assertAlmostEqual(second._reserve('host',1,1),1.0)
+    self.assertEqual(second._reserve('other',1,1),0)
+    self.assertEqual(stat.S_IMODE(os.stat(self.stateDir).st_mode),0o700)
+
+  def testAcquireWithoutLimit(self):
+    limiter=injector.RateLimiter(self.stateDir)
+    limiter.acquire('http://host/tile',None)
+    limiter.acquire('http://host/tile',0)
+    self.assertFalse(os.path.exists(self.stateDir))
+
+
+class TestConfigValues(unittest.TestCase):
+  def testInvalidValuesAreIgnored(self):
+    log=Log()
+    inj=injector.Injector([],logger=log)
+    self.assertEqual(inj._getFloat(Source(rate_limit='2.5'),'rate_limit'),2.5)
+    self.assertIsNone(inj._getFloat(Source(),'rate_limit'))
+    self.assertIsNone(inj._getFloat(Source(rate_limit='fast'),'rate_limit'))
+    self.assertIsNone(inj._getFloat(Source(rate_burst=[1]),'rate_burst'))
+    self.assertEqual(len(log.messages),2)
+    self.assertIn('rate_limit fast',log.messages[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+import http.client
+import http.server
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import yaml
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+try:
+  from PIL import Image
+  import mapproxy_wrapper
+  HAS_MAPPROXY=True
+except ImportError:
+  HAS_MAPPROXY=False
+
+PREFIX='/api/mapproxy'
+
+
+class Log(object):
+  def log(self,fmt,*args):
+    pass
+  def debug(self,fmt,*args):
+    pass
+  def error(self,fmt,*args):
+    pass
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+  '''
+  serves tiles up to zoom 2, fails with 500 for higher zooms
+  '''
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    self.server.entered.set()
+    self.server.gate.wait(10)
+    zoom=int(self.path.split('/')[1])
+    if zoom > 2:
+      self.send_error(500)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type','image/png')
+    self.send_header('Content-Length',str(len(self.server.tile)))
+    self.end_headers()
+    self.wfile.write(self.server.tile)
+  def log_message(self,*args):
+    pass
+
+
+class Server(object):
+  server_port=8080
+
+
+class Request(object):
+  '''
+  the parts of a BaseHTTPRequestHandler the wrapper uses
+  '''
+  def __init__(self,path,command='GET'):
+    self.path=PREFIX+path
+    self.command=command
+    self.request_version='HTTP/1.1'
+    self.headers=http.client.HTTPMessage()
+    self.server=Server()
+    self.client_address=('127.0.0.1',1)
+    self.rfile=io.BytesIO()
+    self.wfile=io.BytesIO()
+    self.status=None
+    self.responseHeaders={}
+  def address_string(self):
+    return '127.0.0.1'
+  def log_request(self,*args):
+    pass
+  def send_response(self,code,message=None):
+    self.status=code
+  def send_header(self,name,value):
+    self.responseHeaders[name.lower()]=value
+  def end_headers(self):
+    pass
+
+
+@unittest.skipUnless(HAS_MAPPROXY,"mapproxy not available")
+class TestTileCache(unittest.TestCase):
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+    self.tileServer=http.server.ThreadingHTTPServer(('127.0.0.1',0),TileHandler)
+    self.tileServer.requests=[]
+    self.tileServer.entered=threading.Event()
+    self.tileServer.gate=threading.Event()
+    self.tileServer.gate.set()
+    out=io.BytesIO()
+    Image.new('RGB',(256,256),(0,0,255)).save(out,'PNG')
+    self.tileServer.tile=out.getvalue()
+    threading.Thread(target=self.tileServer.serve_forever,daemon=True).start()
+    url='http://127.0.0.1:%d/%%(tms_path)s.png'%self.tileServer.server_address[1]
+    def cache(source):
+      return {
+        'grids':['GLOBAL_WEBMERCATOR'],
+        'sources':[source],
+        'cache':{'type':'file','directory':os.path.join(self.workdir,source)}
+      }
+    self.configFile=os.path.join(self.workdir,'mapproxy.yaml')
+    with open(self.configFile,"w") as fh:
+      yaml.safe_dump({
+        'services':{'tms':{'use_grid_names':True,'origin':'nw'}},
+        'layers':[
+          {'name':'plain','title':'plain','sources':['plainCache']},
+          {'name':'handler','title':'handler','sources':['handlerCache']},
+          {'name':'mbtiles','title':'mbtiles','sources':['mbtilesCache']}
+        ],
+        'caches':{
+          'plainCache':cache('plain'),
+          'handlerCache':cache('handler'),
+          'mbtilesCache':{
+            'grids':['GLOBAL_WEBMERCATOR'],
+            'sources':['plain'],
+            'cache':{'type':'mbtiles','filename':os.path.join(self.workdir,'tiles.mbtiles')}
+          }
+        },
+        'sources':{
+          'plain':{'type':'tile','grid':'GLOBAL_WEBMERCATOR','url':url},
+          'handler':{'type':'tile','grid':'GLOBAL_WEBMERCATOR','url':url,
+                     'on_error':{500:{'response':'transparent'}}}
+        }
+      },fh)
+    self.wrapper=mapproxy_wrapper.MapProxyWrapper(PREFIX,self.configFile,[self.workdir],Log())
+    self.wrapper.createProxy()
+
+  def tearDown(self):
+    self.tileServer.shutdown()
+    self.tileServer.server_close()
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def request(self,path,headers=None):
+    request=Request(path)
+    for k,v in (headers or {}).items():
+      request.headers[k]=v
+    self.wrapper.handleRequest(path,request,{})
+    return request
+
+  def tilePath(self,layer,z,x=0,y=0):
+    return '/tiles/1.0.0/%s/GLOBAL_WEBMERCATOR/%d/%d/%d.png'%(layer,z,x,y)
+
+  def testTileIsKept(self):
+    for i in range(0,2):
+      response=self.request(self.tilePath('plain',1))
+      self.assertEqual(response.status,200)
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],1)
+    self.assertEqual(len(self.tileServer.requests),1)
+
+  def testErrorIsNotKept(self):
+    response=self.request(self.tilePath('plain',3))
+    self.assertNotEqual(response.status,200)
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],0)
+
+  def testErrorTileIsNotKept(self):
+    for i in range(0,2):
+      response=self.request(self.tilePath('handler',3))
+      self.assertEqual(response.status,200)
+      self.assertIn('no-cache',response.responseHeaders.get('cache-control'))
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],0)
+    self.assertEqual(len(self.tileServer.requests),2)
+
+  def testLayerWithErrorHandler(self):
+    #a real tile, but it could as well be an error tile
+    response=self.request(self.tilePath('handler',1))
+    self.assertEqual(response.status,200)
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],0)
+
+  def requestWhile(self,action,path):
+    '''
+    run action while the request for path waits for the upstream tile
+    '''
+    self.tileServer.gate.clear()
+    result=[]
+    thread=threading.Thread(target=lambda: result.append(self.request(path)))
+    thread.start()
+    self.assertTrue(self.tileServer.entered.wait(10))
+    action()
+    self.tileServer.gate.set()
+    thread.join(10)
+    return result[0]
+
+  def testClearWhileFetching(self):
+    response=self.requestWhile(self.wrapper.clearTileCache,self.tilePath('plain',1))
+    self.assertEqual(response.status,200)
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],0)
+    self.assertEqual(self.wrapper.tileInfoCache.getStatus()['entries'],0)
+    self.request(self.tilePath('plain',1))
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],1)
+
+  def testNewAppWhileFetching(self):
+    (app,tileLayers,generation)=self.wrapper.proxy
+    def recreate():
+      os.utime(self.configFile,(0,0))
+      self.assertTrue(self.wrapper.createProxy(changedOnly=True))
+    response=self.requestWhile(recreate,self.tilePath('plain',2))
+    self.assertEqual(response.status,200)
+    (newApp,newLayers,newGeneration)=self.wrapper.proxy
+    self.assertIsNot(newApp,app)
+    self.assertGreater(newGeneration,generation)
+    self.assertEqual(self.wrapper.tileCache.getStatus()['entries'],0)
+
+  def testServedFromMbtiles(self):
+    path=self.tilePath('mbtiles',1)
+    first=self.request(path)
+    self.assertEqual(first.status,200)
+    etag=first.responseHeaders.get('etag')
+    self.assertIsNotNone(etag)
+    #after a clear the tile is read directly from the file with the same ETag
+    self.wrapper.clearTileCache()
+    second=self.request(path)
+    self.assertEqual(second.status,200)
+    self.assertEqual(second.responseHeaders.get('etag'),etag)
+    self.assertEqual(self.wrapper.mbtilesReader.getStatus()['hits'],1)
+    self.assertEqual(len(self.tileServer.requests),1)
+    self.wrapper.clearTileCache()
+    third=self.request(path,{'If-None-Match':etag})
+    self.assertEqual(third.status,304)
+    self.assertEqual(third.responseHeaders.get('etag'),etag)
+
+
+if __name__ == '__main__':
+  unittest.main()
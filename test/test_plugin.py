@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+import http.client
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+try:
+  import mapproxy
+  import plugin
+  HAS_MAPPROXY=True
+except ImportError:
+  HAS_MAPPROXY=False
+
+
+class Api(object):
+  def log(self,fmt,*args):
+    pass
+  def debug(self,fmt,*args):
+    pass
+  def error(self,fmt,*args):
+    pass
+
+
+class Handler(object):
+  '''
+  the parts of a BaseHTTPRequestHandler getBoxes uses
+  '''
+  def __init__(self,ifNoneMatch=None):
+    self.headers=http.client.HTTPMessage()
+    if ifNoneMatch is not None:
+      self.headers['If-None-Match']=ifNoneMatch
+    self.wfile=io.BytesIO()
+    self.status=None
+    self.responseHeaders={}
+  def send_response(self,code,message=None):
+    self.status=code
+  def send_header(self,name,value):
+    self.responseHeaders[name.lower()]=value
+  def end_headers(self):
+    pass
+
+
+@unittest.skipUnless(HAS_MAPPROXY,"mapproxy not available")
+class TestGetBoxes(unittest.TestCase):
+  ARGS={'nelat':['54.3'],'nelng':['10.4'],'swlat':['54.0'],'swlng':['10.0']}
+  def setUp(self):
+    self.dir=tempfile.mkdtemp()
+    self.boxesFile=os.path.join(self.dir,'test.bbox')
+    with open(self.boxesFile,"w") as fh:
+      fh.write("B1 10 54.1 10.1 54.2 10.2\n")
+    self.plugin=plugin.Plugin(Api())
+    self.plugin.boxes=plugin.seedCreator.Boxes(self.boxesFile)
+
+  def tearDown(self):
+    plugin.seedCreator.BoxCatalog._catalogs.pop(self.boxesFile,None)
+    shutil.rmtree(self.dir,ignore_errors=True)
+
+  def getBoxes(self,ifNoneMatch=None,args=None):
+    handler=Handler(ifNoneMatch)
+    self.assertTrue(self.plugin.handleApiRequest('getBoxes',handler,args or self.ARGS))
+    return handler
+
+  def testEtag(self):
+    first=self.getBoxes()
+    self.assertEqual(first.status,200)
+    self.assertEqual(first.wfile.getvalue(),b"B1 10 54.1 10.1 54.2 10.2\n")
+    etag=first.responseHeaders.get('etag')
+    self.assertIsNotNone(etag)
+    notModified=self.getBoxes(etag)
+    self.assertEqual(notModified.status,304)
+    self.assertEqual(notModified.responseHeaders.get('etag'),etag)
+    self.assertEqual(notModified.wfile.getvalue(),b'')
+    #a slightly moved map gives the same bounds
+    moved=dict(self.ARGS,nelat=['54.31'])
+    self.assertEqual(self.getBoxes(etag,moved).status,304)
+    #other limits or other boxes change the ETag
+    self.plugin.maxBoxes=10
+    self.assertEqual(self.getBoxes(etag).status,200)
+    self.plugin.maxBoxes=None
+    with open(self.boxesFile,"a") as fh:
+      fh.write("B2 10 54.15 10.15 54.25 10.25\n")
+    st=os.stat(self.boxesFile)
+    os.utime(self.boxesFile,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    changed=self.getBoxes(etag)
+    self.assertEqual(changed.status,200)
+    self.assertNotEqual(changed.responseHeaders.get('etag'),etag)
+    self.assertEqual(len(changed.wfile.getvalue().splitlines()),2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+import gzip
+import http.server
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import yaml
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+import seed_runner
+
+try:
+  import mapproxy
+  from PIL import Image
+  HAS_MAPPROXY=True
+except ImportError:
+  HAS_MAPPROXY=False
+
+
+class TestQueue(unittest.TestCase):
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def createRunner(self):
+    runner=seed_runner.SeedRunner(self.workdir,'mapproxy.yaml',[],useServer=False)
+    # keep the jobs in the queue
+    runner.pause=True
+    return runner
+
+  def queueFile(self):
+    return os.path.join(self.workdir,seed_runner.SeedRunner.QUEUEFILE)
+
+  def testQueueKeptInMemory(self):
+    runner=self.createRunner()
+    (first,started)=runner.queueSeed({'seeds':{}},['c1'],'s1',priority=0)
+    self.assertFalse(started)
+    (second,started)=runner.queueSeed({'seeds':{}},['c2'],'s2',priority=1)
+    os.unlink(self.queueFile())
+    queue=runner.getQueue()
+    self.assertEqual([j['id'] for j in queue],[second,first])
+    self.assertTrue(all('seeds' not in j for j in queue))
+    self.assertTrue(runner.setJobPriority(first,2))
+    self.assertTrue(os.path.exists(self.queueFile()))
+    with open(self.queueFile()) as fh:
+      stored=yaml.safe_load(fh)
+    self.assertEqual([j['id'] for j in stored],[first,second])
+    self.assertEqual(stored[0]['seeds'],{'seeds':{}})
+    self.assertTrue(runner.removeJob(second))
+    self.assertFalse(runner.removeJob(second))
+    self.assertEqual([j['id'] for j in self.createRunner().getQueue()],[first])
+
+  def testJobWithoutSeeds(self):
+    with open(self.queueFile(),"w") as fh:
+      yaml.safe_dump([{'id':1,'priority':0}],fh)
+    self.assertEqual(self.createRunner().getQueue(),[{'id':1,'priority':0}])
+
+  def testCorruptQueueIsKept(self):
+    with open(self.queueFile(),"w") as fh:
+      fh.write("- id: [1\n")
+    runner=self.createRunner()
+    self.assertEqual(runner.getQueue(),[])
+    bad=[f for f in os.listdir(self.workdir) if f.endswith('.bad')]
+    self.assertEqual(len(bad),1)
+    with open(os.path.join(self.workdir,bad[0])) as fh:
+      self.assertEqual(fh.read(),"- id: [1\n")
+    runner.queueSeed({'seeds':{}},['c1'],'s1')
+    self.assertEqual(len(runner.getQueue()),1)
+
+
+class TestReadLog(unittest.TestCase):
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+    self.runner=seed_runner.SeedRunner(self.workdir,'mapproxy.yaml',[],useServer=False)
+    self.logName=seed_runner.SeedRunner.LOGFILE+".1"
+    self.runner.currentLog=os.path.join(self.workdir,self.logName)
+    with open(self.runner.currentLog,"wb") as fh:
+      fh.write(b"start\n")
+    #a running seed
+    self.runner.child=object()
+
+  def tearDown(self):
+    self.runner.child=None
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def testWaitIsCapped(self):
+    self.runner.MAX_LOG_WAIT=0.2
+    start=time.monotonic()
+    self.assertEqual(self.runner.readLog(self.logName,offset=6,wait=30),(b'',6,6))
+    self.assertLess(time.monotonic()-start,5)
+
+  def testWakeupOnOutput(self):
+    def write():
+      time.sleep(0.2)
+      with open(self.runner.currentLog,"ab") as fh:
+        fh.write(b"next\n")
+      self.runner._notifyLogReaders()
+    threading.Thread(target=write).start()
+    start=time.monotonic()
+    self.assertEqual(self.runner.readLog(self.logName,offset=6,wait=20),(b'next\n',6,11))
+    self.assertLess(time.monotonic()-start,5)
+
+  def testWakeupOnEnd(self):
+    def finish():
+      time.sleep(0.2)
+      self.runner.child=None
+      self.runner._notifyLogReaders()
+    threading.Thread(target=finish).start()
+    start=time.monotonic()
+    self.assertEqual(self.runner.readLog(self.logName,offset=6,wait=20),(b'',6,6))
+    self.assertLess(time.monotonic()-start,5)
+
+  def testCompressedWhileWaiting(self):
+    result=[]
+    reader=threading.Thread(target=lambda: result.append(self.runner.readLog(self.logName,offset=6,wait=20)))
+    reader.start()
+    time.sleep(0.2)
+    with open(self.runner.currentLog,"ab") as fh:
+      fh.write(b"end\n")
+    self.runner.child=None
+    self.runner.cleanupLogs()
+    self.assertFalse(os.path.exists(self.runner.currentLog))
+    self.runner._notifyLogReaders()
+    reader.join(5)
+    self.assertEqual(result,[(b'end\n',6,10)])
+
+  def testCompressedBeforeOpen(self):
+    self.runner.child=None
+    stalePath=self.runner.currentLog
+    self.runner._compressLog(stalePath)
+    logPath=self.runner._logPath
+    calls=[]
+    def staleLogPath(name):
+      calls.append(name)
+      if len(calls) == 1:
+        return stalePath
+      return logPath(name)
+    self.runner._logPath=staleLogPath
+    self.assertEqual(self.runner.readLog(self.logName,offset=0),(b'start\n',0,6))
+    self.assertEqual(len(calls),2)
+    del calls[:]
+    with self.runner.getLogFile(self.logName,bytesFromEnd=3) as fh:
+      self.assertEqual(fh.read(),b'rt\n')
+    del calls[:]
+    with self.runner.getCompressedLog(self.logName) as fh:
+      self.assertEqual(gzip.decompress(fh.read()),b'start\n')
+
+
+class TestLogs(unittest.TestCase):
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+    self.runner=seed_runner.SeedRunner(self.workdir,'mapproxy.yaml',[],useServer=False)
+    self.runner._nowTs=lambda useLong=False: '20240101-1200'
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def writeLog(self,name,data=b"log\n"):
+    with open(os.path.join(self.workdir,name),"wb") as fh:
+      fh.write(data)
+
+  def testUniqueLogNames(self):
+    first=self.runner._logFile()
+    self.assertEqual(os.path.basename(first),'seed.log.20240101-1200')
+    open(first,"w").close()
+    second=self.runner._logFile()
+    self.assertEqual(os.path.basename(second),'seed.log.20240101-1200-01')
+    self.runner._compressLog(first)
+    self.assertEqual(self.runner._logFile(),second)
+    open(second,"w").close()
+    self.assertEqual(os.path.basename(self.runner._logFile()),'seed.log.20240101-1200-02')
+
+  def testCleanupKeepsStartingLog(self):
+    self.writeLog('seed.log.1')
+    self.writeLog('seed.log.2')
+    #leftover from an interrupted compression
+    self.writeLog('seed.log.1.gz',gzip.compress(b"log\n"))
+    self.runner.currentLog=os.path.join(self.workdir,'seed.log.2')
+    self.runner.currentlyStarting=True
+    self.runner.cleanupLogs()
+    self.assertEqual(sorted(os.listdir(self.workdir)),['seed.log.1.gz','seed.log.2'])
+    self.runner.currentlyStarting=False
+    self.runner.cleanupLogs()
+    self.assertEqual(sorted(os.listdir(self.workdir)),['seed.log.1.gz','seed.log.2.gz'])
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.server.requests+=1
+    time.sleep(self.server.delay)
+    self.send_response(200)
+    self.send_header('Content-Type','image/png')
+    self.send_header('Content-Length',str(len(self.server.tile)))
+    self.end_headers()
+    self.wfile.write(self.server.tile)
+  def log_message(self,*args):
+    pass
+
+
+@unittest.skipUnless(HAS_MAPPROXY,"mapproxy not available")
+class TestSeedServer(unittest.TestCase):
+  USE_SERVER=True
+  def setUp(self):
+    self.workdir=tempfile.mkdtemp()
+    self.tileServer=http.server.ThreadingHTTPServer(('127.0.0.1',0),TileHandler)
+    self.tileServer.requests=0
+    self.tileServer.delay=0
+    out=io.BytesIO()
+    Image.new('RGB',(256,256),(0,0,255)).save(out,'PNG')
+    self.tileServer.tile=out.getvalue()
+    threading.Thread(target=self.tileServer.serve_forever,daemon=True).start()
+    self.configFile=os.path.join(self.workdir,'mapproxy.yaml')
+    with open(self.configFile,"w") as fh:
+      yaml.safe_dump({
+        'services':{'tms':{}},
+        'layers':[{'name':'l','title':'l','sources':['c']}],
+        'caches':{'c':{
+          'grids':['GLOBAL_WEBMERCATOR'],
+          'sources':['tiles'],
+          'cache':{'type':'file','directory':os.path.join(self.workdir,'cache')}
+        }},
+        'sources':{'tiles':{
+          'type':'tile',
+          'grid':'GLOBAL_WEBMERCATOR',
+          'url':'http://127.0.0.1:%d/%%(tms_path)s.png'%self.tileServer.server_address[1]
+        }}
+      },fh)
+    self.finished=threading.Event()
+    self.runner=seed_runner.SeedRunner(self.workdir,self.configFile,[],
+                                       useServer=self.USE_SERVER,
+                                       finishedCallback=self.finished.set)
+
+  def tearDown(self):
+    if self.runner.child is not None:
+      self.runner.killRun()
+    if self.runner.server is not None:
+      self.runner.server.stop()
+      if self.runner.server.process is not None:
+        self.runner.server.process.wait(10)
+    self.tileServer.shutdown()
+    self.tileServer.server_close()
+    shutil.rmtree(self.workdir,ignore_errors=True)
+
+  def seedConfig(self,maxLevel,cache='c'):
+    return {'seeds':{'s':{'caches':[cache],'levels':{'to':maxLevel}}}}
+
+  def waitFinished(self):
+    self.assertTrue(self.finished.wait(60))
+    self.finished.clear()
+
+  def testSeedFinished(self):
+    self.runner.runSeed(self.seedConfig(2))
+    if self.USE_SERVER:
+      self.assertIsInstance(self.runner.child,seed_runner.SeedChild)
+    self.waitFinished()
+    self.assertEqual(self.runner.seedStatus,seed_runner.SeedRunner.STATE_OK)
+    self.assertEqual(self.tileServer.requests,1+4+16)
+    self.runner.runSeed(self.seedConfig(3))
+    self.waitFinished()
+    self.assertEqual(self.runner.seedStatus,seed_runner.SeedRunner.STATE_OK)
+    if self.USE_SERVER:
+      self.assertEqual(len(self.runner.server.children),0)
+
+  def testExitStatus(self):
+    self.runner.runSeed(self.seedConfig(2,cache='unknown'))
+    self.waitFinished()
+    self.assertEqual(self.runner.seedStatus,seed_runner.SeedRunner.STATE_ERROR)
+    self.assertIn('state 2',self.runner.info)
+
+  def testKill(self):
+    self.tileServer.delay=0.05
+    self.runner.runSeed(self.seedConfig(10))
+    child=self.runner.child
+    logName=os.path.basename(self.runner.currentLog)
+    end=time.monotonic()+30
+    while self.tileServer.requests < 2 and time.monotonic() < end:
+      time.sleep(0.1)
+    self.assertGreater(self.tileServer.requests,1)
+    (data,start,offset)=self.runner.readLog(logName,offset=0,wait=20)
+    self.assertIn(b'Start seeding',data)
+    (data,start,offset)=self.runner.readLog(logName,offset=offset)
+    self.assertEqual(os.getpgid(child.pid),child.pid)
+    self.assertNotEqual(os.getpgid(child.pid),os.getpgrp())
+    if self.USE_SERVER:
+      self.assertNotEqual(os.getpgid(child.pid),os.getpgid(self.runner.server.process.pid))
+    result=[]
+    reader=threading.Thread(target=lambda: result.append(self.runner.readLog(logName,offset=offset,wait=20)))
+    reader.start()
+    time.sleep(0.2)
+    self.assertTrue(self.runner.killRun())
+    #the output of the stopping seed ends the wait
+    reader.join(5)
+    self.assertEqual(len(result),1)
+    self.assertGreater(len(result[0][0]),0)
+    self.waitFinished()
+    self.assertIsNotNone(child.poll())
+    self.assertNotEqual(child.poll(),0)
+    self.assertEqual(self.runner.seedStatus,seed_runner.SeedRunner.STATE_ERROR)
+    if self.USE_SERVER:
+      #the server survives the kill
+      self.assertIsNone(self.runner.server.process.poll())
+    self.tileServer.delay=0
+    self.runner.runSeed(self.seedConfig(1))
+    self.waitFinished()
+    self.assertEqual(self.runner.seedStatus,seed_runner.SeedRunner.STATE_OK)
+
+
+class TestSeedProcess(TestSeedServer):
+  USE_SERVER=False
+
+
+if __name__ == '__main__':
+  unittest.main()
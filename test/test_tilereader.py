@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+import email.utils
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+
+import tilereader
+
+
+class TestMbtilesReader(unittest.TestCase):
+  def setUp(self):
+    self.dir=tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def createFile(self,name,tiles,withTimestamp=False):
+    '''
+    create a mbtiles file like mapproxy does
+    :param tiles: dict (z,x,y) -> data
+    '''
+    fileName=os.path.join(self.dir.name,name)
+    con=sqlite3.connect(fileName)
+    columns="zoom_level integer, tile_column integer, tile_row integer, tile_data blob"
+    if withTimestamp:
+      columns+=", last_modified datetime default (datetime('now','localtime'))"
+    con.execute("create table tiles (%s)"%columns)
+    con.execute("create unique index idx on tiles (zoom_level, tile_column, tile_row)")
+    con.executemany("insert into tiles (zoom_level,tile_column,tile_row,tile_data) values (?,?,?,?)",
+                    [(z,x,y,data) for (z,x,y),data in tiles.items()])
+    con.commit()
+    con.close()
+    return fileName
+
+  def testGetTile(self):
+    fileName=self.createFile('a.mbtiles',{(1,0,1):b'tile'})
+    reader=tilereader.MbtilesReader()
+    self.assertEqual(reader.getTile(fileName,1,0,1),(b'tile',None))
+    self.assertEqual(reader.getTile(fileName,1,1,1),(None,None))
+    self.assertEqual(reader.getStatus(),{'files':1,'hits':1,'misses':1,'errors':0})
+    with self.assertRaises(Exception):
+      reader.getTile(os.path.join(self.dir.name,'missing.mbtiles'),1,0,1)
+    self.assertEqual(reader.getStatus()['errors'],1)
+
+  def testTimestamp(self):
+    fileName=self.createFile('a.mbtiles',{(2,1,1):b'tile'},withTimestamp=True)
+    (data,timestamp)=tilereader.MbtilesReader().getTile(fileName,2,1,1,withTimestamp=True)
+    self.assertEqual(data,b'tile')
+    self.assertLess(abs(timestamp-time.time()),60)
+
+  def testClear(self):
+    fileName=self.createFile('a.mbtiles',{(1,0,1):b'tile'})
+    reader=tilereader.MbtilesReader()
+    (connection,generation)=reader._acquire(fileName)
+    reader.getTile(fileName,1,0,1)
+    self.assertEqual(len(reader.idle[fileName]),1)
+    reader.clear()
+    self.assertEqual(reader.idle,{})
+    #a connection that was in use while clearing is not kept
+    reader._release(fileName,connection,generation)
+    self.assertEqual(reader.idle,{})
+    self.assertEqual(reader.getTile(fileName,1,0,1),(b'tile',None))
+    self.assertEqual(len(reader.idle[fileName]),1)
+
+
+class TestTileHeaders(unittest.TestCase):
+  def testTileHeaders(self):
+    headers=tilereader.tileHeaders([('Content-Type','image/png'),('ETag','"old"'),
+                                    ('Last-Modified','x'),('Cache-Control','no-cache')],
+                                   b'tile',timestamp=0,cacheControl='public, max-age=10')
+    self.assertEqual(tilereader.getHeader(headers,'content-type'),'image/png')
+    self.assertEqual(len([h for h in headers if h[0].lower() == 'etag']),1)
+    self.assertEqual(tilereader.getHeader(headers,'last-modified'),'Thu, 01 Jan 1970 00:00:00 GMT')
+    self.assertEqual(tilereader.getHeader(headers,'cache-control'),'public, max-age=10')
+    #without new values the existing ones are kept
+    headers=tilereader.tileHeaders([('Last-Modified','x'),('Cache-Control','no-cache')],b'tile')
+    self.assertEqual(tilereader.getHeader(headers,'last-modified'),'x')
+    self.assertEqual(tilereader.getHeader(headers,'cache-control'),'no-cache')
+
+  def testStableEtag(self):
+    #the ETag only depends on the content, so it survives clearing the caches and new apps
+    first=tilereader.getHeader(tilereader.tileHeaders([],b'tile',timestamp=1),'etag')
+    second=tilereader.getHeader(tilereader.tileHeaders([('ETag','"mapproxy"')],b'tile',timestamp=2),'etag')
+    self.assertEqual(first,second)
+    self.assertNotEqual(first,tilereader.getHeader(tilereader.tileHeaders([],b'other'),'etag'))
+
+  def testNotModified(self):
+    headers=tilereader.tileHeaders([('Content-Type','image/png')],b'tile',timestamp=1000)
+    etag=tilereader.getHeader(headers,'etag')
+    self.assertTrue(tilereader.isNotModified(headers,etag,None))
+    self.assertTrue(tilereader.isNotModified(headers,'"other", W/'+etag,None))
+    self.assertTrue(tilereader.isNotModified(headers,'*',None))
+    self.assertFalse(tilereader.isNotModified(headers,'"other"',None))
+    #If-None-Match wins over If-Modified-Since
+    later=email.utils.formatdate(2000,usegmt=True)
+    earlier=email.utils.formatdate(500,usegmt=True)
+    self.assertFalse(tilereader.isNotModified(headers,'"other"',later))
+    self.assertTrue(tilereader.isNotModified(headers,None,later))
+    self.assertFalse(tilereader.isNotModified(headers,None,earlier))
+    self.assertFalse(tilereader.isNotModified(headers,None,'invalid'))
+    self.assertFalse(tilereader.isNotModified([],etag,later))
+    self.assertFalse(tilereader.isNotModified(headers,None,None))
+
+  def testNoCacheHeaders(self):
+    layer={'errorTiles':False}
+    image=[('Content-Type','image/png')]
+    self.assertTrue(tilereader.isCacheable(layer,'200 OK',image))
+    self.assertFalse(tilereader.isCacheable(None,'200 OK',image))
+    self.assertFalse(tilereader.isCacheable({'errorTiles':True},'200 OK',image))
+    self.assertFalse(tilereader.isCacheable(layer,'404 Not Found',image))
+    self.assertFalse(tilereader.isCacheable(layer,'200 OK',[('Content-Type','text/plain')]))
+    self.assertFalse(tilereader.isCacheable(layer,'200 OK',image+[('Cache-Control','no-cache, no-store')]))
+    self.assertFalse(tilereader.isCacheable(layer,'200 OK',image+[('Pragma','no-cache')]))
+    self.assertTrue(tilereader.isCacheable(layer,'200 OK',image+[('Cache-control','public, max-age=10')]))
+
+
+if __name__ == '__main__':
+  unittest.main()
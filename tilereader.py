@@ -0,0 +1,218 @@
+###############################################################################
+# Copyright (c) 2021, Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+import email.utils
+import hashlib
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+def getHeader(headers,name):
+  '''
+  get a header from a list of (name,value), None if not found
+  '''
+  name=name.lower()
+  for k,v in headers:
+    if k.lower() == name:
+      return v
+  return None
+
+
+def tileHeaders(headers,body,timestamp=None,cacheControl=None):
+  '''
+  set a stable ETag (content hash) and optionally
+  Last-Modified and Cache-Control at a tile response
+  '''
+  rt=[]
+  for k,v in headers:
+    lk=k.lower()
+    if lk == 'etag':
+      continue
+    if lk == 'last-modified' and timestamp is not None:
+      continue
+    if lk == 'cache-control' and cacheControl is not None:
+      continue
+    rt.append((k,v))
+  rt.append(('ETag','"%s"'%hashlib.md5(body).hexdigest()))
+  if timestamp is not None:
+    rt.append(('Last-Modified',email.utils.formatdate(timestamp,usegmt=True)))
+  if cacheControl is not None:
+    rt.append(('Cache-Control',cacheControl))
+  return rt
+
+
+def isNotModified(headers,ifNoneMatch,ifModifiedSince):
+  '''
+  evaluate the conditional request headers against the headers of a tile
+  '''
+  if ifNoneMatch is not None:
+    etag=getHeader(headers,'etag')
+    if etag is None:
+      return False
+    for tag in ifNoneMatch.split(','):
+      tag=tag.strip()
+      if tag.startswith('W/'):
+        tag=tag[2:]
+      if tag == etag or tag == '*':
+        return True
+    return False
+  if ifModifiedSince is not None:
+    lastModified=getHeader(headers,'last-modified')
+    if lastModified is None:
+      return False
+    try:
+      return (email.utils.parsedate_to_datetime(lastModified) <=
+              email.utils.parsedate_to_datetime(ifModifiedSince))
+    except Exception:
+      return False
+  return False
+
+
+def isCacheable(layer,status,headers):
+  '''
+  check if a tile response from mapproxy can be kept in memory
+  mapproxy sends tiles it does not store (e.g. from error handlers) with no-cache,
+  for layers with error handlers we do not keep any tile as we cannot
+  distinguish error tiles from real ones
+  :param layer: the entry from the tile layers, None if unknown
+  '''
+  if layer is None or layer['errorTiles']:
+    return False
+  if not status.startswith('200'):
+    return False
+  if not (getHeader(headers,'content-type') or '').startswith('image/'):
+    return False
+  cacheControl=(getHeader(headers,'cache-control') or '').lower()
+  for directive in ['no-cache','no-store','private']:
+    if directive in cacheControl:
+      return False
+  if 'no-cache' in (getHeader(headers,'pragma') or '').lower():
+    return False
+  return True
+
+
+class MbtilesReader(object):
+  '''
+  read tiles directly from mbtiles files
+  keeps a pool of read-only sqlite connections per file
+  a connection is only used by one thread at a time
+  '''
+  MMAP_SIZE=64*1024*1024
+  QUERY='SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+  QUERY_TS='SELECT tile_data,last_modified FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+  def __init__(self,maxIdle=4,mmapSize=MMAP_SIZE):
+    self.maxIdle=maxIdle
+    self.mmapSize=mmapSize
+    #fileName -> list of idle connections
+    self.idle={}
+    self.generation=0
+    self.lock=threading.Lock()
+    self.hits=0
+    self.misses=0
+    self.errors=0
+
+  def _connect(self,fileName):
+    uri='file:'+urllib.parse.quote(fileName)+'?mode=ro'
+    connection=sqlite3.connect(uri,uri=True,check_same_thread=False)
+    try:
+      connection.execute('PRAGMA mmap_size=%d'%self.mmapSize)
+    except:
+      connection.close()
+      raise
+    return connection
+
+  def _acquire(self,fileName):
+    with self.lock:
+      connections=self.idle.get(fileName)
+      generation=self.generation
+      if connections:
+        return (connections.pop(),generation)
+    return (self._connect(fileName),generation)
+
+  def _release(self,fileName,connection,generation):
+    with self.lock:
+      if generation == self.generation:
+        connections=self.idle.setdefault(fileName,[])
+        if len(connections) < self.maxIdle:
+          connections.append(connection)
+          return
+    connection.close()
+
+  @classmethod
+  def _toTimestamp(cls,value):
+    #mapproxy stores the local time as sqlite datetime
+    if value is None:
+      return None
+    return time.mktime(time.strptime(value,"%Y-%m-%d %H:%M:%S"))
+
+  def getTile(self,fileName,z,x,y,withTimestamp=False):
+    '''
+    read a tile
+    :param y: the tile_row as stored in the file
+    :param withTimestamp: the file has a last_modified column
+    :return: (data,timestamp), data is None if the tile is not in the file
+    '''
+    try:
+      (connection,generation)=self._acquire(fileName)
+    except Exception:
+      self.errors+=1
+      raise
+    try:
+      row=connection.execute(self.QUERY_TS if withTimestamp else self.QUERY,(z,x,y)).fetchone()
+    except Exception:
+      self.errors+=1
+      connection.close()
+      raise
+    self._release(fileName,connection,generation)
+    if row is None or row[0] is None:
+      self.misses+=1
+      return (None,None)
+    self.hits+=1
+    timestamp=None
+    if withTimestamp:
+      try:
+        timestamp=self._toTimestamp(row[1])
+      except Exception:
+        pass
+    return (bytes(row[0]),timestamp)
+
+  def clear(self):
+    '''
+    close all idle connections
+    connections in use will be closed when they are released
+    '''
+    with self.lock:
+      self.generation+=1
+      idle=self.idle
+      self.idle={}
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+
+  def getStatus(self):
+    return {
+      'files':len(self.idle),
+      'hits':self.hits,
+      'misses':self.misses,
+      'errors':self.errors
+    }